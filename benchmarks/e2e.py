@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark for LiberGPT Telegram bot
+Feeds synthetic updates through the real handlers, with the Bot API and the AI API replaced by local stand-ins
+    
+    python benchmarks/e2e.py --users 200 --messages 5 --latency lognormal:0.5,0.5 --output before.json
+
+The report is JSON, so runs of two versions can be diffed. Latency is measured
+per update, from the moment it is queued until its handler has delivered the
+answer, so it includes waiting for the per-user lock and for upstream capacity.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import mock_api
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+BOT_TOKEN = "123456:BENCHMARK"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "LiberGPT", "username": "libergpt_bench_bot"}
+
+class FakeTelegramRequest(BaseRequest):
+    """Bot API transport that answers locally after a sampled delay, counting calls by method"""
+    
+    def __init__(self, latency: mock_api.LatencyModel, seed: Optional[int] = None):
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.calls: Dict[str, int] = {}
+        self._message_ids = itertools.count(1)
+    
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+    
+    def _message(self, parameters: Dict, message_id: Optional[int] = None) -> Dict:
+        """Build the message object the Bot API returns for a sent or edited message"""
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": parameters["chat_id"], "type": "private"},
+            "from": BOT_USER,
+            "text": parameters.get("text", "")
+        }
+    
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None, *args, **kwargs) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        parameters = request_data.parameters if request_data else {}
+        
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint == "sendMessage":
+            await asyncio.sleep(self.latency(self.rng))
+            result = self._message(parameters)
+        elif endpoint == "editMessageText":
+            await asyncio.sleep(self.latency(self.rng))
+            result = self._message(parameters, parameters.get("message_id"))
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+def make_update(bot, update_id: int, user_id: int, text: str) -> Update:
+    """Build a synthetic private text message update bound to a bot"""
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": text
+        }
+    }, bot)
+
+def percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile of already sorted values"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of this process in MiB"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+async def start_mock_api(args: argparse.Namespace) -> Tuple[asyncio.subprocess.Process, str]:
+    """Run the mock AI API in its own process, so its work and memory stay out of the measurement"""
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_api.py"),
+        "--port", "0",
+        "--latency", args.latency,
+        "--error-rate", str(args.error_rate),
+        "--response-chars", str(args.response_chars),
+        "--seed", str(args.seed),
+        stdout=asyncio.subprocess.PIPE
+    )
+    line = (await process.stdout.readline()).decode()
+    if "listening on" not in line:
+        process.kill()
+        raise RuntimeError(f"Mock API failed to start: {line!r}")
+    return process, line.rsplit(" ", 1)[-1].strip()
+
+def configure_environment(args: argparse.Namespace, api_url: str, rate_limit_messages: Optional[int] = None) -> None:
+    """
+    Point the bot's configuration at the stand-ins
+    
+    Args:
+        args: Parsed command line options
+        api_url: Base URL of the mock API
+        rate_limit_messages: Per-user rate limit to use, None to keep the configured one
+    """
+    os.environ.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "API_BASE_URL": api_url,
+        "BOT_MODE": "polling",
+        "WORKER_PROCESSES": "1",
+        "MEMORY_BACKEND": "memory",
+        "RATE_LIMIT_BACKEND": "local",
+        "METRICS_PORT": "0",
+        "TRACE_FILE": "",
+        "STREAM_RESPONSES": str(args.stream),
+        "HEALTH_CHECK_INTERVAL": "3600"
+    })
+    if rate_limit_messages is not None:
+        os.environ["RATE_LIMIT_MESSAGES"] = str(rate_limit_messages)
+    if not args.telegram_pacing:
+        # Telegram's per-chat flood limits would dominate every other cost
+        os.environ.update({
+            "OUTBOUND_GLOBAL_RATE": "1000000",
+            "OUTBOUND_CHAT_RATE": "1000000",
+            "OUTBOUND_CHAT_BURST": "1000000"
+        })
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the options shared by the benchmarks that run the bot"""
+    parser.add_argument("--telegram-latency", default="fixed:0.02", help="Bot API call latency, same syntax as --latency")
+    parser.add_argument("--telegram-pacing", action="store_true", help="keep Telegram's flood limits in the outbound scheduler")
+    parser.add_argument("--stream", action="store_true", help="stream responses into edited messages")
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds to wait for all updates")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    mock_api.add_arguments(parser)
+
+def write_report(report: Dict, output: Optional[str]) -> None:
+    """Print a report as JSON, or write it to a file"""
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"Report written to {output}", file=sys.stderr)
+    else:
+        print(text)
+
+class InstrumentedBot:
+    """The real bot wired to the fake Bot API, timing every chat message it handles"""
+    
+    def __init__(self, request: FakeTelegramRequest):
+        from src.bot import LiberGPTBot
+        from src.config import Config
+        
+        self.request = request
+        self.bot = LiberGPTBot(Config())
+        self._update_ids = itertools.count(1)
+        self._queued_at: Dict[int, float] = {}
+        # (queued, handler started, handler finished) per handled message, in completion order
+        self.timings: List[Tuple[float, float, float]] = []
+        # Messages the debouncer merged into an earlier one; they count as handled
+        self.merged = 0
+        self._waiters: List[Tuple[int, asyncio.Future]] = []
+        
+        handle_message = self.bot.handlers.handle_message
+        
+        async def timed_handle_message(update, context):
+            started = time.perf_counter()
+            try:
+                await handle_message(update, context)
+            finally:
+                self.timings.append((self._queued_at.pop(update.update_id), started, time.perf_counter()))
+                self._wake_waiters()
+        
+        self.bot.handlers.handle_message = timed_handle_message
+        
+        if self.bot.debouncer is not None:
+            add = self.bot.debouncer.add
+            
+            def counted_add(key, update):
+                merged = add(key, update)
+                if merged:
+                    del self._queued_at[update.update_id]
+                    self.merged += 1
+                    self._wake_waiters()
+                return merged
+            
+            self.bot.debouncer.add = counted_add
+        self.bot.application = self.bot._build_application(updater=False, request=request)
+        self.bot.setup_handlers()
+        self.application = self.bot.application
+    
+    @property
+    def handled(self) -> int:
+        """Number of messages handled or merged into another"""
+        return len(self.timings) + self.merged
+    
+    def _wake_waiters(self) -> None:
+        for count, future in self._waiters:
+            if self.handled >= count and not future.done():
+                future.set_result(None)
+    
+    async def start(self) -> None:
+        """Start the bot's services and update processing"""
+        await self.application.initialize()
+        await self.bot._start_services()
+        await self.application.start()
+    
+    async def submit(self, user_id: int, text: str) -> None:
+        """Queue a text message from a user"""
+        update_id = next(self._update_ids)
+        self._queued_at[update_id] = time.perf_counter()
+        await self.application.update_queue.put(make_update(self.application.bot, update_id, user_id, text))
+    
+    async def wait_handled(self, count: int, timeout: float) -> None:
+        """Wait until count messages have been handled or merged"""
+        if self.handled >= count:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((count, future))
+        await asyncio.wait_for(future, timeout=timeout)
+    
+    async def stop(self) -> None:
+        """Stop processing and shut the bot's services down"""
+        if self.application.running:
+            await self.application.stop()
+        await self.application.shutdown()
+        await self.bot.post_shutdown(self.application)
+    
+    def outcomes(self) -> Dict[str, int]:
+        """Count handled messages by outcome, and messages merged by the debouncer"""
+        outcomes = {
+            outcome: self.bot.metrics.update_seconds.count(outcome=outcome)
+            for outcome in ("answered", "rate_limited", "shed", "error")
+        }
+        outcomes["merged"] = self.merged
+        return outcomes
+
+async def fetch_upstream_stats(api_url: str) -> Dict:
+    """Get the mock API's request counters"""
+    async with aiohttp.ClientSession() as session:
+        async with session.get(api_url + "stats") as response:
+            return await response.json()
+
+def latency_summary(values: List[float]) -> Dict:
+    """Summarize durations in seconds"""
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        "p50": round(percentile(values, 0.50), 4),
+        "p95": round(percentile(values, 0.95), 4),
+        "p99": round(percentile(values, 0.99), 4),
+        "max": round(values[-1], 4),
+        "mean": round(sum(values) / len(values), 4)
+    }
+
+async def run_benchmark(args: argparse.Namespace) -> Dict:
+    """Run one benchmark and build its report"""
+    mock_process, api_url = await start_mock_api(args)
+    # The benchmark measures the bot, not the rate limit
+    configure_environment(args, api_url, rate_limit_messages=max(args.messages, 1) * 10)
+    
+    request = FakeTelegramRequest(mock_api.parse_latency(args.telegram_latency), seed=args.seed)
+    bot = InstrumentedBot(request)
+    total = args.users * args.messages
+    
+    rng = random.Random(args.seed)
+    # Each user's messages in order; users interleaved as they would be in real traffic
+    schedule = [(user_id, n) for n in range(args.messages) for user_id in range(1, args.users + 1)]
+    if args.shuffle:
+        # The update processor still runs each user's messages in arrival order
+        rng.shuffle(schedule)
+    
+    try:
+        await bot.start()
+        started = time.perf_counter()
+        for user_id, n in schedule:
+            await bot.submit(user_id, f"Question {n} from user {user_id}: how do I sort a list?")
+            if args.rate:
+                await asyncio.sleep(rng.expovariate(args.rate))
+        await bot.wait_handled(total, timeout=args.timeout)
+        elapsed = time.perf_counter() - started
+    finally:
+        await bot.stop()
+        upstream = await fetch_upstream_stats(api_url)
+        mock_process.terminate()
+        await mock_process.wait()
+    
+    return {
+        "benchmark": "e2e",
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "parameters": {
+            "users": args.users,
+            "messages_per_user": args.messages,
+            "arrival_rate": args.rate,
+            "upstream_latency": args.latency,
+            "upstream_error_rate": args.error_rate,
+            "response_chars": args.response_chars,
+            "telegram_latency": args.telegram_latency,
+            "telegram_pacing": args.telegram_pacing,
+            "stream": args.stream,
+            "seed": args.seed
+        },
+        "updates": total,
+        "duration_s": round(elapsed, 3),
+        "throughput_per_s": round(total / elapsed, 2),
+        "latency_s": latency_summary([finished - queued for queued, _, finished in bot.timings]),
+        "queue_delay_s": latency_summary([handled - queued for queued, handled, _ in bot.timings]),
+        "outcomes": bot.outcomes(),
+        "upstream": upstream,
+        "telegram_calls": dict(sorted(request.calls.items())),
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the bot against local stand-ins")
+    parser.add_argument("--users", type=int, default=100, help="number of users")
+    parser.add_argument("--messages", type=int, default=5, help="messages per user")
+    parser.add_argument("--rate", type=float, default=0.0, help="Poisson arrival rate in updates/s (0 sends all at once)")
+    parser.add_argument("--shuffle", action="store_true", help="randomize the interleaving of users")
+    add_arguments(parser)
+    args = parser.parse_args()
+    
+    # Keep per-message logs out of the measurement
+    logging.basicConfig(level=logging.WARNING)
+    
+    write_report(asyncio.run(run_benchmark(args)), args.output)
+
+if __name__ == "__main__":
+    main()
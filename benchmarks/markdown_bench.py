@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for Markdown escaping and rendering
+Compares the old escape with the current escape and the MarkdownV2 renderer on 4 KB responses
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.markdown import render_markdown_v2
+from src.utils import escape_markdown
+
+SAMPLE = """## Sorting a list in Python
+
+You can sort a list **in place** with `list.sort()` or get a *new* list with `sorted()`:
+
+```python
+numbers = [3, 1, 2]
+numbers.sort(reverse=True)  # [3, 2, 1]
+names = sorted(users, key=lambda u: u["name"])
+```
+
+- `key=` takes a function (e.g. `str.lower`) applied to each item.
+- `reverse=True` sorts in descending order.
+- Sorting is *stable*: equal items keep their order!
+
+See [the docs](https://docs.python.org/3/howto/sorting.html) for more. Cost: O(n log n) -> fine for 10_000+ items.
+
+"""
+
+def legacy_escape(text: str) -> str:
+    """The escape function as it was before the renderer was added"""
+    escape_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
+    for char in escape_chars:
+        text = text.replace(char, f'\\{char}')
+    return text
+
+def make_response(size: int = 4096) -> str:
+    """Build a response of about size characters from the sample"""
+    return (SAMPLE * (size // len(SAMPLE) + 1))[:size]
+
+def bench(name: str, func, text: str, number: int) -> float:
+    """Time func(text) and print microseconds per call"""
+    seconds = min(timeit.repeat(lambda: func(text), number=number, repeat=5)) / number
+    print(f"{name:<28} {seconds * 1e6:9.1f} µs per 4 KB response")
+    return seconds
+
+def main():
+    text = make_response()
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f"Benchmarking on a {len(text)}-character response, best of 5 x {number} calls\n")
+    
+    legacy = bench("escape (old)", legacy_escape, text, number)
+    current = bench("escape_markdown", escape_markdown, text, number)
+    render = bench("render_markdown_v2", render_markdown_v2, text, number)
+    
+    print(f"\nescape_markdown is {legacy / current:.1f}x the speed of the old escape")
+    print(f"Full rendering costs {render / legacy:.1f}x the old escape")
+
+if __name__ == "__main__":
+    main()
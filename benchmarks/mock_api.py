@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the LiberGPT copilot endpoint
+Answers like the real API after a sampled delay, with configurable errors and response sizes
+
+Run it on its own to point a real bot at it:
+    python benchmarks/mock_api.py --port 8081 --latency lognormal:0.8,0.5
+    API_BASE_URL=http://127.0.0.1:8081/ python main.py
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+from typing import Callable, Dict, Optional
+
+from aiohttp import web
+
+# Draws one latency in seconds
+LatencyModel = Callable[[random.Random], float]
+
+_WORDS = (
+    "the", "a", "model", "answer", "python", "list", "value", "function", "returns", "data",
+    "example", "result", "because", "simple", "request", "user", "each", "with", "for", "and"
+)
+
+def parse_latency(spec: str) -> LatencyModel:
+    """
+    Parse a latency distribution
+    
+    Args:
+        spec: One of "fixed:SECONDS", "uniform:LOW,HIGH", "exp:MEAN" or "lognormal:MEDIAN,SIGMA"
+    
+    Returns:
+        Function drawing a latency from the distribution
+    
+    Raises:
+        ValueError: For an unknown distribution or malformed parameters
+    """
+    name, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(",") if value]
+    if name == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if name == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if name == "exp" and len(values) == 1:
+        return lambda rng: rng.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+    if name == "lognormal" and len(values) == 2:
+        # The median of a lognormal distribution is exp(mu)
+        mu = math.log(values[0]) if values[0] > 0 else float("-inf")
+        return lambda rng: rng.lognormvariate(mu, values[1]) if values[0] > 0 else 0.0
+    raise ValueError(f"Unknown latency distribution: {spec!r}")
+
+def make_text(rng: random.Random, size: int) -> str:
+    """Generate Markdown-flavoured text of about size characters"""
+    parts = []
+    length = 0
+    while length < size:
+        if rng.random() < 0.1:
+            part = "```python\nresult = [x * 2 for x in range(10)]\nprint(result)\n```"
+        elif rng.random() < 0.2:
+            part = "- **" + " ".join(rng.choices(_WORDS, k=3)) + "**: " + " ".join(rng.choices(_WORDS, k=8)) + "."
+        else:
+            part = " ".join(rng.choices(_WORDS, k=rng.randint(20, 60))).capitalize() + "."
+        parts.append(part)
+        length += len(part) + 2
+    return "\n\n".join(parts)[:size]
+
+class MockLiberGPTAPI:
+    """aiohttp server imitating the copilot endpoint, plain JSON and server-sent events"""
+    
+    def __init__(
+        self,
+        latency: LatencyModel = parse_latency("fixed:0"),
+        error_rate: float = 0.0,
+        response_chars: int = 800,
+        stream_chunk_chars: int = 40,
+        seed: Optional[int] = None
+    ):
+        """
+        Initialize the mock API
+        
+        Args:
+            latency: Distribution of the delay before answering
+            error_rate: Fraction of requests answered with an error, half as HTTP 500,
+                half as a JSON body with code 500
+            response_chars: Length of each response
+            stream_chunk_chars: Characters per event of a streamed response
+            seed: Random seed, for reproducible runs
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.response_chars = response_chars
+        self.stream_chunk_chars = stream_chunk_chars
+        self.rng = random.Random(seed)
+        self._runner: Optional[web.AppRunner] = None
+        self.port: Optional[int] = None
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+    
+    def make_app(self) -> web.Application:
+        """Build the aiohttp application: the API on / and counters on /stats"""
+        app = web.Application()
+        app.router.add_post("/", self.handle_request)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+    
+    async def handle_request(self, request: web.Request) -> web.StreamResponse:
+        """Answer one completion request"""
+        payload = await request.json()
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency(self.rng))
+            if self.rng.random() < self.error_rate:
+                self.errors += 1
+                if self.rng.random() < 0.5:
+                    return web.Response(status=500, text="Internal Server Error")
+                return web.json_response({"code": 500, "message": "Mock upstream failure"})
+            
+            content = make_text(self.rng, self.response_chars)
+            if payload.get("stream") != "true":
+                return web.json_response({"code": 200, "response": {"role": "assistant", "content": content}})
+            
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            for start in range(0, len(content), self.stream_chunk_chars):
+                event = {"choices": [{"delta": {"content": content[start:start + self.stream_chunk_chars]}}]}
+                await response.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+        finally:
+            self.in_flight -= 1
+    
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        """Report request counters"""
+        return web.json_response(self.get_stats())
+    
+    def get_stats(self) -> Dict:
+        """
+        Get request statistics
+        
+        Returns:
+            Dictionary with request, error and concurrency counters
+        """
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'peak_in_flight': self.peak_in_flight
+        }
+    
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Start serving
+        
+        Args:
+            host: Address to bind to
+            port: Port to bind to, 0 for any free port
+        
+        Returns:
+            Base URL of the API
+        """
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{self.port}/"
+    
+    async def stop(self) -> None:
+        """Stop serving"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the mock API options to a command line parser"""
+    parser.add_argument("--latency", default="lognormal:0.5,0.5",
+                        help="upstream latency: fixed:S, uniform:LOW,HIGH, exp:MEAN or lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream requests that fail")
+    parser.add_argument("--response-chars", type=int, default=800, help="length of each AI response")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+
+def from_arguments(args: argparse.Namespace) -> MockLiberGPTAPI:
+    """Create a mock API from parsed command line options"""
+    return MockLiberGPTAPI(
+        latency=parse_latency(args.latency),
+        error_rate=args.error_rate,
+        response_chars=args.response_chars,
+        seed=args.seed
+    )
+
+async def _serve(args: argparse.Namespace) -> None:
+    api = from_arguments(args)
+    url = await api.start(args.host, args.port)
+    print(f"Mock LiberGPT API listening on {url}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    add_arguments(parser)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Trace replay load test for LiberGPT Telegram bot
+Replays a recorded update trace (TRACE_FILE) against the bot wired to the mock API, at any speed
+    
+    python benchmarks/replay.py trace.jsonl --speed 10 --output replay-10x.json
+
+Real traffic comes in bursts, so unlike the synthetic benchmark the real rate
+limit stays in force. The report has a timeline with queueing delay, rate
+limit rejections and memory growth per interval of replay time.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import mock_api
+from benchmarks.e2e import (
+    FakeTelegramRequest, InstrumentedBot, add_arguments, configure_environment, fetch_upstream_stats,
+    latency_summary, peak_rss_mb, percentile, start_mock_api, write_report
+)
+
+def load_trace(paths: List[str], limit: Optional[int] = None) -> List[Tuple[float, int, int]]:
+    """
+    Load and merge trace files
+    
+    Args:
+        paths: JSONL files written by TraceRecorder, e.g. one per worker process
+        limit: Keep only the first limit messages
+    
+    Returns:
+        (seconds from the first message, user number, message length) in arrival order
+    """
+    entries = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entries.append(json.loads(line))
+    entries.sort(key=lambda entry: entry['t'])
+    if limit:
+        entries = entries[:limit]
+    if not entries:
+        return []
+    
+    # Pseudonyms become small user IDs in order of first appearance
+    users: Dict[str, int] = {}
+    start = entries[0]['t']
+    return [
+        (entry['t'] - start, users.setdefault(entry['user'], len(users) + 1), entry['chars'])
+        for entry in entries
+    ]
+
+def current_rss_mb() -> Optional[float]:
+    """Current resident set size of this process in MiB, where /proc is available"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+
+def make_text(index: int, user_id: int, chars: int) -> str:
+    """
+    Build a message of the recorded length
+    
+    Every message is distinct, so neither response cache can answer replayed
+    messages that reached the upstream in production.
+    """
+    prefix = f"#{index} from {user_id}: "
+    return (prefix + mock_api.make_text(random.Random(index), chars))[:max(chars, len(prefix))]
+
+async def sample_timeline(bot: InstrumentedBot, interval: float, speed: float, sent: List[int], timeline: List[Dict]) -> None:
+    """Record queueing, rejections and memory every interval seconds of replay time"""
+    started = time.perf_counter()
+    seen = 0
+    while True:
+        await asyncio.sleep(interval / speed)
+        window = bot.timings[seen:]
+        seen += len(window)
+        memory = bot.bot.memory.get_total_stats()
+        timeline.append({
+            "t": round((time.perf_counter() - started) * speed, 1),
+            "sent": sent[0],
+            "handled": bot.handled,
+            "backlog": sent[0] - bot.handled,
+            "queue_delay_p95_s": round(percentile(sorted(handled - queued for queued, handled, _ in window), 0.95) or 0, 4),
+            "rate_limited": int(bot.bot.metrics.rate_limit_rejections.value()),
+            "memory_users": memory['active_users'],
+            "memory_conversations": memory['total_conversations'],
+            "memory_bytes": memory['current_bytes'],
+            "rss_mb": current_rss_mb()
+        })
+
+async def run_replay(args: argparse.Namespace) -> Dict:
+    """Replay a trace and build the report"""
+    trace = load_trace(args.trace, args.limit)
+    if not trace:
+        raise SystemExit("The trace is empty")
+    
+    mock_process, api_url = await start_mock_api(args)
+    configure_environment(args, api_url, rate_limit_messages=args.rate_limit_messages)
+    
+    request = FakeTelegramRequest(mock_api.parse_latency(args.telegram_latency), seed=args.seed)
+    bot = InstrumentedBot(request)
+    sent = [0]
+    timeline: List[Dict] = []
+    
+    try:
+        await bot.start()
+        sampler = asyncio.create_task(sample_timeline(bot, args.interval, args.speed, sent, timeline))
+        started = time.perf_counter()
+        for index, (offset, user_id, chars) in enumerate(trace):
+            # Sleep until the message's scaled arrival time rather than for the gap,
+            # so the time spent queueing updates does not slow the replay down
+            delay = offset / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await bot.submit(user_id, make_text(index, user_id, chars))
+            sent[0] += 1
+        await bot.wait_handled(len(trace), timeout=args.timeout)
+        elapsed = time.perf_counter() - started
+        sampler.cancel()
+    finally:
+        await bot.stop()
+        upstream = await fetch_upstream_stats(api_url)
+        mock_process.terminate()
+        await mock_process.wait()
+    
+    return {
+        "benchmark": "replay",
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "parameters": {
+            "trace": args.trace,
+            "speed": args.speed,
+            "rate_limit_messages": bot.bot.config.RATE_LIMIT_MESSAGES,
+            "rate_limit_window": bot.bot.config.RATE_LIMIT_WINDOW,
+            "debounce_window": bot.bot.config.DEBOUNCE_WINDOW,
+            "upstream_latency": args.latency,
+            "upstream_error_rate": args.error_rate,
+            "response_chars": args.response_chars,
+            "telegram_latency": args.telegram_latency,
+            "telegram_pacing": args.telegram_pacing,
+            "seed": args.seed
+        },
+        "updates": len(trace),
+        "users": len({user_id for _, user_id, _ in trace}),
+        "trace_duration_s": round(trace[-1][0], 3),
+        "duration_s": round(elapsed, 3),
+        "latency_s": latency_summary([finished - queued for queued, _, finished in bot.timings]),
+        "queue_delay_s": latency_summary([handled - queued for queued, handled, _ in bot.timings]),
+        "outcomes": bot.outcomes(),
+        "upstream": upstream,
+        "telegram_calls": dict(sorted(request.calls.items())),
+        "peak_rss_mb": peak_rss_mb(),
+        "timeline": timeline
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded update trace against the bot")
+    parser.add_argument("trace", nargs="+", help="trace files recorded with TRACE_FILE")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, e.g. 10 for ten times faster")
+    parser.add_argument("--interval", type=float, default=10.0, help="seconds of replay time per timeline entry")
+    parser.add_argument("--limit", type=int, help="replay only the first N messages")
+    parser.add_argument("--rate-limit-messages", type=int, help="per-user rate limit (default: as configured)")
+    add_arguments(parser)
+    args = parser.parse_args()
+    
+    # Keep per-message logs out of the measurement
+    logging.basicConfig(level=logging.WARNING)
+    
+    write_report(asyncio.run(run_replay(args)), args.output)
+
+if __name__ == "__main__":
+    main()
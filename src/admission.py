@@ -0,0 +1,211 @@
+"""
+Admission control for LiberGPT upstream requests
+Bounds concurrent upstream calls, serves waiting users round-robin and sheds load when the wait queue is full
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+class AdmissionRejected(Exception):
+    """Raised when a request is not admitted to the upstream"""
+
+class QueueFullError(AdmissionRejected):
+    """Raised when the wait queue is full and the request is shed"""
+
+class QueueTimeoutError(AdmissionRejected):
+    """Raised when a request waited in the queue past its deadline"""
+
+class AdmissionController:
+    """Max-in-flight limiter with a bounded wait queue shared fairly between users
+    
+    Waiting requests are queued per key (the user ID) and freed slots go to the
+    keys in round-robin order, so a user with many queued messages is served at
+    the same pace as a user with one. Each key's own requests stay in FIFO order.
+    """
+    
+    def __init__(self, max_in_flight: int = 8, max_queue: int = 100, queue_timeout: float = 60.0):
+        """
+        Initialize the admission controller
+        
+        Args:
+            max_in_flight: Maximum number of upstream requests running at once
+            max_queue: Maximum number of requests waiting for a slot
+            queue_timeout: Seconds a request may wait for a slot
+        """
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._in_flight = 0
+        # Per-key FIFO queues of waiter futures, ordered by whose turn is next
+        self._queues: "OrderedDict[Hashable, deque]" = OrderedDict()
+        self._queue_length = 0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.timed_out = 0
+    
+    async def acquire(
+        self,
+        key: Hashable = None,
+        on_queued: Optional[Callable[[int], Awaitable[None]]] = None
+    ) -> None:
+        """
+        Wait for an upstream slot
+        
+        Args:
+            key: Fairness key, usually the user ID
+            on_queued: Called with the queue position when the request has to wait
+        
+        Raises:
+            QueueFullError: If the wait queue is full
+            QueueTimeoutError: If no slot became free before the deadline
+        """
+        if self._in_flight < self.max_in_flight and not self._queue_length:
+            self._in_flight += 1
+            self.admitted += 1
+            return
+        
+        if self._queue_length >= self.max_queue:
+            self.shed += 1
+            logger.warning(f"Upstream queue full ({self._queue_length} waiting), shedding request")
+            raise QueueFullError("Too many requests are waiting for the AI service")
+        
+        deadline = time.monotonic() + self.queue_timeout
+        waiter = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+        queue.append(waiter)
+        self._queue_length += 1
+        self.queued += 1
+        
+        try:
+            if on_queued is not None:
+                try:
+                    await on_queued(self.position(key, waiter))
+                except Exception as e:
+                    logger.error(f"Failed to report queue position: {e}")
+            
+            await asyncio.wait_for(waiter, timeout=max(0.0, deadline - time.monotonic()))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up; pass it on
+                self.release()
+            else:
+                waiter.cancel()
+                self._remove_waiter(key, waiter)
+            
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise QueueTimeoutError("Timed out waiting for the AI service") from None
+            raise
+        
+        self.admitted += 1
+    
+    def _remove_waiter(self, key: Hashable, waiter: asyncio.Future) -> None:
+        """Drop a waiter that gave up"""
+        queue = self._queues.get(key)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            return
+        self._queue_length -= 1
+        if not queue:
+            del self._queues[key]
+    
+    def _pop_next_waiter(self) -> Optional[asyncio.Future]:
+        """Take the oldest waiter of the key whose turn it is and move that key to the back"""
+        while self._queues:
+            key, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            self._queue_length -= 1
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if not waiter.done():
+                return waiter
+        return None
+    
+    def release(self) -> None:
+        """Free a slot, handing it directly to the next waiter if there is one"""
+        waiter = self._pop_next_waiter()
+        if waiter is not None:
+            # The slot changes hands, so the in-flight count stays the same
+            waiter.set_result(None)
+            return
+        self._in_flight -= 1
+    
+    @asynccontextmanager
+    async def slot(
+        self,
+        key: Hashable = None,
+        on_queued: Optional[Callable[[int], Awaitable[None]]] = None
+    ) -> AsyncIterator[None]:
+        """
+        Hold an upstream slot for the duration of the block
+        
+        Args:
+            key: Fairness key, usually the user ID
+            on_queued: Called with the queue position when the request has to wait
+        """
+        await self.acquire(key, on_queued)
+        try:
+            yield
+        finally:
+            self.release()
+    
+    def position(self, key: Hashable, waiter: asyncio.Future) -> int:
+        """
+        Get the place of a waiter in the round-robin service order
+        
+        Args:
+            key: Fairness key the waiter was queued under
+            waiter: Waiter future
+        
+        Returns:
+            1-based position, 0 if the waiter is not queued
+        """
+        queue = self._queues.get(key)
+        if queue is None:
+            return 0
+        try:
+            index = queue.index(waiter)
+        except ValueError:
+            return 0
+        
+        # Keys ahead of ours in this round are served index + 1 times before the
+        # waiter's turn comes, keys behind it only index times
+        ahead = index
+        own_turn_passed = False
+        for other_key, other_queue in self._queues.items():
+            if other_key == key:
+                own_turn_passed = True
+                continue
+            ahead += min(len(other_queue), index if own_turn_passed else index + 1)
+        return ahead + 1
+    
+    def get_stats(self) -> Dict:
+        """
+        Get admission statistics
+        
+        Returns:
+            Dictionary with current load and admission counters
+        """
+        return {
+            'in_flight': self._in_flight,
+            'queue_length': self._queue_length,
+            'queued_users': len(self._queues),
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'shed': self.shed,
+            'timed_out': self.timed_out
+        }
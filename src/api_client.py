@@ -3,55 +3,244 @@ API client for communicating with LiberGPT Copilot API
 """
 
 import asyncio
+import hashlib
+import json
 import logging
-from typing import Dict, Any
+import time
+from typing import Dict, Any, List, Optional, AsyncIterator, Awaitable, Callable, TypeVar
 import aiohttp
 
+from .cache import ResponseCache, SimilarityCache
+from .resilience import CircuitBreaker, LatencyTracker, RetryPolicy, is_retryable
+
 logger = logging.getLogger(__name__)
 
+T = TypeVar('T')
+
+class _Flight:
+    """An in-flight call shared by every caller with the same key"""
+    
+    __slots__ = ('task', 'waiters')
+    
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into a single execution"""
+    
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.executions = 0
+        self.coalesced = 0
+    
+    async def do(self, key: str, func: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run func once for all concurrent callers that use the same key
+        
+        Every waiter receives the same result or exception. A cancelled waiter
+        only stops waiting; the shared call is cancelled once no waiters remain.
+        
+        Args:
+            key: Identifies calls that may share a result
+            func: Zero-argument coroutine function performing the call
+        
+        Returns:
+            Result of the shared call
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(func()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _task: self._forget(key, flight))
+            self.executions += 1
+        else:
+            self.coalesced += 1
+        
+        flight.waiters += 1
+        try:
+            # Shield so that cancelling one waiter does not cancel the shared call
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+                self._forget(key, flight)
+    
+    def _forget(self, key: str, flight: _Flight) -> None:
+        """Remove a finished or abandoned flight so later calls start afresh"""
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+    
+    @property
+    def in_flight(self) -> int:
+        """Number of distinct calls currently running"""
+        return len(self._flights)
+
 class LiberGPTAPIClient:
     """Client for interacting with the LiberGPT Copilot API"""
     
-    def __init__(self, base_url: str, timeout: int = 30):
+    def __init__(
+        self,
+        base_url: str,
+        timeout: int = 30,
+        pool_limit: int = 100,
+        pool_limit_per_host: int = 20,
+        keepalive_timeout: float = 30.0,
+        dns_cache_ttl: int = 300,
+        cache: Optional[ResponseCache] = None,
+        similarity_cache: Optional[SimilarityCache] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        hedging: bool = False,
+        hedge_min_samples: int = 20
+    ):
         """
         Initialize the API client
         
         Args:
             base_url: Base URL of the API
             timeout: Request timeout in seconds
+            pool_limit: Maximum number of pooled connections in total
+            pool_limit_per_host: Maximum number of pooled connections per host
+            keepalive_timeout: Seconds an idle connection is kept open for reuse
+            dns_cache_ttl: Seconds resolved DNS entries are cached
+            cache: Optional cache of recent responses
+            similarity_cache: Optional cache answering near-duplicates of recent prompts
+                sent without conversation context
+            retry_policy: Retry policy for transient failures (single attempt if None)
+            circuit_breaker: Circuit breaker failing fast while the upstream is down
+            hedging: Whether to send a second request when the first exceeds the p95 latency
+            hedge_min_samples: Successful requests observed before hedging starts
         """
         self.base_url = base_url.rstrip('/')
         self.timeout = aiohttp.ClientTimeout(total=timeout)
-        self.session = None
+        self.pool_limit = pool_limit
+        self.pool_limit_per_host = pool_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.cache = cache
+        self.similarity_cache = similarity_cache
+        self.single_flight = SingleFlight()
+        self._listeners: List[Callable[[float, Optional[BaseException]], None]] = []
+        self.retry_policy = retry_policy or RetryPolicy(max_attempts=1)
+        self.circuit_breaker = circuit_breaker
+        self.hedging = hedging
+        self.latency_tracker = LatencyTracker(min_samples=hedge_min_samples)
+        self.add_listener(self.latency_tracker.record)
+        self.hedges_sent = 0
+        self.hedge_wins = 0
+        self.session: Optional[aiohttp.ClientSession] = None
     
     async def __aenter__(self):
         """Async context manager entry"""
-        self.session = aiohttp.ClientSession(timeout=self.timeout)
+        await self.start()
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """Async context manager exit"""
-        if self.session:
+        await self.close()
+    
+    async def start(self) -> None:
+        """
+        Open the pooled HTTP session shared by all requests
+        
+        Calling this on an already started client is a no-op.
+        """
+        if self.session and not self.session.closed:
+            return
+        
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_limit,
+            limit_per_host=self.pool_limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+            use_dns_cache=True
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=self.timeout,
+            headers=self._get_default_headers()
+        )
+        logger.info(
+            f"API session opened (pool limit: {self.pool_limit}, "
+            f"per host: {self.pool_limit_per_host}, keep-alive: {self.keepalive_timeout}s)"
+        )
+    
+    async def close(self) -> None:
+        """Close the pooled HTTP session and release its connections"""
+        if self.session and not self.session.closed:
             await self.session.close()
+            logger.info("API session closed")
+        self.session = None
+    
+    def add_listener(self, listener: Callable[[float, Optional[BaseException]], None]) -> None:
+        """
+        Register a callback notified after every upstream request
+        
+        Args:
+            listener: Called with the request duration in seconds and the raised
+                exception (None on success). Cache hits are not reported.
+        """
+        self._listeners.append(listener)
+    
+    def _notify_listeners(self, started_at: float, error: Optional[BaseException]) -> None:
+        """Report a finished upstream request to all listeners"""
+        latency = time.monotonic() - started_at
+        for listener in self._listeners:
+            try:
+                listener(latency, error)
+            except Exception as e:
+                logger.error(f"API request listener failed: {e}")
+    
+    def _get_default_headers(self) -> Dict[str, str]:
+        """
+        Get the headers sent with every API request
+        
+        Returns:
+            Dictionary of HTTP headers
+        """
+        return {
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+            'User-Agent': 'LiberGPT-Telegram-Bot/1.0'
+        }
     
-    def _build_payload(self, prompt: str) -> Dict[str, Any]:
+    def _build_payload(self, prompt: str, stream: bool = False) -> Dict[str, Any]:
         """
         Build the JSON payload for the API request
         
         Args:
             prompt: The text prompt to send to the API
-            
+            stream: Whether to ask the API for a streamed response
+        
         Returns:
             JSON payload for the request
         """
         return {
-            "stream": "false",
+            "stream": "true" if stream else "false",
             "messages": [
                 {"role": "system", "content": "You are LiberGPT"},
                 {"role": "user", "content": prompt}
             ]
         }
     
+    @staticmethod
+    def _compose_prompt(prompt: str, context: str = "") -> str:
+        """
+        Combine conversation context and the user's prompt into one message
+        
+        Args:
+            prompt: The user's prompt
+            context: Conversation context, empty for stateless prompts
+        
+        Returns:
+            Prompt text sent to the API
+        """
+        if context:
+            return f"{context}\n{prompt}"
+        return prompt
+    
     def _get_api_url(self) -> str:
         """
         Get the complete API URL
@@ -61,74 +250,435 @@ class LiberGPTAPIClient:
         """
         return self.base_url
     
-    async def get_response(self, prompt: str) -> str:
+    def _ensure_session(self) -> aiohttp.ClientSession:
+        """
+        Get the pooled session, failing if the client has not been started
+        
+        Returns:
+            The open HTTP session
+        """
+        if not self.session or self.session.closed:
+            raise RuntimeError("API client not initialized. Call start() or use as async context manager.")
+        return self.session
+    
+    @staticmethod
+    def _parse_response_data(data: Any) -> str:
+        """
+        Validate a complete API response body and extract its content
+        
+        Args:
+            data: Decoded JSON response body
+        
+        Returns:
+            AI response text
+        
+        Raises:
+            ValueError: For invalid API response format
+        """
+        if not isinstance(data, dict):
+            raise ValueError("API response is not a JSON object")
+        
+        # Check for expected structure
+        if data.get("code") != 200:
+            error_msg = data.get("message", data.get("error", "Unknown API error"))
+            raise ValueError(f"API error: {error_msg}")
+        
+        response_content = data.get("response", {}).get("content")
+        if not response_content:
+            raise ValueError("API response missing content field")
+        
+        return response_content
+    
+    @staticmethod
+    def _parse_stream_event(data: str) -> Optional[str]:
+        """
+        Extract the text delta from one server-sent event payload
+        
+        Accepts OpenAI-style chunks (choices[0].delta.content) as well as the
+        non-streaming response shape and bare {"content": ...} objects.
+        Payloads that are not JSON are treated as raw text.
+        
+        Args:
+            data: The payload after the "data:" prefix
+        
+        Returns:
+            Text delta, or None if the event carries no text
+        """
+        try:
+            event = json.loads(data)
+        except ValueError:
+            return data
+        
+        if not isinstance(event, dict):
+            return None
+        
+        if "error" in event and not event.get("choices"):
+            error = event["error"]
+            message = error.get("message") if isinstance(error, dict) else error
+            raise ValueError(f"API error: {message}")
+        
+        choices = event.get("choices")
+        if choices:
+            choice = choices[0]
+            delta = choice.get("delta") or choice.get("message") or {}
+            return delta.get("content") or choice.get("text")
+        
+        response = event.get("response")
+        if isinstance(response, dict):
+            return response.get("content")
+        
+        return event.get("content")
+    
+    async def get_response(self, prompt: str, context: str = "", use_cache: bool = True) -> str:
         """
         Get AI response for the given prompt
         
         Args:
             prompt: The text prompt to send to the API
-            
+            context: Conversation context to send along with the prompt
+            use_cache: Whether the response cache may answer this request
+        
         Returns:
             AI response text
-            
+        
         Raises:
             aiohttp.ClientError: For HTTP-related errors
             ValueError: For invalid API response format
             asyncio.TimeoutError: For request timeout
+            CircuitOpenError: While the upstream is considered down
         """
-        if not self.session:
-            raise RuntimeError("API client not initialized. Use as async context manager.")
+        cache_key = None
+        if self.cache is not None and use_cache:
+            cache_key = self.cache.make_key(prompt, context)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                logger.debug("Serving API response from cache: %d characters", len(cached))
+                return cached
         
-        url = self._get_api_url()
-        payload = self._build_payload(prompt)
-        headers = {
-            'Accept': 'application/json',
-            'Content-Type': 'application/json',
-            'User-Agent': 'LiberGPT-Telegram-Bot/1.0'
+        # Without context the answer depends on the prompt alone, so a near-duplicate's answer fits
+        similar = self.similarity_cache is not None and use_cache and not context
+        if similar:
+            cached = self.similarity_cache.get(prompt)
+            if cached is not None:
+                logger.debug("Serving API response from similarity cache: %d characters", len(cached))
+                return cached
+        
+        # Identical concurrent requests share one upstream call
+        payload = self._build_payload(self._compose_prompt(prompt, context))
+        response_content = await self.single_flight.do(
+            self._payload_key(payload),
+            lambda: self._resilient_request(payload)
+        )
+        
+        self._store_response(cache_key, prompt if similar else None, response_content)
+        return response_content
+    
+    def _store_response(self, cache_key: Optional[str], similarity_prompt: Optional[str], response: str) -> None:
+        """
+        Store a fresh response in the caches that may answer it later
+        
+        Args:
+            cache_key: Response cache key, or None if the response cache is not used
+            similarity_prompt: Prompt to index in the similarity cache, or None if it is not used
+            response: Response text
+        """
+        if cache_key is not None:
+            self.cache.set(cache_key, response)
+        if similarity_prompt is not None:
+            self.similarity_cache.set(similarity_prompt, response)
+    
+    async def _resilient_request(self, payload: Dict[str, Any]) -> str:
+        """
+        Send a request with circuit breaking and retries of transient failures
+        
+        Args:
+            payload: JSON payload for the request
+        
+        Returns:
+            AI response text
+        """
+        delay = self.retry_policy.base_delay
+        attempt = 1
+        while True:
+            if self.circuit_breaker:
+                self.circuit_breaker.before_request()
+            
+            try:
+                response_content = await self._hedged_request(payload)
+            except asyncio.CancelledError:
+                if self.circuit_breaker:
+                    self.circuit_breaker.release()
+                raise
+            except Exception as e:
+                self._record_circuit_outcome(e)
+                if not is_retryable(e):
+                    raise
+                if attempt >= self.retry_policy.max_attempts:
+                    if self.retry_policy.max_attempts > 1:
+                        self.retry_policy.exhausted += 1
+                    raise
+                
+                delay = self.retry_policy.next_delay(delay)
+                self.retry_policy.retries += 1
+                logger.warning(f"API request attempt {attempt} failed ({type(e).__name__}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            
+            self._record_circuit_outcome(None)
+            return response_content
+    
+    def _record_circuit_outcome(self, error: Optional[BaseException]) -> None:
+        """
+        Report a request outcome to the circuit breaker
+        
+        Only transient failures say anything about upstream availability; any
+        other outcome means the upstream answered.
+        
+        Args:
+            error: Exception raised by the request, None on success
+        """
+        if not self.circuit_breaker:
+            return
+        if error is not None and is_retryable(error):
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+    
+    async def _hedged_request(self, payload: Dict[str, Any]) -> str:
+        """
+        Send a request, adding a second one if the first is slower than the p95 latency
+        
+        Whichever request answers first wins and the other one is cancelled.
+        
+        Args:
+            payload: JSON payload for the request
+        
+        Returns:
+            AI response text
+        """
+        hedge_delay = self.latency_tracker.percentile(0.95) if self.hedging else None
+        if hedge_delay is None:
+            return await self._request(payload)
+        
+        primary = asyncio.ensure_future(self._request(payload))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if done:
+                return primary.result()
+            
+            self.hedges_sent += 1
+            logger.debug(f"API request slower than {hedge_delay:.2f}s, sending hedged request")
+            tasks.add(asyncio.ensure_future(self._request(payload)))
+            
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        return task.result()
+                if not tasks:
+                    # Both requests failed; report the primary's error
+                    return primary.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    def get_stats(self) -> Dict:
+        """
+        Get request resilience statistics
+        
+        Returns:
+            Dictionary with retry, circuit breaker, hedging and coalescing counters
+        """
+        stats = {
+            'requests_coalesced': self.single_flight.coalesced,
+            'hedges_sent': self.hedges_sent,
+            'hedge_wins': self.hedge_wins
         }
+        stats.update(self.retry_policy.get_stats())
+        if self.circuit_breaker:
+            stats.update(self.circuit_breaker.get_stats())
+        return stats
+    
+    @staticmethod
+    def _payload_key(payload: Dict[str, Any]) -> str:
+        """
+        Get a key identifying requests with an identical payload
+        
+        Args:
+            payload: JSON payload for the request
+        
+        Returns:
+            Hex digest of the canonical payload
+        """
+        canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+    
+    async def _request(self, payload: Dict[str, Any]) -> str:
+        """
+        Send one non-streaming request to the API
         
-        logger.debug(f"Making API request to: {url}")
+        Args:
+            payload: JSON payload for the request
+        
+        Returns:
+            AI response text
+        """
+        session = self._ensure_session()
+        url = self._get_api_url()
         
+        logger.debug("Making API request to: %s", url)
+        
+        started_at = time.monotonic()
         try:
-            async with self.session.post(url, json=payload, headers=headers) as response:
+            async with session.post(url, json=payload) as response:
                 # Check if request was successful
                 response.raise_for_status()
                 
-                # Parse JSON response
+                # Parse and validate JSON response
                 data = await response.json()
+                response_content = self._parse_response_data(data)
                 
-                # Validate response format
-                if not isinstance(data, dict):
-                    raise ValueError("API response is not a JSON object")
-                
-                # Check for expected structure
-                if data.get("code") != 200:
-                    error_msg = data.get("message", data.get("error", "Unknown API error"))
-                    raise ValueError(f"API error: {error_msg}")
-                
-                response_content = data.get("response", {}).get("content")
-                if not response_content:
-                    raise ValueError("API response missing content field")
-                
-                logger.debug(f"Received API response: {len(response_content)} characters")
+                logger.debug("Received API response: %d characters", len(response_content))
+                self._notify_listeners(started_at, None)
                 return response_content
-                
-        except aiohttp.ClientTimeout:
+        
+        except asyncio.TimeoutError as e:
             logger.error("API request timed out")
+            self._notify_listeners(started_at, e)
             raise asyncio.TimeoutError("API request timed out")
         
         except aiohttp.ClientError as e:
             logger.error(f"HTTP error during API request: {e}")
+            self._notify_listeners(started_at, e)
             raise
         
         except Exception as e:
             logger.error(f"Unexpected error during API request: {e}")
+            self._notify_listeners(started_at, e)
+            raise
+    
+    async def stream_response(self, prompt: str, context: str = "", use_cache: bool = True) -> AsyncIterator[str]:
+        """
+        Stream the AI response for the given prompt as it is generated
+        
+        The upstream stream is parsed incrementally as server-sent events. If the
+        API answers with a regular JSON body instead, its content is yielded at once.
+        A cached response is yielded as a single chunk.
+        
+        Args:
+            prompt: The text prompt to send to the API
+            context: Conversation context to send along with the prompt
+            use_cache: Whether the response cache may answer this request
+        
+        Yields:
+            Successive chunks of the AI response text
+        
+        Raises:
+            aiohttp.ClientError: For HTTP-related errors
+            ValueError: For invalid API response format
+            asyncio.TimeoutError: For request timeout
+            CircuitOpenError: While the upstream is considered down
+        """
+        cache_key = None
+        if self.cache is not None and use_cache:
+            cache_key = self.cache.make_key(prompt, context)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                logger.debug("Serving streamed API response from cache: %d characters", len(cached))
+                yield cached
+                return
+        
+        similar = self.similarity_cache is not None and use_cache and not context
+        if similar:
+            cached = self.similarity_cache.get(prompt)
+            if cached is not None:
+                logger.debug("Serving streamed API response from similarity cache: %d characters", len(cached))
+                yield cached
+                return
+        
+        session = self._ensure_session()
+        url = self._get_api_url()
+        payload = self._build_payload(self._compose_prompt(prompt, context), stream=True)
+        
+        # Streams are not retried once started, but still respect the circuit breaker
+        if self.circuit_breaker:
+            self.circuit_breaker.before_request()
+        headers = {'Accept': 'text/event-stream, application/json'}
+        
+        logger.debug("Making streaming API request to: %s", url)
+        
+        started_at = time.monotonic()
+        try:
+            async with session.post(url, json=payload, headers=headers) as response:
+                response.raise_for_status()
+                
+                if response.content_type == 'application/json':
+                    data = await response.json()
+                    response_content = self._parse_response_data(data)
+                    self._notify_listeners(started_at, None)
+                    self._record_circuit_outcome(None)
+                    self._store_response(cache_key, prompt if similar else None, response_content)
+                    yield response_content
+                    return
+                
+                received = 0
+                chunks = []
+                async for raw_line in response.content:
+                    line = raw_line.decode('utf-8', errors='replace').strip()
+                    if not line.startswith('data:'):
+                        continue
+                    
+                    data = line[5:].strip()
+                    if data == '[DONE]':
+                        break
+                    
+                    chunk = self._parse_stream_event(data)
+                    if chunk:
+                        received += len(chunk)
+                        chunks.append(chunk)
+                        yield chunk
+                
+                if not received:
+                    raise ValueError("API response missing content field")
+                
+                logger.debug("Received streamed API response: %d characters", received)
+                self._notify_listeners(started_at, None)
+                self._record_circuit_outcome(None)
+                self._store_response(cache_key, prompt if similar else None, "".join(chunks))
+        
+        except asyncio.TimeoutError as e:
+            logger.error("Streaming API request timed out")
+            self._notify_listeners(started_at, e)
+            self._record_circuit_outcome(e)
+            raise asyncio.TimeoutError("API request timed out")
+        
+        except aiohttp.ClientError as e:
+            logger.error(f"HTTP error during streaming API request: {e}")
+            self._notify_listeners(started_at, e)
+            self._record_circuit_outcome(e)
+            raise
+        
+        except ValueError as e:
+            self._notify_listeners(started_at, e)
+            self._record_circuit_outcome(e)
             raise
+        
+        finally:
+            # Free a half-open trial slot if the consumer stopped reading early
+            if self.circuit_breaker:
+                self.circuit_breaker.release()
     
     async def health_check(self) -> bool:
         """
         Check if the API is healthy and responding
         
+        A response still held in the cache counts as healthy, so repeated
+        checks within the cache TTL do not reach the upstream.
+        
         Returns:
             True if API is healthy, False otherwise
         """
@@ -2,21 +2,42 @@
 Main bot class for LiberGPT Telegram bot
 """
 
+import asyncio
 import logging
-from telegram import BotCommand
-from telegram.ext import Application, CommandHandler, MessageHandler, filters
+import multiprocessing
+import os
+import signal
+from typing import Optional
+from telegram import BotCommand, Update
+from telegram.ext import Application, CommandHandler, MessageHandler, TypeHandler, filters
+from telegram.request import BaseRequest
 
 from .config import Config
 from .api_client import LiberGPTAPIClient
+from .cache import ResponseCache, SimilarityCache
+from .resilience import CircuitBreaker, RetryPolicy
 from .handlers import MessageHandlers
 from .utils import RateLimiter, setup_logging
 from .memory import ConversationMemory
+from .storage import InMemoryBackend, SQLiteBackend
+from .health import HealthMonitor
+from .admission import AdmissionController
+from .debounce import MessageDebouncer
+from .update_processor import PerUserUpdateProcessor
+from .webhook import WebhookServer
+from .sharding import WorkerPool
+from .redis_state import RedisClient, RedisMemoryBackend, RedisRateLimiter
+from .outbound import OutboundScheduler
+from .metrics import BotMetrics, Counter, MetricsServer
+from .trace import TraceRecorder
 
 logger = logging.getLogger(__name__)
 
 class LiberGPTBot:
     """Main bot class that orchestrates all components"""
     
+    ALLOWED_UPDATES = ["message", "callback_query"]
+    
     def __init__(self, config: Config):
         """
         Initialize the bot with configuration
@@ -25,22 +46,164 @@ class LiberGPTBot:
             config: Configuration object
         """
         self.config = config
+        self.response_cache = None
+        if config.RESPONSE_CACHE_SIZE > 0:
+            self.response_cache = ResponseCache(
+                max_size=config.RESPONSE_CACHE_SIZE,
+                ttl=config.RESPONSE_CACHE_TTL
+            )
+        self.similarity_cache = None
+        if config.SIMILARITY_CACHE_SIZE > 0:
+            self.similarity_cache = SimilarityCache(
+                max_size=config.SIMILARITY_CACHE_SIZE,
+                ttl=config.SIMILARITY_CACHE_TTL,
+                threshold=config.SIMILARITY_CACHE_THRESHOLD
+            )
         self.api_client = LiberGPTAPIClient(
-            base_url=config.API_BASE_URL
+            base_url=config.API_BASE_URL,
+            timeout=config.API_TIMEOUT,
+            pool_limit=config.API_POOL_LIMIT,
+            pool_limit_per_host=config.API_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=config.API_KEEPALIVE_TIMEOUT,
+            dns_cache_ttl=config.API_DNS_CACHE_TTL,
+            cache=self.response_cache,
+            similarity_cache=self.similarity_cache,
+            retry_policy=RetryPolicy(
+                max_attempts=config.API_MAX_ATTEMPTS,
+                base_delay=config.API_RETRY_BASE_DELAY,
+                max_delay=config.API_RETRY_MAX_DELAY
+            ),
+            circuit_breaker=CircuitBreaker(
+                failure_threshold=config.CIRCUIT_FAILURE_THRESHOLD,
+                reset_timeout=config.CIRCUIT_RESET_TIMEOUT
+            ),
+            hedging=config.API_HEDGING,
+            hedge_min_samples=config.API_HEDGE_MIN_SAMPLES
+        )
+        self.redis = None
+        if "redis" in (config.RATE_LIMIT_BACKEND, config.MEMORY_BACKEND):
+            self.redis = RedisClient(config.REDIS_URL, command_timeout=config.REDIS_COMMAND_TIMEOUT)
+        if config.RATE_LIMIT_BACKEND == "redis":
+            self.rate_limiter = RedisRateLimiter(
+                self.redis,
+                max_messages=config.RATE_LIMIT_MESSAGES,
+                time_window=config.RATE_LIMIT_WINDOW,
+                prefix=config.REDIS_KEY_PREFIX
+            )
+        else:
+            self.rate_limiter = RateLimiter(
+                max_messages=config.RATE_LIMIT_MESSAGES,
+                time_window=config.RATE_LIMIT_WINDOW
+            )
+        self.memory = ConversationMemory(
+            max_conversations=config.MEMORY_CONVERSATIONS,
+            backend=self._create_memory_backend(config),
+            flush_interval=config.MEMORY_FLUSH_INTERVAL,
+            flush_batch_size=config.MEMORY_FLUSH_BATCH_SIZE,
+            max_bytes=config.MEMORY_MAX_BYTES,
+            idle_ttl=config.MEMORY_IDLE_TTL
+        )
+        self.debouncer = None
+        if config.DEBOUNCE_WINDOW > 0:
+            self.debouncer = MessageDebouncer(
+                window=config.DEBOUNCE_WINDOW,
+                max_wait=config.DEBOUNCE_MAX_WAIT
+            )
+        self.admission = None
+        if config.UPSTREAM_MAX_IN_FLIGHT > 0:
+            self.admission = AdmissionController(
+                max_in_flight=config.UPSTREAM_MAX_IN_FLIGHT,
+                max_queue=config.UPSTREAM_MAX_QUEUE,
+                queue_timeout=config.UPSTREAM_QUEUE_TIMEOUT
+            )
+        self.health_monitor = HealthMonitor(
+            api_client=self.api_client,
+            interval=config.HEALTH_CHECK_INTERVAL,
+            window_size=config.HEALTH_WINDOW_SIZE
         )
-        self.rate_limiter = RateLimiter(
-            max_messages=config.RATE_LIMIT_MESSAGES,
-            time_window=config.RATE_LIMIT_WINDOW
+        self.outbound = OutboundScheduler(
+            global_rate=config.OUTBOUND_GLOBAL_RATE,
+            chat_rate=config.OUTBOUND_CHAT_RATE,
+            group_rate=config.OUTBOUND_GROUP_RATE,
+            chat_burst=config.OUTBOUND_CHAT_BURST,
+            typing_max_wait=config.OUTBOUND_TYPING_MAX_WAIT
         )
-        self.memory = ConversationMemory(max_conversations=config.MEMORY_CONVERSATIONS)
+        self.metrics = BotMetrics()
+        self.api_client.add_listener(self.metrics.record_upstream)
+        self.outbound.add_listener(self.metrics.record_send)
+        self.metrics.track_memory(self.memory)
+        if self.response_cache is not None:
+            self.metrics.track_cache("response", self.response_cache)
+        if self.similarity_cache is not None:
+            self.metrics.track_cache("similarity", self.similarity_cache)
+        if self.debouncer:
+            self.metrics.registry.register(Counter(
+                "libergpt_debounced_messages_total",
+                "Messages merged into an earlier message from the same user",
+                function=lambda: self.debouncer.merged
+            ))
+        if self.admission:
+            self.metrics.track(
+                "libergpt_upstream_in_flight",
+                "Upstream requests currently admitted",
+                lambda: self.admission.get_stats()['in_flight']
+            )
+            self.metrics.track(
+                "libergpt_upstream_queue_length",
+                "Messages waiting for upstream capacity",
+                lambda: self.admission.get_stats()['queue_length']
+            )
+        self.metrics_server = None
+        if config.METRICS_PORT:
+            self.metrics_server = MetricsServer(
+                self.metrics.registry,
+                listen=config.METRICS_LISTEN,
+                port=config.METRICS_PORT
+            )
+        self.trace = None
+        if config.TRACE_FILE:
+            self.trace = TraceRecorder(config.TRACE_FILE, salt=config.TRACE_SALT)
         self.handlers = MessageHandlers(
             api_client=self.api_client,
             rate_limiter=self.rate_limiter,
             memory=self.memory,
-            max_message_length=config.MAX_MESSAGE_LENGTH
+            max_message_length=config.MAX_MESSAGE_LENGTH,
+            stream_responses=config.STREAM_RESPONSES,
+            stream_edit_interval=config.STREAM_EDIT_INTERVAL,
+            health_monitor=self.health_monitor,
+            context_max_chars=config.MEMORY_CONTEXT_MAX_CHARS or None,
+            admission=self.admission,
+            outbound=self.outbound,
+            render_markdown=config.RENDER_MARKDOWN,
+            metrics=self.metrics,
+            debouncer=self.debouncer
         )
         self.application = None
     
+    def _create_memory_backend(self, config: Config):
+        """
+        Create the conversation memory storage backend selected in the configuration
+        
+        Args:
+            config: Configuration object
+        
+        Returns:
+            Storage backend instance
+        """
+        if config.MEMORY_BACKEND == "sqlite":
+            return SQLiteBackend(
+                path=config.MEMORY_DB_PATH,
+                max_conversations=config.MEMORY_CONVERSATIONS
+            )
+        if config.MEMORY_BACKEND == "redis":
+            return RedisMemoryBackend(
+                self.redis,
+                max_conversations=config.MEMORY_CONVERSATIONS,
+                prefix=config.REDIS_KEY_PREFIX,
+                ttl=config.REDIS_MEMORY_TTL
+            )
+        return InMemoryBackend()
+    
     def setup_handlers(self):
         """Setup all command and message handlers"""
         # Command handlers
@@ -50,9 +213,8 @@ class LiberGPTBot:
         self.application.add_handler(CommandHandler("clear", self.handlers.clear_memory_command))
         
         # Message handler for regular text messages
-        self.application.add_handler(
-            MessageHandler(filters.TEXT & ~filters.COMMAND, self.handlers.handle_message)
-        )
+        message_filter = filters.TEXT & ~filters.COMMAND
+        self.application.add_handler(MessageHandler(message_filter, self.handlers.handle_message))
         
         # Error handler
         self.application.add_error_handler(self.handlers.handle_error)
@@ -67,8 +229,11 @@ class LiberGPTBot:
             application: The Telegram Application instance
         """
         logger.info("Bot initialization completed")
-        
-        # Set up bot commands for the menu
+        await self._set_bot_commands(application)
+        await self._start_services()
+    
+    async def _set_bot_commands(self, application: Application) -> None:
+        """Set up bot commands for the menu"""
         commands = [
             BotCommand("start", "Start the bot and get welcome message"),
             BotCommand("help", "Show help information"),
@@ -81,13 +246,24 @@ class LiberGPTBot:
             logger.info("Bot commands set successfully")
         except Exception as e:
             logger.error(f"Failed to set bot commands: {e}")
+    
+    async def _start_services(self) -> None:
+        """Start the components that answer messages"""
+        # Open the pooled API session shared by all handlers
+        await self.api_client.start()
+        
+        # Open conversation storage
+        await self.memory.start()
         
-        # Test API connection
-        async with self.api_client as client:
-            if await client.health_check():
-                logger.info("API health check passed - bot is ready")
-            else:
-                logger.warning("API health check failed - bot may not function properly")
+        # Monitor API health in the background; the first probe runs right away
+        # without delaying startup, and /status reads the cached result
+        self.health_monitor.start()
+        
+        if self.metrics_server:
+            await self.metrics_server.start()
+        
+        if self.trace:
+            self.trace.start()
     
     async def post_shutdown(self, application: Application) -> None:
         """
@@ -96,39 +272,237 @@ class LiberGPTBot:
         Args:
             application: The Telegram Application instance
         """
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        if self.trace:
+            await self.trace.close()
+        await self.outbound.close()
+        await self.health_monitor.stop()
+        await self.memory.close()
+        if self.redis:
+            await self.redis.close()
+        await self.api_client.close()
         logger.info("Bot shutdown completed")
     
     def run(self):
         """Start the bot and run until interrupted"""
         # Setup logging
-        setup_logging(self.config.DEBUG)
+        configure_logging(self.config)
         
         logger.info("Starting LiberGPT Telegram Bot...")
         logger.info(f"Debug mode: {self.config.DEBUG}")
         logger.info(f"API URL: {self.config.API_BASE_URL}")
         logger.info(f"Rate limit: {self.config.RATE_LIMIT_MESSAGES} msgs/{self.config.RATE_LIMIT_WINDOW}s")
+        logger.info(f"Max concurrent updates: {self.config.MAX_CONCURRENT_UPDATES}")
+        logger.info(f"Update delivery: {self.config.BOT_MODE}")
+        
+        if self.config.WORKER_PROCESSES > 1:
+            self.run_front()
+            return
         
         # Create application
-        self.application = (
+        self.application = self._build_application()
+        
+        # Setup handlers
+        self.setup_handlers()
+        
+        # Start the bot
+        logger.info("Bot is starting...")
+        self._receive_updates()
+    
+    def _build_application(self, updater: bool = True, request: Optional[BaseRequest] = None) -> Application:
+        """
+        Build the application that runs the message handlers
+        
+        Args:
+            updater: Whether the application fetches its own updates
+            request: Transport for Bot API calls, e.g. a local stand-in for benchmarks
+        
+        Returns:
+            Application with the per-user update processor and lifecycle hooks
+        """
+        builder = (
             Application.builder()
             .token(self.config.BOT_TOKEN)
+            .concurrent_updates(PerUserUpdateProcessor(
+                max_concurrent_updates=self.config.MAX_CONCURRENT_UPDATES,
+                max_pending_updates=self.config.MAX_PENDING_UPDATES,
+                debouncer=self.debouncer,
+                trace=self.trace
+            ))
             .post_init(self.post_init)
             .post_shutdown(self.post_shutdown)
+        )
+        if not updater:
+            builder = builder.updater(None)
+        if request is not None:
+            builder = builder.request(request)
+        return builder.build()
+    
+    def _receive_updates(self):
+        """Fetch updates with long polling or a webhook, as configured"""
+        if self.config.BOT_MODE == "webhook":
+            asyncio.run(self.run_webhook())
+        else:
+            self.application.run_polling(
+                drop_pending_updates=True,
+                allowed_updates=self.ALLOWED_UPDATES
+            )
+    
+    async def run_webhook(self):
+        """Receive updates through a webhook until SIGINT or SIGTERM"""
+        application = self.application
+        server = WebhookServer(
+            application,
+            listen=self.config.WEBHOOK_LISTEN,
+            port=self.config.WEBHOOK_PORT,
+            path=self.config.WEBHOOK_PATH,
+            secret_token=self.config.WEBHOOK_SECRET
+        )
+        
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                # Signal handlers are unavailable on Windows event loops
+                pass
+        
+        await application.initialize()
+        try:
+            if application.post_init:
+                await application.post_init(application)
+            await application.start()
+            await server.start()
+            
+            # Every replica registers the same URL, so pending updates are kept
+            # rather than dropped when one of them restarts
+            await application.bot.set_webhook(
+                url=self.config.WEBHOOK_URL.rstrip("/") + self.config.WEBHOOK_PATH,
+                secret_token=self.config.WEBHOOK_SECRET,
+                allowed_updates=self.ALLOWED_UPDATES,
+                max_connections=self.config.WEBHOOK_MAX_CONNECTIONS
+            )
+            logger.info("Webhook registered, waiting for updates")
+            
+            await stop_event.wait()
+            logger.info("Stopping webhook mode...")
+        finally:
+            await server.stop()
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+    
+    def run_front(self):
+        """Receive updates and shard them across worker processes by user ID"""
+        pool = WorkerPool(self.config.WORKER_PROCESSES, target=run_worker_process)
+        
+        async def front_post_init(application: Application) -> None:
+            await self._set_bot_commands(application)
+            pool.start()
+            logger.info(f"Dispatching updates to {pool.num_workers} worker processes")
+        
+        async def front_post_shutdown(application: Application) -> None:
+            await pool.stop()
+            logger.info(f"Front process stopped after dispatching {pool.dispatched} updates")
+        
+        # Dispatching is cheap and must keep each user's updates in order, so the
+        # front processes updates one at a time
+        self.application = (
+            Application.builder()
+            .token(self.config.BOT_TOKEN)
+            .post_init(front_post_init)
+            .post_shutdown(front_post_shutdown)
             .build()
         )
+        self.application.add_handler(TypeHandler(Update, pool.handle_update))
         
-        # Setup handlers
+        logger.info("Front process is starting...")
+        self._receive_updates()
+    
+    async def run_worker(self, queue: multiprocessing.Queue) -> None:
+        """
+        Process updates handed over by the front process until it sends None
+        
+        Args:
+            queue: Queue of update dictionaries for this worker
+        """
+        self.application = self._build_application(updater=False)
         self.setup_handlers()
+        application = self.application
+        loop = asyncio.get_running_loop()
         
-        # Start the bot
-        logger.info("Bot is starting...")
-        self.application.run_polling(
-            drop_pending_updates=True,
-            allowed_updates=["message", "callback_query"]
-        )
+        await application.initialize()
+        try:
+            await self._start_services()
+            await application.start()
+            
+            while True:
+                data = await loop.run_in_executor(None, queue.get)
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(data, application.bot))
+        finally:
+            # stop() lets the update processor finish what is already queued
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+            await self.post_shutdown(application)
     
     def stop(self):
         """Stop the bot gracefully"""
         if self.application:
             self.application.stop()
             logger.info("Bot stopped")
+
+def configure_logging(config: Config) -> None:
+    """
+    Set up logging as configured
+    
+    Args:
+        config: Configuration object
+    """
+    setup_logging(
+        config.DEBUG,
+        log_file=config.LOG_FILE,
+        json_format=config.LOG_FORMAT == "json",
+        async_mode=config.LOG_ASYNC,
+        max_bytes=config.LOG_MAX_BYTES,
+        backup_count=config.LOG_BACKUP_COUNT,
+        rotate_when=config.LOG_ROTATE_WHEN,
+        sample_rate=config.LOG_SAMPLE_RATE
+    )
+
+def run_worker_process(index: int, queue: multiprocessing.Queue) -> None:
+    """
+    Entry point of a worker process started by the front process
+    
+    Args:
+        index: Worker index
+        queue: Queue of update dictionaries for this worker
+    """
+    # Ctrl+C reaches the whole process group; workers stop when the front tells them to
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    
+    config = Config()
+    if config.METRICS_PORT:
+        # Each worker keeps its own metrics, so each needs its own port
+        config.METRICS_PORT += index + 1
+    if config.LOG_FILE:
+        # Rotating one file from several processes loses records, so each worker writes its own
+        root, ext = os.path.splitext(config.LOG_FILE)
+        config.LOG_FILE = f"{root}-worker-{index}{ext}"
+    if config.TRACE_FILE:
+        root, ext = os.path.splitext(config.TRACE_FILE)
+        config.TRACE_FILE = f"{root}-worker-{index}{ext}"
+    # The bot token's flood limit and the upstream capacity are shared by all workers
+    config.OUTBOUND_GLOBAL_RATE /= config.WORKER_PROCESSES
+    if config.UPSTREAM_MAX_IN_FLIGHT > 0:
+        config.UPSTREAM_MAX_IN_FLIGHT = max(1, config.UPSTREAM_MAX_IN_FLIGHT // config.WORKER_PROCESSES)
+    configure_logging(config)
+    logger.info(f"Worker {index} starting")
+    asyncio.run(LiberGPTBot(config).run_worker(queue))
+    logger.info(f"Worker {index} stopped")
@@ -0,0 +1,336 @@
+"""
+Response caching for LiberGPT Telegram bot
+Avoids repeating upstream calls for prompts that were answered recently, exactly or nearly
+"""
+
+import hashlib
+import logging
+import random
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_prompt(prompt: str) -> str:
+    """Normalize a prompt so trivially different spellings share a cache entry"""
+    return _WHITESPACE_RE.sub(' ', prompt).strip().casefold()
+
+class ResponseCache:
+    """Bounded LRU cache of AI responses with per-entry time to live"""
+    
+    def __init__(self, max_size: int = 1024, ttl: float = 600.0):
+        """
+        Initialize the response cache
+        
+        Args:
+            max_size: Maximum number of cached responses
+            ttl: Seconds a cached response stays valid
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        # Ordered from least to most recently used; values are (expires_at, response)
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    @staticmethod
+    def make_key(prompt: str, context: str = "") -> str:
+        """
+        Build the cache key for a prompt and its conversation context
+        
+        Args:
+            prompt: The user's prompt
+            context: Conversation context sent along with the prompt
+        
+        Returns:
+            Hex digest identifying the request
+        """
+        digest = hashlib.sha256()
+        digest.update(normalize_prompt(prompt).encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(context.encode('utf-8'))
+        return digest.hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached response
+        
+        Args:
+            key: Cache key from make_key()
+        
+        Returns:
+            Cached response, or None on a miss
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        expires_at, response = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return response
+    
+    def set(self, key: str, response: str) -> None:
+        """
+        Store a response, evicting the least recently used entries if full
+        
+        Args:
+            key: Cache key from make_key()
+            response: Response text to cache
+        """
+        if self.max_size <= 0:
+            return
+        
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self._entries.move_to_end(key)
+        
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def clear(self) -> None:
+        """Drop all cached responses"""
+        self._entries.clear()
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def get_stats(self) -> Dict:
+        """
+        Get cache statistics
+        
+        Returns:
+            Dictionary with cache statistics
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+# Largest Mersenne prime below 2**64, the modulus of the MinHash permutations
+_MERSENNE_PRIME = (1 << 61) - 1
+_PUNCTUATION_RE = re.compile(r'[^\w\s]')
+# Numbers, operators and other symbols, which must match exactly; sentence punctuation need not
+_EXACT_RE = re.compile(r'\d+|[^\w\s.,;:!?\'"]')
+
+class SimilarityCache:
+    """
+    Bounded LRU cache of AI responses matched by prompt similarity
+    
+    Prompts are compared by the Jaccard similarity of their character 4-gram
+    shingles after dropping case and punctuation, estimated with MinHash
+    signatures. Locality-sensitive hashing over bands of the signature finds
+    candidates without scanning every entry. Only use it for prompts whose
+    answer does not depend on conversation context.
+    """
+    
+    SHINGLE_SIZE = 4
+    
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: float = 600.0,
+        threshold: float = 0.8,
+        num_perm: int = 64,
+        bands: int = 16,
+        max_prompt_length: int = 256,
+        seed: int = 1
+    ):
+        """
+        Initialize the similarity cache
+        
+        Args:
+            max_size: Maximum number of cached responses
+            ttl: Seconds a cached response stays valid
+            threshold: Minimum estimated similarity for a cached response to be served
+            num_perm: MinHash signature length; more is more accurate and slower
+            bands: LSH bands, must divide num_perm; more bands find more candidates
+            max_prompt_length: Longer prompts are neither looked up nor cached, which
+                bounds the time spent hashing; near-duplicates are short questions
+            seed: Seed of the hash permutations
+        
+        Raises:
+            ValueError: If bands does not divide num_perm
+        """
+        if num_perm % bands:
+            raise ValueError("bands must divide num_perm")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_prompt_length = max_prompt_length
+        rng = random.Random(seed)
+        self._permutations = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+        # Ordered from least to most recently used, keyed by normalized prompt;
+        # values are (expires_at, signature, exact tokens, response)
+        self._entries: "OrderedDict[str, Tuple[float, Tuple[int, ...], str, str]]" = OrderedDict()
+        # Hash of (band index, band of a signature) -> normalized prompts with that band
+        self._buckets: Dict[int, Set[str]] = {}
+        # Signature of the last prompt looked up, reused when its response is stored
+        self._last_signature: Optional[Tuple[str, Tuple[int, ...]]] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.skipped = 0
+    
+    @staticmethod
+    def _normalize(prompt: str) -> str:
+        """Drop case, punctuation and repeated whitespace"""
+        return _WHITESPACE_RE.sub(' ', _PUNCTUATION_RE.sub(' ', prompt)).strip().casefold()
+    
+    def _signature(self, text: str) -> Tuple[int, ...]:
+        """Compute the MinHash signature of a normalized prompt"""
+        if self._last_signature is not None and self._last_signature[0] == text:
+            return self._last_signature[1]
+        
+        size = self.SHINGLE_SIZE
+        shingles = {hash(text[i:i + size]) & _MERSENNE_PRIME for i in range(max(len(text) - size + 1, 1))}
+        signature = tuple(
+            min([(a * shingle + b) % _MERSENNE_PRIME for shingle in shingles])
+            for a, b in self._permutations
+        )
+        self._last_signature = (text, signature)
+        return signature
+    
+    def _band_keys(self, signature: Tuple[int, ...]) -> List[int]:
+        """Get the LSH bucket of each band of a signature"""
+        rows = self.rows
+        return [hash((band,) + signature[band * rows:(band + 1) * rows]) for band in range(self.bands)]
+    
+    def _remove(self, text: str) -> None:
+        """Drop an entry and its bucket memberships"""
+        _, signature, _, _ = self._entries.pop(text)
+        for bucket_key in self._band_keys(signature):
+            bucket = self._buckets.get(bucket_key)
+            if bucket is not None:
+                bucket.discard(text)
+                if not bucket:
+                    del self._buckets[bucket_key]
+    
+    def get(self, prompt: str) -> Optional[str]:
+        """
+        Look up the response to the most similar cached prompt
+        
+        Prompts whose numbers, operators or other symbols differ never match,
+        since changing a single one usually changes the answer.
+        
+        Args:
+            prompt: The user's prompt
+        
+        Returns:
+            Cached response, or None if no cached prompt is similar enough
+        """
+        if len(prompt) > self.max_prompt_length:
+            self.skipped += 1
+            return None
+        
+        text = self._normalize(prompt)
+        signature = self._signature(text)
+        exact = " ".join(_EXACT_RE.findall(prompt))
+        
+        candidates = set()
+        for bucket_key in self._band_keys(signature):
+            candidates.update(self._buckets.get(bucket_key, ()))
+        
+        now = time.monotonic()
+        best_text = None
+        best_similarity = self.threshold
+        for candidate in candidates:
+            expires_at, candidate_signature, candidate_exact, _ = self._entries[candidate]
+            if expires_at <= now:
+                self._remove(candidate)
+                self.expirations += 1
+                continue
+            if candidate_exact != exact:
+                continue
+            
+            similarity = sum(x == y for x, y in zip(signature, candidate_signature)) / self.num_perm
+            if similarity >= best_similarity:
+                best_text, best_similarity = candidate, similarity
+        
+        if best_text is None:
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(best_text)
+        self.hits += 1
+        logger.debug("Similarity cache hit with estimated similarity %.2f", best_similarity)
+        return self._entries[best_text][3]
+    
+    def set(self, prompt: str, response: str) -> None:
+        """
+        Store a response, evicting the least recently used entries if full
+        
+        Args:
+            prompt: The user's prompt
+            response: Response text to cache
+        """
+        if self.max_size <= 0 or len(prompt) > self.max_prompt_length:
+            return
+        
+        text = self._normalize(prompt)
+        if text in self._entries:
+            self._remove(text)
+        
+        signature = self._signature(text)
+        exact = " ".join(_EXACT_RE.findall(prompt))
+        self._entries[text] = (time.monotonic() + self.ttl, signature, exact, response)
+        for bucket_key in self._band_keys(signature):
+            self._buckets.setdefault(bucket_key, set()).add(text)
+        
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+    
+    def clear(self) -> None:
+        """Drop all cached responses"""
+        self._entries.clear()
+        self._buckets.clear()
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def get_stats(self) -> Dict:
+        """
+        Get cache statistics
+        
+        Returns:
+            Dictionary with cache statistics
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'threshold': self.threshold,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'skipped': self.skipped,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
@@ -3,6 +3,7 @@ Configuration management for LiberGPT bot
 """
 
 import os
+import re
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -15,11 +16,117 @@ class Config:
         self.BOT_TOKEN = os.getenv("BOT_TOKEN")
         self.API_BASE_URL = os.getenv("API_BASE_URL", "https://api.zpi.my.id/v1/ai/copilot")
         self.DEBUG = os.getenv("DEBUG", "False").lower() == "true"
+        
+        # Logging (async mode writes from a background thread instead of the event loop)
+        self.LOG_FILE = os.getenv("LOG_FILE", "libergpt.log")
+        self.LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+        self.LOG_ASYNC = os.getenv("LOG_ASYNC", "True").lower() == "true"
+        self.LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", "10485760"))
+        self.LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+        self.LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")
+        self.LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+        
+        # Update delivery: "polling" or "webhook"
+        self.BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+        self.WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+        self.WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+        self.WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+        self.WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+        self.WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+        self.WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+        
+        # Worker processes; above 1, updates are sharded across workers by user ID
+        self.WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+        
         self.MAX_MESSAGE_LENGTH = int(os.getenv("MAX_MESSAGE_LENGTH", "4096"))
         self.RATE_LIMIT_MESSAGES = int(os.getenv("RATE_LIMIT_MESSAGES", "10"))
         self.RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", "60"))
         self.MEMORY_CONVERSATIONS = int(os.getenv("MEMORY_CONVERSATIONS", "20"))
         
+        # Rate limit state ("local" or "redis"; redis shares limits between replicas)
+        self.RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "local").lower()
+        
+        # Conversation memory storage ("memory", "sqlite" or "redis")
+        self.MEMORY_BACKEND = os.getenv("MEMORY_BACKEND", "memory").lower()
+        self.MEMORY_DB_PATH = os.getenv("MEMORY_DB_PATH", "libergpt.db")
+        self.MEMORY_FLUSH_INTERVAL = float(os.getenv("MEMORY_FLUSH_INTERVAL", "1.0"))
+        self.MEMORY_FLUSH_BATCH_SIZE = int(os.getenv("MEMORY_FLUSH_BATCH_SIZE", "500"))
+        
+        # Redis server for shared state
+        self.REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+        self.REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "libergpt:")
+        self.REDIS_MEMORY_TTL = int(os.getenv("REDIS_MEMORY_TTL", "2592000"))
+        self.REDIS_COMMAND_TIMEOUT = float(os.getenv("REDIS_COMMAND_TIMEOUT", "2"))
+        
+        # Conversation memory bounds (0 disables the limit)
+        self.MEMORY_MAX_BYTES = int(os.getenv("MEMORY_MAX_BYTES", str(64 * 1024 * 1024)))
+        self.MEMORY_IDLE_TTL = float(os.getenv("MEMORY_IDLE_TTL", "86400"))
+        self.MEMORY_CONTEXT_MAX_CHARS = int(os.getenv("MEMORY_CONTEXT_MAX_CHARS", "6000"))
+        
+        # Upstream API connection pool
+        self.API_TIMEOUT = int(os.getenv("API_TIMEOUT", "30"))
+        self.API_POOL_LIMIT = int(os.getenv("API_POOL_LIMIT", "100"))
+        self.API_POOL_LIMIT_PER_HOST = int(os.getenv("API_POOL_LIMIT_PER_HOST", "20"))
+        self.API_KEEPALIVE_TIMEOUT = float(os.getenv("API_KEEPALIVE_TIMEOUT", "30"))
+        self.API_DNS_CACHE_TTL = int(os.getenv("API_DNS_CACHE_TTL", "300"))
+        
+        # Upstream API resilience
+        self.API_MAX_ATTEMPTS = int(os.getenv("API_MAX_ATTEMPTS", "3"))
+        self.API_RETRY_BASE_DELAY = float(os.getenv("API_RETRY_BASE_DELAY", "0.5"))
+        self.API_RETRY_MAX_DELAY = float(os.getenv("API_RETRY_MAX_DELAY", "8"))
+        self.CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+        self.CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+        self.API_HEDGING = os.getenv("API_HEDGING", "False").lower() == "true"
+        self.API_HEDGE_MIN_SAMPLES = int(os.getenv("API_HEDGE_MIN_SAMPLES", "20"))
+        
+        # Upstream admission control (max in flight 0 disables it)
+        self.UPSTREAM_MAX_IN_FLIGHT = int(os.getenv("UPSTREAM_MAX_IN_FLIGHT", "16"))
+        self.UPSTREAM_MAX_QUEUE = int(os.getenv("UPSTREAM_MAX_QUEUE", "200"))
+        self.UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "60"))
+        
+        # Update processing
+        self.MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+        self.MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "1024"))
+        
+        # Message debouncing: quick successive messages from a user are answered together (window 0 disables it)
+        self.DEBOUNCE_WINDOW = float(os.getenv("DEBOUNCE_WINDOW", "0"))
+        self.DEBOUNCE_MAX_WAIT = float(os.getenv("DEBOUNCE_MAX_WAIT", "3"))
+        
+        # Outbound Telegram flood control (messages per second)
+        self.OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+        self.OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+        self.OUTBOUND_GROUP_RATE = float(os.getenv("OUTBOUND_GROUP_RATE", "0.33"))
+        self.OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+        self.OUTBOUND_TYPING_MAX_WAIT = float(os.getenv("OUTBOUND_TYPING_MAX_WAIT", "3"))
+        
+        # Streaming responses
+        self.STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "False").lower() == "true"
+        self.STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+        
+        # Metrics endpoint (port 0 disables it); worker processes use the following ports
+        self.METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+        self.METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+        
+        # Update trace for load test replay (empty disables recording)
+        self.TRACE_FILE = os.getenv("TRACE_FILE", "")
+        self.TRACE_SALT = os.getenv("TRACE_SALT", "")
+        
+        # Response formatting (AI Markdown is sent as MarkdownV2, plain text if Telegram rejects it)
+        self.RENDER_MARKDOWN = os.getenv("RENDER_MARKDOWN", "True").lower() == "true"
+        
+        # Response cache (size 0 disables it)
+        self.RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+        self.RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600"))
+        
+        # Near-duplicate cache for prompts without conversation context (size 0 disables it)
+        self.SIMILARITY_CACHE_SIZE = int(os.getenv("SIMILARITY_CACHE_SIZE", "0"))
+        self.SIMILARITY_CACHE_TTL = float(os.getenv("SIMILARITY_CACHE_TTL", "600"))
+        self.SIMILARITY_CACHE_THRESHOLD = float(os.getenv("SIMILARITY_CACHE_THRESHOLD", "0.8"))
+        
+        # Background API health monitoring
+        self.HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "300"))
+        self.HEALTH_WINDOW_SIZE = int(os.getenv("HEALTH_WINDOW_SIZE", "20"))
+        
         self._validate_config()
     
     def _validate_config(self):
@@ -29,6 +136,38 @@ class Config:
         
         if not self.API_BASE_URL:
             raise ValueError("API_BASE_URL is required. Please set it in your .env file")
+        
+        if self.MEMORY_BACKEND not in ("memory", "sqlite", "redis"):
+            raise ValueError("MEMORY_BACKEND must be 'memory', 'sqlite' or 'redis'")
+        
+        if self.RATE_LIMIT_BACKEND not in ("local", "redis"):
+            raise ValueError("RATE_LIMIT_BACKEND must be 'local' or 'redis'")
+        
+        if self.LOG_FORMAT not in ("text", "json"):
+            raise ValueError("LOG_FORMAT must be 'text' or 'json'")
+        
+        if not 0 <= self.LOG_SAMPLE_RATE <= 1:
+            raise ValueError("LOG_SAMPLE_RATE must be between 0 and 1")
+        
+        if self.DEBOUNCE_WINDOW < 0 or self.DEBOUNCE_MAX_WAIT < self.DEBOUNCE_WINDOW:
+            raise ValueError("DEBOUNCE_WINDOW must not be negative or exceed DEBOUNCE_MAX_WAIT")
+        
+        if not 0 < self.SIMILARITY_CACHE_THRESHOLD <= 1:
+            raise ValueError("SIMILARITY_CACHE_THRESHOLD must be greater than 0 and at most 1")
+        
+        if self.BOT_MODE not in ("polling", "webhook"):
+            raise ValueError("BOT_MODE must be 'polling' or 'webhook'")
+        
+        if self.BOT_MODE == "webhook":
+            if not self.WEBHOOK_URL:
+                raise ValueError("WEBHOOK_URL is required when BOT_MODE is 'webhook'")
+            if not self.WEBHOOK_PATH.startswith("/"):
+                raise ValueError("WEBHOOK_PATH must start with '/'")
+            if not self.WEBHOOK_SECRET:
+                # Anyone who can reach the port could otherwise post forged updates as any user
+                raise ValueError("WEBHOOK_SECRET is required when BOT_MODE is 'webhook'")
+            if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", self.WEBHOOK_SECRET):
+                raise ValueError("WEBHOOK_SECRET may only contain A-Z, a-z, 0-9, _ and - (up to 256 characters)")
     
     @property
     def full_api_url(self):
@@ -0,0 +1,205 @@
+"""
+Message debouncing for LiberGPT Telegram bot
+Merges a question sent as several quick messages into one message before it is handled
+"""
+
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from telegram import Message, Update
+
+logger = logging.getLogger(__name__)
+
+class _Batch:
+    """Text messages from one user in one chat waiting to be merged into the first of them"""
+    
+    __slots__ = ('message', 'chat_id', 'texts', 'length', 'first_at', 'last_at', 'open', 'flushed')
+    
+    def __init__(self, message: Message, now: float):
+        self.message = message
+        self.chat_id = message.chat_id
+        self.texts: List[str] = [message.text]
+        self.length = len(message.text)
+        self.first_at = now
+        self.last_at = now
+        # Closed batches take no more fragments; their first message is handled right away
+        self.open = True
+        self.flushed = asyncio.Event()
+
+class MessageDebouncer:
+    """
+    Per-user debounce window for chat messages
+    
+    The first text message of a burst is held until the user has been quiet for
+    the window, or until the maximum wait has passed since it arrived. Text
+    messages arriving meanwhile are appended to it and dropped, so the burst is
+    handled once: one rate limit slot, one upstream request and one reply.
+    Any other update from the user, such as a command or a message in another
+    chat, ends the burst so that updates keep their order and a reply never
+    carries text into a chat it was not written in.
+    
+    Messages are frozen once parsed, so the merged text is not written into the
+    first message; handlers read it with text_of().
+    """
+    
+    SEPARATOR = "\n"
+    
+    def __init__(self, window: float = 1.0, max_wait: float = 3.0, max_chars: int = 4096):
+        """
+        Initialize the debouncer
+        
+        Args:
+            window: Seconds of quiet after a message before the burst is handled
+            max_wait: Maximum seconds the first message of a burst is held
+            max_chars: Maximum length of a merged message; a fragment that does
+                not fit starts a new burst
+        """
+        self.window = window
+        self.max_wait = max_wait
+        self.max_chars = max_chars
+        # Open burst of each user, keyed like the update processor orders updates
+        self._pending: Dict[int, _Batch] = {}
+        # Bursts by the update ID of their first message, until it is handled
+        self._leaders: Dict[int, _Batch] = {}
+        # Merged text by the update ID of the first message, while it is processed
+        self._merged_texts: Dict[int, str] = {}
+        self.merged = 0
+        self.bursts = 0
+    
+    @staticmethod
+    def _mergeable(update: object) -> Optional[Message]:
+        """Get the message of a plain text message update, None for anything else"""
+        if not isinstance(update, Update):
+            return None
+        message = update.message
+        if message is None or not message.text or message.text.startswith('/'):
+            return None
+        return message
+    
+    def _close(self, key: int) -> None:
+        """End a user's open burst, waking its first message"""
+        batch = self._pending.pop(key, None)
+        if batch is not None:
+            batch.open = False
+            batch.flushed.set()
+    
+    def add(self, key: int, update: object) -> bool:
+        """
+        Take an update arriving from a user
+        
+        Args:
+            key: Ordering key of the user
+            update: The update
+        
+        Returns:
+            True if the update was merged into an earlier message and must not
+            be processed, False if it should be processed after wait()
+        """
+        message = self._mergeable(update)
+        if message is None:
+            self._close(key)
+            return False
+        
+        now = asyncio.get_running_loop().time()
+        batch = self._pending.get(key)
+        if batch is not None:
+            merged_length = batch.length + len(self.SEPARATOR) + len(message.text)
+            if (
+                message.chat_id == batch.chat_id
+                and merged_length <= self.max_chars
+                and now - batch.first_at < self.max_wait
+            ):
+                batch.texts.append(message.text)
+                batch.length = merged_length
+                batch.last_at = now
+                self.merged += 1
+                return True
+            self._close(key)
+        
+        batch = self._pending[key] = _Batch(message, now)
+        self._leaders[update.update_id] = batch
+        self.bursts += 1
+        return False
+    
+    async def wait(self, key: int, update: object) -> None:
+        """
+        Hold the first message of a burst until the burst ends, then merge it
+        
+        Returns at once for updates that do not start a burst. Call it while
+        holding the user's ordering lock, so that updates queued behind it
+        cannot overtake the burst.
+        
+        Args:
+            key: Ordering key of the user
+            update: The update about to be processed
+        """
+        batch = self._leaders.pop(getattr(update, 'update_id', None), None)
+        if batch is None:
+            return
+        
+        loop = asyncio.get_running_loop()
+        while batch.open:
+            deadline = min(batch.last_at + self.window, batch.first_at + self.max_wait)
+            delay = deadline - loop.time()
+            if delay <= 0:
+                break
+            try:
+                await asyncio.wait_for(batch.flushed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        
+        if self._pending.get(key) is batch:
+            self._close(key)
+        
+        if len(batch.texts) > 1:
+            self._merged_texts[update.update_id] = self.SEPARATOR.join(batch.texts)
+            logger.debug("Merged %d messages from %s into one", len(batch.texts), key)
+    
+    def text_of(self, update: Update) -> str:
+        """
+        Get the text to answer for a message update
+        
+        Args:
+            update: The update being handled
+        
+        Returns:
+            The merged text of the burst the message started, or its own text
+        """
+        return self._merged_texts.get(update.update_id, update.message.text)
+    
+    def discard(self, key: int, update: object) -> None:
+        """
+        Forget an update once it has been processed or will not be, ending the burst it started
+        
+        Args:
+            key: Ordering key of the user
+            update: The update
+        """
+        update_id = getattr(update, 'update_id', None)
+        self._merged_texts.pop(update_id, None)
+        batch = self._leaders.pop(update_id, None)
+        if batch is not None and self._pending.get(key) is batch:
+            self._close(key)
+    
+    def clear(self) -> None:
+        """Release every held message"""
+        for key in list(self._pending):
+            self._close(key)
+        self._leaders.clear()
+        self._merged_texts.clear()
+    
+    def get_stats(self) -> Dict:
+        """
+        Get debouncing statistics
+        
+        Returns:
+            Dictionary with burst and merge counters
+        """
+        return {
+            'window': self.window,
+            'max_wait': self.max_wait,
+            'bursts': self.bursts,
+            'merged': self.merged,
+            'pending': len(self._pending)
+        }
@@ -2,22 +2,49 @@
 Message handlers for LiberGPT Telegram bot
 """
 
+import asyncio
+import contextlib
 import logging
-from typing import Optional
-from telegram import Update
+import time
+from typing import AsyncContextManager, List, Optional, Tuple
+from telegram import Message, Update
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes
 from telegram.constants import ChatAction, ParseMode
 
 from .api_client import LiberGPTAPIClient
-from .utils import truncate_message, format_error_message, escape_markdown
+from .utils import truncate_message, split_message, format_error_message, escape_markdown
 from .memory import ConversationMemory
+from .health import HealthMonitor
+from .admission import AdmissionController, AdmissionRejected
+from .outbound import OutboundScheduler
+from .markdown import render_chunks
+from .metrics import BotMetrics
+from .debounce import MessageDebouncer
 
 logger = logging.getLogger(__name__)
 
 class MessageHandlers:
     """Collection of message handlers for the bot"""
     
-    def __init__(self, api_client: LiberGPTAPIClient, rate_limiter, memory: ConversationMemory, max_message_length: int = 4096):
+    STREAM_PLACEHOLDER = "⏳ Thinking..."
+    
+    def __init__(
+        self,
+        api_client: LiberGPTAPIClient,
+        rate_limiter,
+        memory: ConversationMemory,
+        max_message_length: int = 4096,
+        stream_responses: bool = False,
+        stream_edit_interval: float = 1.5,
+        health_monitor: Optional[HealthMonitor] = None,
+        context_max_chars: Optional[int] = None,
+        admission: Optional[AdmissionController] = None,
+        outbound: Optional[OutboundScheduler] = None,
+        render_markdown: bool = True,
+        metrics: Optional[BotMetrics] = None,
+        debouncer: Optional[MessageDebouncer] = None
+    ):
         """
         Initialize message handlers
         
@@ -26,11 +53,30 @@ class MessageHandlers:
             rate_limiter: Rate limiter instance
             memory: Conversation memory instance
             max_message_length: Maximum message length
+            stream_responses: Whether to stream responses into a progressively edited message
+            stream_edit_interval: Minimum seconds between edits of a streamed message
+            health_monitor: Background API health monitor read by /status
+            context_max_chars: Maximum length of the conversation context sent upstream
+            admission: Admission controller bounding concurrent upstream requests and sharing
+                them fairly between users; only chat messages go through it, commands bypass it
+            outbound: Scheduler pacing every Bot API call under Telegram's flood limits
+            render_markdown: Whether to send AI responses formatted as MarkdownV2
+            metrics: Metrics recording message handling times and rate limit rejections
+            debouncer: Debouncer holding the merged text of messages sent in quick succession
         """
         self.api_client = api_client
         self.rate_limiter = rate_limiter
         self.memory = memory
         self.max_message_length = max_message_length
+        self.stream_responses = stream_responses
+        self.stream_edit_interval = stream_edit_interval
+        self.health_monitor = health_monitor
+        self.context_max_chars = context_max_chars
+        self.admission = admission
+        self.outbound = outbound or OutboundScheduler()
+        self.render_markdown = render_markdown
+        self.metrics = metrics or BotMetrics()
+        self.debouncer = debouncer
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -64,7 +110,8 @@ I'm your free AI assistant powered by advanced language models\\. I can help you
 Ready to chat? Send me a message\\! 🚀
         """
         
-        await update.message.reply_text(
+        await self._reply(
+            update,
             welcome_message,
             parse_mode=ParseMode.MARKDOWN_V2
         )
@@ -110,7 +157,8 @@ To ensure fair usage, there are rate limits in place\\. If you hit the limit, yo
 Need more help? Just ask me anything\\! 💬
         """
         
-        await update.message.reply_text(
+        await self._reply(
+            update,
             help_message,
             parse_mode=ParseMode.MARKDOWN_V2
         )
@@ -125,32 +173,39 @@ Need more help? Just ask me anything\\! 💬
         """
         logger.info(f"Status check requested by user {update.effective_user.id}")
         
-        # Show typing indicator
-        await context.bot.send_chat_action(
-            chat_id=update.effective_chat.id,
-            action=ChatAction.TYPING
-        )
-        
-        # Check API health
-        async with self.api_client as client:
-            api_healthy = await client.health_check()
+        # Read the cached API health instead of probing the upstream
+        api_latency = ""
+        if self.health_monitor:
+            health = self.health_monitor.get_status()
+            api_healthy = health['healthy']
+            if health['p50_latency'] is not None:
+                latency = escape_markdown(f"{health['p50_latency']:.1f}s")
+                error_rate = escape_markdown(f"{health['error_rate']:.0%}")
+                api_latency = f"\n**API Latency:** {latency} median, {error_rate} errors"
+        else:
+            self._show_typing(update, context)
+            api_healthy = await self.api_client.health_check()
         
         # Get memory stats
+        await self.memory.ensure_loaded(update.effective_user.id)
         memory_stats = self.memory.get_memory_stats(update.effective_user.id)
         
-        status_emoji = "🟢" if api_healthy else "🔴"
-        api_status = "Online" if api_healthy else "Offline"
+        if api_healthy is None:
+            status_emoji, api_status = "🟡", "Checking"
+        else:
+            status_emoji = "🟢" if api_healthy else "🔴"
+            api_status = "Online" if api_healthy else "Offline"
         
         status_message = f"""
 🤖 **LiberGPT Status**
 
 **Bot:** 🟢 Online
-**API:** {status_emoji} {api_status}
+**API:** {status_emoji} {api_status}{api_latency}
 **Version:** 1\\.0\\.0
 
 **Rate Limiting:**
 • Max messages: {self.rate_limiter.max_messages} per {self.rate_limiter.time_window}s
-• Your status: {"✅ Available" if self.rate_limiter.is_allowed(update.effective_user.id) else "⏳ Rate limited"}
+• Your status: {"✅ Available" if await self.rate_limiter.available(update.effective_user.id) else "⏳ Rate limited"}
 
 **Memory:**
 • Conversations stored: {memory_stats['conversation_count']}/{self.memory.max_conversations}
@@ -159,7 +214,8 @@ Need more help? Just ask me anything\\! 💬
 **Last Updated:** Just now
         """
         
-        await update.message.reply_text(
+        await self._reply(
+            update,
             status_message,
             parse_mode=ParseMode.MARKDOWN_V2
         )
@@ -172,13 +228,39 @@ Need more help? Just ask me anything\\! 💬
             update: Telegram update object
             context: Bot context
         """
+        started_at = time.monotonic()
+        outcome = "error"
+        try:
+            outcome = await self._answer_message(update, context)
+        finally:
+            self.metrics.update_seconds.observe(time.monotonic() - started_at, outcome=outcome)
+    
+    async def _answer_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+        """
+        Answer a text message with the AI response
+        
+        Args:
+            update: Telegram update object
+            context: Bot context
+        
+        Returns:
+            Outcome for metrics: "answered", "rate_limited", "shed" or "error"
+        """
         user = update.effective_user
-        message_text = update.message.text
+        message_text = self.debouncer.text_of(update) if self.debouncer else update.message.text
+        
+        # Per-message logs are formatted lazily and sampled together by update
+        log_extra = {'sample_key': update.update_id, 'user_id': user.id}
+        logger.info("Message from user %s (%s): %.50s...", user.id, user.username, message_text, extra=log_extra)
         
-        logger.info(f"Message from user {user.id} ({user.username}): {message_text[:50]}...")
+        # Start loading the user's memory while the rate limit is checked; with
+        # shared Redis state both requests go out in the same round trip
+        loading = asyncio.ensure_future(self.memory.ensure_loaded(user.id))
         
         # Check rate limiting
-        if not self.rate_limiter.is_allowed(user.id):
+        if not await self.rate_limiter.acquire(user.id):
+            self.metrics.rate_limit_rejections.inc()
+            await asyncio.gather(loading, return_exceptions=True)
             remaining_time = self.rate_limiter.get_remaining_time(user.id)
             rate_limit_message = f"""
 ⏳ **Rate Limit Exceeded**
@@ -188,50 +270,226 @@ You've sent too many messages recently\\. Please wait **{remaining_time} seconds
 This helps ensure fair usage for all users\\. Thank you for understanding\\! 🙏
             """
             
-            await update.message.reply_text(
+            await self._reply(
+                update,
                 rate_limit_message,
                 parse_mode=ParseMode.MARKDOWN_V2
             )
-            return
+            return "rate_limited"
         
         # Show typing indicator
-        await context.bot.send_chat_action(
-            chat_id=update.effective_chat.id,
-            action=ChatAction.TYPING
-        )
+        self._show_typing(update, context)
+        
+        # Placeholder message that a streamed response is written into
+        reply_message = None
         
         try:
             # Get conversation context for better responses
-            context_string = self.memory.get_context_string(user.id, include_last_n=3)
-            
-            # Prepare message with context if available
-            if context_string:
-                full_message = f"{context_string}\n{message_text}"
-            else:
-                full_message = message_text
+            await loading
+            context_string = self.memory.get_context_string(
+                user.id,
+                include_last_n=3,
+                max_chars=self.context_max_chars
+            )
             
-            # Get AI response
-            async with self.api_client as client:
-                ai_response = await client.get_response(full_message)
+            # Get AI response, waiting for upstream capacity if the bot is busy
+            async with self._upstream_slot(update):
+                if self.stream_responses:
+                    reply_message = await self._reply(update, self.STREAM_PLACEHOLDER)
+                    ai_response = await self._stream_into_message(reply_message, message_text, context_string)
+                else:
+                    ai_response = await self.api_client.get_response(message_text, context=context_string)
             
             # Store conversation in memory
             self.memory.add_conversation(user.id, message_text, ai_response)
             
-            # Truncate if necessary
-            if len(ai_response) > self.max_message_length:
-                ai_response = truncate_message(ai_response, self.max_message_length)
-                ai_response += "\n\n*[Message truncated due to length]*"
-            
-            # Send response
-            await update.message.reply_text(ai_response)
-            
-            logger.info(f"Responded to user {user.id} with {len(ai_response)} characters")
+            # Send response, split over several messages if it is too long for one
+            if self.render_markdown:
+                chunks = render_chunks(ai_response, self.max_message_length)
+            else:
+                chunks = [(chunk, None) for chunk in split_message(ai_response, self.max_message_length)]
+            await self._send_chunks(update, chunks, reply_message)
             
+            logger.info(
+                "Responded to user %s with %d characters in %d messages",
+                user.id, len(ai_response), len(chunks), extra=log_extra
+            )
+            return "answered"
+        
+        except AdmissionRejected as e:
+            logger.warning(f"Shed message from user {user.id}: {e}")
+            await self._reply(update, format_error_message(e))
+            return "shed"
+        
         except Exception as e:
             logger.error(f"Error processing message from user {user.id}: {e}")
             
             error_message = format_error_message(e)
-            await update.message.reply_text(error_message)
+            if reply_message:
+                await self._edit(reply_message, error_message)
+            else:
+                await self._reply(update, error_message)
+            return "error"
+    
+    def _upstream_slot(self, update: Update) -> AsyncContextManager:
+        """
+        Get the context manager that holds an upstream slot for a message
+        
+        Args:
+            update: Telegram update being answered
+        
+        Returns:
+            Admission slot, or a no-op context manager when admission control is off
+        """
+        if self.admission is None:
+            return contextlib.nullcontext()
+        
+        async def on_queued(position: int) -> None:
+            await self._reply(
+                update,
+                f"⏳ I'm busy right now, you're number {position} in line. Your answer is on its way."
+            )
+        
+        return self.admission.slot(key=update.effective_user.id, on_queued=on_queued)
+    
+    async def _send_chunks(
+        self,
+        update: Update,
+        chunks: List[Tuple[str, Optional[str]]],
+        reply_message: Optional[Message] = None
+    ) -> None:
+        """
+        Send the parts of a reply in order
+        
+        All parts are queued at once and delivered in order by the outbound scheduler.
+        
+        Args:
+            update: Telegram update being answered
+            chunks: (plain text, MarkdownV2 text or None) pairs, each short enough for one message
+            reply_message: Placeholder message that receives the first part instead of a new message
+        """
+        chat_id = update.effective_chat.id
+        pending = []
+        for index, (plain, formatted) in enumerate(chunks):
+            if index == 0 and reply_message:
+                deliver = lambda text, parse_mode=None: self._edit_message(reply_message, text, parse_mode)
+            else:
+                deliver = lambda text, parse_mode=None: update.message.reply_text(text, parse_mode=parse_mode)
+            send = lambda deliver=deliver, plain=plain, formatted=formatted: self._send_formatted(deliver, plain, formatted)
+            pending.append(self.outbound.submit(chat_id, send))
+        
+        results = await asyncio.gather(*pending, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+    
+    async def _send_formatted(self, deliver, plain: str, formatted: Optional[str]):
+        """
+        Send a reply part formatted, falling back to plain text if Telegram rejects the markup
+        
+        Args:
+            deliver: Function sending or editing a message as deliver(text, parse_mode)
+            plain: Plain text of the part
+            formatted: MarkdownV2 rendering of the part, None to send it plain
+        
+        Returns:
+            The result of the successful call
+        """
+        if formatted is not None:
+            try:
+                return await deliver(formatted, ParseMode.MARKDOWN_V2)
+            except BadRequest as e:
+                if "can't parse entities" not in str(e).lower():
+                    raise
+                logger.warning(f"Telegram rejected rendered markdown, sending plain text: {e}")
+        return await deliver(plain)
+    
+    async def _stream_into_message(self, message: Message, prompt: str, context_string: str = "") -> str:
+        """
+        Stream the AI response for a prompt into an already sent message
+        
+        Edits are throttled to one per stream_edit_interval to stay under
+        Telegram's edit rate limits; the caller performs the final edit.
+        
+        Args:
+            message: Placeholder message to edit as chunks arrive
+            prompt: The text prompt to send to the API
+            context_string: Conversation context to send along with the prompt
+        
+        Returns:
+            Complete AI response text
+        """
+        loop = asyncio.get_running_loop()
+        chunks = []
+        shown_text = message.text
+        last_edit = loop.time()
+        
+        async for chunk in self.api_client.stream_response(prompt, context=context_string):
+            chunks.append(chunk)
+            
+            now = loop.time()
+            if now - last_edit < self.stream_edit_interval:
+                continue
+            
+            preview = truncate_message("".join(chunks), self.max_message_length)
+            if preview != shown_text:
+                await self._edit(message, preview, priority=OutboundScheduler.PRIORITY_UPDATE)
+                shown_text = preview
+            last_edit = now
+        
+        return "".join(chunks)
+    
+    async def _reply(self, update: Update, text: str, **kwargs) -> Message:
+        """
+        Reply to the message of an update through the outbound scheduler
+        
+        Args:
+            update: Telegram update being answered
+            text: Reply text
+            **kwargs: Further arguments for reply_text
+        
+        Returns:
+            The sent message
+        """
+        return await self.outbound.send(
+            update.effective_chat.id,
+            lambda: update.message.reply_text(text, **kwargs)
+        )
+    
+    def _show_typing(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Queue a typing indicator for the chat of an update without waiting for it"""
+        chat_id = update.effective_chat.id
+        self.outbound.send_typing(
+            chat_id,
+            lambda: context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        )
+    
+    async def _edit(self, message: Message, text: str, priority: int = OutboundScheduler.PRIORITY_REPLY) -> None:
+        """
+        Edit a message sent by the bot through the outbound scheduler
+        
+        Args:
+            message: Message to edit
+            text: New message text
+            priority: Scheduling priority of the edit
+        """
+        await self.outbound.send(message.chat_id, lambda: self._edit_message(message, text), priority)
+    
+    async def _edit_message(self, message: Message, text: str, parse_mode: Optional[str] = None) -> None:
+        """
+        Replace the text of a message sent by the bot
+        
+        Args:
+            message: Message to edit
+            text: New message text
+            parse_mode: How Telegram should parse the text, None for plain text
+        """
+        try:
+            await message.edit_text(text, parse_mode=parse_mode)
+        except BadRequest as e:
+            # Editing to identical text is harmless, anything else is a real failure
+            if "message is not modified" not in str(e).lower():
+                raise
     
     async def handle_error(self, update: Optional[Update], context: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -247,9 +505,10 @@ This helps ensure fair usage for all users\\. Thank you for understanding\\! 
         if update and update.effective_chat:
             try:
                 error_message = "❌ An unexpected error occurred. Please try again later."
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=error_message
+                chat_id = update.effective_chat.id
+                await self.outbound.send(
+                    chat_id,
+                    lambda: context.bot.send_message(chat_id=chat_id, text=error_message)
                 )
             except Exception as e:
                 logger.error(f"Failed to send error message to user: {e}")
@@ -266,6 +525,7 @@ This helps ensure fair usage for all users\\. Thank you for understanding\\! 
         logger.info(f"Memory clear requested by user {user.id} ({user.username})")
         
         # Clear user's conversation memory
+        await self.memory.ensure_loaded(user.id)
         cleared_count = self.memory.clear_user_memory(user.id)
         
         if cleared_count > 0:
@@ -287,7 +547,8 @@ You don't have any conversation history to clear\\.
 Start chatting with me and I'll remember our conversations\\! 💬
             """
         
-        await update.message.reply_text(
+        await self._reply(
+            update,
             clear_message,
             parse_mode=ParseMode.MARKDOWN_V2
         )
@@ -0,0 +1,149 @@
+"""
+Health monitoring for LiberGPT Telegram bot
+Tracks upstream API latency and error rate without blocking user-facing commands
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from .api_client import LiberGPTAPIClient
+from .resilience import percentile
+
+logger = logging.getLogger(__name__)
+
+class HealthMonitor:
+    """Background monitor keeping a rolling window of upstream API health"""
+    
+    PROBE_PROMPT = "Hello"
+    
+    def __init__(
+        self,
+        api_client: LiberGPTAPIClient,
+        interval: float = 300.0,
+        window_size: int = 20,
+        max_error_rate: float = 0.5
+    ):
+        """
+        Initialize the health monitor
+        
+        Args:
+            api_client: API client to observe and probe
+            interval: Seconds without any upstream request after which a probe is sent
+            window_size: Number of recent requests kept for latency and error rate
+            max_error_rate: Highest error rate in the window still considered healthy
+        """
+        self.api_client = api_client
+        self.interval = interval
+        self.max_error_rate = max_error_rate
+        # Recent (latency in seconds, success) samples, oldest first
+        self._samples: deque = deque(maxlen=window_size)
+        self._last_sample_at: Optional[float] = None
+        self._last_success_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        self.probes = 0
+        
+        # Real traffic counts as a health sample, so probes are only needed when idle
+        api_client.add_listener(self.record)
+    
+    def record(self, latency: float, error: Optional[BaseException]) -> None:
+        """
+        Record the outcome of one upstream request
+        
+        Args:
+            latency: Request duration in seconds
+            error: Exception raised by the request, None on success
+        """
+        now = time.monotonic()
+        self._samples.append((latency, error is None))
+        self._last_sample_at = now
+        if error is None:
+            self._last_success_at = now
+    
+    async def probe(self) -> bool:
+        """
+        Send one uncached probe request to the upstream API
+        
+        Returns:
+            True if the probe succeeded, False otherwise
+        """
+        self.probes += 1
+        try:
+            await self.api_client.get_response(self.PROBE_PROMPT, use_cache=False)
+            return True
+        except Exception as e:
+            logger.warning(f"API health probe failed: {e}")
+            return False
+    
+    async def _run(self) -> None:
+        """Probe the upstream whenever it has been idle for a full interval"""
+        while True:
+            if self._last_sample_at is None:
+                delay = 0.0
+            else:
+                delay = self._last_sample_at + self.interval - time.monotonic()
+            
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            
+            last_sample_at = self._last_sample_at
+            await self.probe()
+            if self._last_sample_at == last_sample_at:
+                # The probe never reached the upstream (client not started or circuit open)
+                await asyncio.sleep(self.interval)
+    
+    def start(self) -> None:
+        """Start probing in the background"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Health monitor started (interval: {self.interval}s)")
+    
+    async def stop(self) -> None:
+        """Stop background probing"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    def get_status(self) -> Dict:
+        """
+        Get the cached health status
+        
+        Returns:
+            Dictionary with health status; 'healthy' is None until a first sample exists
+        """
+        if not self._samples:
+            return {
+                'healthy': None,
+                'samples': 0,
+                'error_rate': None,
+                'p50_latency': None,
+                'p95_latency': None,
+                'last_success_age': None
+            }
+        
+        failures = sum(1 for _, success in self._samples if not success)
+        error_rate = failures / len(self._samples)
+        latencies = sorted(latency for latency, success in self._samples if success)
+        last_success_age = None
+        if self._last_success_at is not None:
+            last_success_age = time.monotonic() - self._last_success_at
+        
+        # An open circuit means requests are currently being rejected outright
+        breaker = self.api_client.circuit_breaker
+        circuit_open = breaker is not None and breaker.state == breaker.OPEN
+        
+        return {
+            'healthy': error_rate <= self.max_error_rate and not circuit_open,
+            'samples': len(self._samples),
+            'error_rate': error_rate,
+            'p50_latency': percentile(latencies, 0.5) if latencies else None,
+            'p95_latency': percentile(latencies, 0.95) if latencies else None,
+            'last_success_age': last_success_age
+        }
@@ -0,0 +1,109 @@
+"""
+Markdown rendering for LiberGPT Telegram bot
+Converts the Markdown returned by the AI into Telegram MarkdownV2 in a single pass
+"""
+
+import re
+from typing import List, Match, Tuple
+
+from .utils import escape_markdown, split_message
+
+
+_TOKEN_RE = re.compile(
+    r"(?P<fence>^[ \t]*```(?P<lang>[\w+#-]*)[ \t]*\n(?P<code>.*?)\n?[ \t]*```[ \t]*$)"
+    r"|(?P<inline>`(?P<inline_text>[^`\n]+)`)"
+    r"|(?P<link>\[(?P<link_text>[^\]\n]+)\]\((?P<url>(?:[^()\s]|\([^()\s]*\))+)\))"
+    r"|(?P<bold>\*\*(?=\S)(?P<bold_text>.+?)(?<=\S)\*\*)"
+    r"|(?P<underscore_bold>__(?=\S)(?P<underscore_bold_text>.+?)(?<=\S)__)"
+    r"|(?P<strike>~~(?=\S)(?P<strike_text>.+?)(?<=\S)~~)"
+    r"|(?P<italic>(?<![\w*])\*(?=[^\s*])(?P<italic_text>[^*\n]+?)(?<=\S)\*(?![\w*]))"
+    r"|(?P<underscore_italic>(?<![\w_])_(?=[^\s_])(?P<underscore_italic_text>[^_\n]+?)(?<=\S)_(?![\w_]))"
+    r"|(?P<heading>^[ \t]*\#{1,6}[ \t]+(?P<heading_text>[^\n]+?)[ \t#]*$)"
+    r"|(?P<bullet>^(?P<indent>[ \t]*)[-*+][ \t]+)",
+    re.MULTILINE | re.DOTALL
+)
+
+_BOLD_RE = re.compile(r"\*\*(?=\S)(.+?)(?<=\S)\*\*|__(?=\S)(.+?)(?<=\S)__", re.DOTALL)
+
+def _strip_bold(text: str) -> str:
+    """Drop bold markers inside text that is rendered bold, since MarkdownV2 cannot nest bold"""
+    return _BOLD_RE.sub(lambda match: match.group(1) or match.group(2), text)
+
+def _escape_code(text: str) -> str:
+    """Escape the content of a code entity, where only the backtick and the backslash are special"""
+    return text.replace('\\', '\\\\').replace('`', '\\`')
+
+def _escape_url(text: str) -> str:
+    """Escape a link target, where only the closing parenthesis and the backslash are special"""
+    return text.replace('\\', '\\\\').replace(')', '\\)')
+
+def _render_token(match: Match) -> str:
+    """Render one Markdown construct as MarkdownV2"""
+    kind = match.lastgroup
+    if kind == "fence":
+        return f"```{match.group('lang')}\n{_escape_code(match.group('code'))}\n```"
+    if kind == "inline":
+        return f"`{_escape_code(match.group('inline_text'))}`"
+    if kind == "link":
+        return f"[{render_markdown_v2(match.group('link_text'))}]({_escape_url(match.group('url'))})"
+    if kind in ("bold", "underscore_bold"):
+        return f"*{render_markdown_v2(_strip_bold(match.group(kind + '_text')))}*"
+    if kind == "strike":
+        return f"~{render_markdown_v2(match.group('strike_text'))}~"
+    if kind in ("italic", "underscore_italic"):
+        return f"_{render_markdown_v2(match.group(kind + '_text'))}_"
+    if kind == "heading":
+        return f"*{render_markdown_v2(_strip_bold(match.group('heading_text')))}*"
+    if kind == "bullet":
+        return f"{match.group('indent')}• "
+    return escape_markdown(match.group(0))
+
+def render_markdown_v2(text: str) -> str:
+    """
+    Render common Markdown as Telegram MarkdownV2
+    
+    Handles fenced and inline code, bold, italic, strikethrough, links,
+    headings (shown bold) and bullet lists. Everything else is escaped, so
+    the result is always valid MarkdownV2 as long as the constructs are
+    well formed.
+    
+    Args:
+        text: Markdown text
+    
+    Returns:
+        MarkdownV2 text
+    """
+    parts = []
+    position = 0
+    for match in _TOKEN_RE.finditer(text):
+        parts.append(escape_markdown(text[position:match.start()]))
+        parts.append(_render_token(match))
+        position = match.end()
+    parts.append(escape_markdown(text[position:]))
+    return "".join(parts)
+
+def render_chunks(text: str, max_length: int = 4096) -> List[Tuple[str, str]]:
+    """
+    Split Markdown text into parts whose MarkdownV2 rendering fits in one message
+    
+    Escaping makes the rendering longer than its source, so parts that
+    grow past max_length are split again more finely.
+    
+    Args:
+        text: Markdown text
+        max_length: Maximum length of a rendered part
+    
+    Returns:
+        (source, rendering) pairs in order; the source is the plain text fallback
+    """
+    parts = []
+    for chunk in split_message(text, max_length):
+        rendered = render_markdown_v2(chunk)
+        if len(rendered) <= max_length or len(chunk) < 2:
+            parts.append((chunk, rendered))
+            continue
+        # Shrink the source limit by how much this part grew, with some slack
+        limit = max(1, min(len(chunk) - 1, int(len(chunk) * max_length / len(rendered) * 0.9)))
+        for piece in split_message(chunk, limit):
+            parts.extend(render_chunks(piece, max_length))
+    return parts
@@ -3,28 +3,290 @@ Memory management for LiberGPT Telegram bot
 Handles conversation history storage and retrieval
 """
 
+import sys
+import time
 import logging
+from itertools import islice
 from typing import Dict, List, Tuple, Optional
-from collections import deque
+from collections import OrderedDict, deque
 from datetime import datetime
 
+from .storage import StorageBackend, InMemoryBackend, WriteBehindWriter
+
 logger = logging.getLogger(__name__)
 
+# Approximate bytes used per stored turn besides its two strings (record, float, deque slot)
+_TURN_OVERHEAD = 96
+
+# Rough characters per token used to turn a token budget into a character budget
+CHARS_PER_TOKEN = 4
+
+_CONTEXT_HEADER = "Previous conversation context:\n"
+_CONTEXT_FOOTER = "\n\nCurrent message:"
+_CLIP_MARKER = "…"
+# Smallest clipped turn worth including; with less room left the turn is dropped
+_MIN_CLIPPED_TURN = 40
+
+class ConversationTurn:
+    """A single user message and bot response"""
+    
+    __slots__ = ('timestamp', 'user_message', 'bot_response', 'size')
+    
+    def __init__(self, timestamp: float, user_message: str, bot_response: str):
+        """
+        Initialize a conversation turn
+        
+        Args:
+            timestamp: Unix time the turn was recorded
+            user_message: Message sent by user
+            bot_response: Response from bot
+        """
+        self.timestamp = timestamp
+        self.user_message = user_message
+        self.bot_response = bot_response
+        self.size = sys.getsizeof(user_message) + sys.getsizeof(bot_response) + _TURN_OVERHEAD
+    
+    def as_dict(self) -> Dict:
+        """
+        Get the turn in the dictionary form returned by the public API
+        
+        Returns:
+            Dictionary with timestamp, user_message and bot_response
+        """
+        return {
+            'timestamp': datetime.fromtimestamp(self.timestamp),
+            'user_message': self.user_message,
+            'bot_response': self.bot_response
+        }
+
+class UserHistory:
+    """Conversation turns of one user plus bookkeeping for eviction"""
+    
+    __slots__ = ('turns', 'size', 'last_access', 'context_key', 'context')
+    
+    def __init__(self, max_conversations: int):
+        self.turns: deque = deque(maxlen=max_conversations)
+        self.size = 0
+        self.last_access = time.monotonic()
+        # Last rendered context string and the (include_last_n, budget) it was rendered for
+        self.context_key: Optional[Tuple[int, Optional[int]]] = None
+        self.context: Optional[str] = None
+
 class ConversationMemory:
     """Manages conversation history for users"""
     
-    def __init__(self, max_conversations: int = 20):
+    def __init__(
+        self,
+        max_conversations: int = 20,
+        backend: Optional[StorageBackend] = None,
+        flush_interval: float = 1.0,
+        flush_batch_size: int = 500,
+        max_bytes: int = 0,
+        idle_ttl: float = 0
+    ):
         """
         Initialize conversation memory
         
         Args:
             max_conversations: Maximum number of conversations to remember per user
+            backend: Storage backend behind the in-memory tier (in-memory only if None)
+            flush_interval: Seconds between group commits to a persistent backend
+            flush_batch_size: Buffered writes that trigger an early commit
+            max_bytes: Approximate memory budget for all users' history (0 for unlimited)
+            idle_ttl: Seconds after which an idle user's history is evicted (0 to keep forever)
         """
         self.max_conversations = max_conversations
-        # Dictionary mapping user_id to deque of conversations
-        self._conversations: Dict[int, deque] = {}
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        # Users ordered from least to most recently used; the hot tier all reads are served from
+        self._conversations: "OrderedDict[int, UserHistory]" = OrderedDict()
+        self._current_bytes = 0
+        # Maintained on every change so the totals never need a scan over all users
+        self._total_turns = 0
+        self._active_users = 0
+        self._next_idle_sweep = time.monotonic() + min(idle_ttl, 60) if idle_ttl else None
+        self.evicted_users = 0
+        self.evicted_turns = 0
+        self.backend = backend or InMemoryBackend()
+        self._writer = None
+        if self.backend.persistent:
+            self._writer = WriteBehindWriter(self.backend, flush_interval, flush_batch_size)
         logger.info(f"ConversationMemory initialized with max {max_conversations} conversations per user")
     
+    async def start(self) -> None:
+        """Open the storage backend and start committing writes in the background"""
+        await self.backend.start()
+        if self._writer:
+            self._writer.start()
+    
+    async def close(self) -> None:
+        """Commit buffered writes and close the storage backend"""
+        if self._writer:
+            await self._writer.stop()
+        await self.backend.close()
+    
+    async def ensure_loaded(self, user_id: int) -> None:
+        """
+        Load a user's stored conversations into the in-memory tier if needed
+        
+        Call this before reading a user's memory; it returns immediately for
+        users already in memory and when the backend is not persistent. With a
+        shared backend the history is refreshed every time, since another
+        replica may have answered the user since it was loaded. If the backend
+        fails, the user is answered with what is in memory, possibly nothing.
+        
+        Args:
+            user_id: Telegram user ID
+        """
+        if not self._writer:
+            return
+        if self._touch(user_id) and not self.backend.shared:
+            return
+        
+        try:
+            # Make sure the backend sees writes still waiting in the buffer
+            if self._writer.has_pending(user_id):
+                await self._writer.flush()
+            
+            rows = await self.backend.load_user(user_id, self.max_conversations)
+        except Exception as e:
+            logger.warning(f"Failed to load stored conversations for user {user_id}, continuing without them: {e}")
+            return
+        history = self._conversations.get(user_id)
+        if history is not None:
+            if not self.backend.shared or self._writer.has_pending(user_id):
+                # A conversation was added while loading; memory is already authoritative
+                return
+            if [turn.timestamp for turn in history.turns] == [row[0] for row in rows]:
+                # Nothing changed elsewhere; keep the cached context string
+                return
+            self._remove_history(user_id)
+        
+        # Users without stored history get an empty entry so they are not looked up again
+        history = self._conversations[user_id] = UserHistory(self.max_conversations)
+        for timestamp, user_message, bot_response in rows:
+            self._append_turn(history, ConversationTurn(timestamp, user_message, bot_response))
+        self._enforce_budget(user_id)
+        logger.debug("Loaded %d stored conversations for user %s", len(history.turns), user_id)
+    
+    def _touch(self, user_id: int) -> bool:
+        """
+        Mark a user as recently used
+        
+        Args:
+            user_id: Telegram user ID
+        
+        Returns:
+            True if the user's history is in memory
+        """
+        history = self._conversations.get(user_id)
+        if history is None:
+            return False
+        history.last_access = time.monotonic()
+        self._conversations.move_to_end(user_id)
+        return True
+    
+    def _set_context_cache(self, history: UserHistory, key: Optional[Tuple[int, Optional[int]]], context: Optional[str]) -> None:
+        """Replace a user's cached context string, keeping byte counts in sync"""
+        if history.context is not None:
+            released = sys.getsizeof(history.context)
+            history.size -= released
+            self._current_bytes -= released
+        history.context_key = key
+        history.context = context
+        if context is not None:
+            added = sys.getsizeof(context)
+            history.size += added
+            self._current_bytes += added
+    
+    def _append_turn(self, history: UserHistory, turn: ConversationTurn) -> None:
+        """Append a turn to a user's history, keeping byte counts in sync"""
+        self._set_context_cache(history, None, None)
+        if not history.turns:
+            self._active_users += 1
+        elif len(history.turns) == history.turns.maxlen:
+            dropped = history.turns.popleft()
+            history.size -= dropped.size
+            self._current_bytes -= dropped.size
+            self._total_turns -= 1
+        history.turns.append(turn)
+        history.size += turn.size
+        self._current_bytes += turn.size
+        self._total_turns += 1
+    
+    def _remove_history(self, user_id: int) -> UserHistory:
+        """Take a user's history out of memory, keeping the totals in sync"""
+        history = self._conversations.pop(user_id)
+        self._current_bytes -= history.size
+        self._total_turns -= len(history.turns)
+        if history.turns:
+            self._active_users -= 1
+        return history
+    
+    def _evict_user(self, user_id: int) -> None:
+        """Drop a user's history from memory; persisted history stays in the backend"""
+        history = self._remove_history(user_id)
+        if history.turns:
+            self.evicted_users += 1
+            self.evicted_turns += len(history.turns)
+    
+    def _enforce_budget(self, current_user_id: int) -> None:
+        """
+        Evict least recently used users until memory fits the byte budget
+        
+        Args:
+            current_user_id: User being served, evicted last
+        """
+        if self._next_idle_sweep is not None and time.monotonic() >= self._next_idle_sweep:
+            self.evict_idle()
+        
+        if not self.max_bytes:
+            return
+        
+        while self._current_bytes > self.max_bytes and len(self._conversations) > 1:
+            oldest_user_id = next(iter(self._conversations))
+            if oldest_user_id == current_user_id:
+                self._conversations.move_to_end(current_user_id)
+                continue
+            self._evict_user(oldest_user_id)
+        
+        # A single user larger than the whole budget keeps only their newest turn
+        history = self._conversations.get(current_user_id)
+        if history and self._current_bytes > self.max_bytes:
+            self._set_context_cache(history, None, None)
+        while history and self._current_bytes > self.max_bytes and len(history.turns) > 1:
+            dropped = history.turns.popleft()
+            history.size -= dropped.size
+            self._current_bytes -= dropped.size
+            self._total_turns -= 1
+            self.evicted_turns += 1
+    
+    def evict_idle(self) -> int:
+        """
+        Evict users who have been idle for longer than idle_ttl
+        
+        Returns:
+            Number of users evicted
+        """
+        if not self.idle_ttl:
+            return 0
+        
+        now = time.monotonic()
+        self._next_idle_sweep = now + min(self.idle_ttl, 60)
+        cutoff = now - self.idle_ttl
+        evicted = 0
+        # Users are kept in access order, so idle users are all at the front
+        while self._conversations:
+            user_id, history = next(iter(self._conversations.items()))
+            if history.last_access > cutoff:
+                break
+            self._evict_user(user_id)
+            evicted += 1
+        
+        if evicted:
+            logger.info(f"Evicted {evicted} idle users from conversation memory")
+        return evicted
+    
     def add_conversation(self, user_id: int, user_message: str, bot_response: str) -> None:
         """
         Add a conversation pair to memory
@@ -34,17 +296,17 @@ class ConversationMemory:
             user_message: Message sent by user
             bot_response: Response from bot
         """
-        if user_id not in self._conversations:
-            self._conversations[user_id] = deque(maxlen=self.max_conversations)
+        if not self._touch(user_id):
+            self._conversations[user_id] = UserHistory(self.max_conversations)
+        history = self._conversations[user_id]
         
-        conversation = {
-            'timestamp': datetime.now(),
-            'user_message': user_message,
-            'bot_response': bot_response
-        }
+        turn = ConversationTurn(time.time(), user_message, bot_response)
+        self._append_turn(history, turn)
+        if self._writer:
+            self._writer.enqueue(("append", user_id, turn.timestamp, user_message, bot_response))
         
-        self._conversations[user_id].append(conversation)
-        logger.debug(f"Added conversation for user {user_id}. Total: {len(self._conversations[user_id])}")
+        self._enforce_budget(user_id)
+        logger.debug("Added conversation for user %s. Total: %d", user_id, len(history.turns))
     
     def get_conversation_history(self, user_id: int, limit: Optional[int] = None) -> List[Dict]:
         """
@@ -53,43 +315,113 @@ class ConversationMemory:
         Args:
             user_id: Telegram user ID
             limit: Maximum number of conversations to return (None for all)
-            
+        
         Returns:
             List of conversation dictionaries
         """
-        if user_id not in self._conversations:
+        return [turn.as_dict() for turn in self._get_turns(user_id, limit)]
+    
+    def _get_turns(self, user_id: int, limit: Optional[int] = None) -> List[ConversationTurn]:
+        """
+        Get a user's most recent turns, oldest first
+        
+        Args:
+            user_id: Telegram user ID
+            limit: Maximum number of turns to return (None for all)
+        
+        Returns:
+            List of conversation turns
+        """
+        if not self._touch(user_id):
             return []
         
-        conversations = list(self._conversations[user_id])
+        turns = list(self._conversations[user_id].turns)
         
         if limit is not None:
-            conversations = conversations[-limit:]
+            turns = turns[-limit:]
         
-        return conversations
+        return turns
     
-    def get_context_string(self, user_id: int, include_last_n: int = 5) -> str:
+    def get_context_string(
+        self,
+        user_id: int,
+        include_last_n: int = 5,
+        max_chars: Optional[int] = None,
+        max_tokens: Optional[int] = None
+    ) -> str:
         """
         Get conversation history as a formatted context string
         
+        The newest turns are kept; older turns that do not fit the budget are
+        dropped, and the oldest included turn may be clipped from the front.
+        The result is cached per user until the user's history changes.
+        
         Args:
             user_id: Telegram user ID
             include_last_n: Number of recent conversations to include
-            
+            max_chars: Maximum length of the context string (None for unlimited)
+            max_tokens: Approximate token budget, converted with CHARS_PER_TOKEN
+        
         Returns:
             Formatted context string
         """
-        conversations = self.get_conversation_history(user_id, limit=include_last_n)
+        budget = max_chars
+        if max_tokens is not None:
+            token_chars = max_tokens * CHARS_PER_TOKEN
+            budget = token_chars if budget is None else min(budget, token_chars)
         
-        if not conversations:
+        if not self._touch(user_id):
             return ""
         
-        context_parts = []
-        for conv in conversations:
-            context_parts.append(f"User: {conv['user_message']}")
-            context_parts.append(f"Assistant: {conv['bot_response']}")
+        history = self._conversations[user_id]
+        key = (include_last_n, budget)
+        if history.context_key == key:
+            return history.context
+        
+        context = self._render_context(history, include_last_n, budget)
+        self._set_context_cache(history, key, context)
+        return context
+    
+    @staticmethod
+    def _render_context(history: UserHistory, include_last_n: int, budget: Optional[int]) -> str:
+        """
+        Render the most recent turns of a history into a context string within a budget
+        
+        Args:
+            history: User history to render
+            include_last_n: Number of recent conversations to include
+            budget: Maximum length of the result (None for unlimited)
+        
+        Returns:
+            Formatted context string, empty if no turn fits
+        """
+        if budget is None:
+            remaining = None
+        else:
+            remaining = budget - len(_CONTEXT_HEADER) - len(_CONTEXT_FOOTER)
+        
+        # Walk from the newest turn backwards so the most relevant context survives
+        parts = []
+        for turn in islice(reversed(history.turns), include_last_n):
+            part = f"User: {turn.user_message}\nAssistant: {turn.bot_response}"
+            separator = 1 if parts else 0
+            
+            if remaining is not None and len(part) + separator > remaining:
+                room = remaining - separator - len(_CLIP_MARKER)
+                if room >= _MIN_CLIPPED_TURN:
+                    parts.append(_CLIP_MARKER + part[-room:])
+                break
+            
+            parts.append(part)
+            if remaining is not None:
+                remaining -= len(part) + separator
+        
+        if not parts:
+            return ""
         
-        context = "\n".join(context_parts)
-        return f"Previous conversation context:\n{context}\n\nCurrent message:"
+        parts.reverse()
+        context = "\n".join(parts)
+        return f"{_CONTEXT_HEADER}{context}{_CONTEXT_FOOTER}"
     
     def clear_user_memory(self, user_id: int) -> int:
         """
@@ -97,15 +429,17 @@ class ConversationMemory:
         
         Args:
             user_id: Telegram user ID
-            
+        
         Returns:
             Number of conversations cleared
         """
         if user_id not in self._conversations:
             return 0
         
-        count = len(self._conversations[user_id])
-        del self._conversations[user_id]
+        history = self._remove_history(user_id)
+        count = len(history.turns)
+        if self._writer:
+            self._writer.enqueue(("clear", user_id))
         logger.info(f"Cleared {count} conversations for user {user_id}")
         return count
     
@@ -115,7 +449,7 @@ class ConversationMemory:
         
         Args:
             user_id: Telegram user ID
-            
+        
         Returns:
             Dictionary with memory statistics
         """
@@ -126,11 +460,11 @@ class ConversationMemory:
                 'newest_conversation': None
             }
         
-        conversations = self._conversations[user_id]
+        turns = self._conversations[user_id].turns
         return {
-            'conversation_count': len(conversations),
-            'oldest_conversation': conversations[0]['timestamp'] if conversations else None,
-            'newest_conversation': conversations[-1]['timestamp'] if conversations else None
+            'conversation_count': len(turns),
+            'oldest_conversation': datetime.fromtimestamp(turns[0].timestamp) if turns else None,
+            'newest_conversation': datetime.fromtimestamp(turns[-1].timestamp) if turns else None
         }
     
     def get_total_stats(self) -> Dict:
@@ -140,11 +474,12 @@ class ConversationMemory:
         Returns:
             Dictionary with total statistics
         """
-        total_conversations = sum(len(convs) for convs in self._conversations.values())
-        active_users = len(self._conversations)
-        
         return {
-            'active_users': active_users,
-            'total_conversations': total_conversations,
-            'max_conversations_per_user': self.max_conversations
+            'active_users': self._active_users,
+            'total_conversations': self._total_turns,
+            'max_conversations_per_user': self.max_conversations,
+            'current_bytes': self._current_bytes,
+            'max_bytes': self.max_bytes,
+            'evicted_users': self.evicted_users,
+            'evicted_turns': self.evicted_turns
         }
@@ -0,0 +1,342 @@
+"""
+Metrics for LiberGPT Telegram bot
+Counters, gauges and histograms exported in the Prometheus text format on a local HTTP endpoint
+"""
+
+import asyncio
+import bisect
+import logging
+import math
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a fast Bot API call to a slow AI answer
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _format_value(value: float) -> str:
+    """Format a sample value the way Prometheus expects"""
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """Format a label set, escaping backslashes, quotes and newlines in the values"""
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+class _Metric:
+    """Base of all metrics: a name, a help text and fixed label names"""
+    
+    type_name = ""
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+    
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        """Get the label values of a sample in label name order"""
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+    
+    def samples(self) -> List[str]:
+        """Get the sample lines of the metric"""
+        raise NotImplementedError
+    
+    def render(self) -> str:
+        """Render the metric with its HELP and TYPE lines"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+class Counter(_Metric):
+    """Monotonically increasing count named ..._total, either incremented or read from a function at scrape time"""
+    
+    type_name = "counter"
+    
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Optional[Callable[[], float]] = None
+    ):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function = function
+    
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Add to the count of a label set"""
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+    
+    def value(self, **labels: str) -> float:
+        """Get the count of a label set"""
+        if self._function is not None:
+            return self._function()
+        return self._values.get(self._key(labels), 0)
+    
+    def samples(self) -> List[str]:
+        if self._function is not None:
+            return [f"{self.name} {_format_value(self._function())}"]
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+class Gauge(_Metric):
+    """Value that goes up and down, either set directly or read from a function at scrape time"""
+    
+    type_name = "gauge"
+    
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Optional[Callable[[], float]] = None
+    ):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function = function
+    
+    def set(self, value: float, **labels: str) -> None:
+        """Set the value of a label set"""
+        self._values[self._key(labels)] = value
+    
+    def samples(self) -> List[str]:
+        if self._function is not None:
+            return [f"{self.name} {_format_value(self._function())}"]
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets"""
+    
+    type_name = "histogram"
+    
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: count of each bucket (not cumulative, the last one is +Inf), sum
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+    
+    def observe(self, value: float, **labels: str) -> None:
+        """Record one observation for a label set"""
+        key = self._key(labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+    
+    def count(self, **labels: str) -> int:
+        """Get the number of observations of a label set"""
+        return sum(self._counts.get(self._key(labels), ()))
+    
+    def samples(self) -> List[str]:
+        lines = []
+        bucket_names = self.labelnames + ("le",)
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _format_labels(bucket_names, key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(self._sums[key])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """Collection of metrics rendered together"""
+    
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+    
+    def register(self, metric: _Metric) -> _Metric:
+        """
+        Add a metric to the registry
+        
+        Args:
+            metric: Metric to add
+        
+        Returns:
+            The metric, for assignment
+        
+        Raises:
+            ValueError: If a metric with the same name is already registered
+        """
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format"""
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+def _outcome(error: Optional[BaseException]) -> str:
+    """Classify the result of a timed call for the outcome label"""
+    if error is None:
+        return "success"
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, RetryAfter):
+        return "flood_limited"
+    return "error"
+
+class BotMetrics:
+    """The bot's metrics and the hooks that feed them"""
+    
+    def __init__(self, registry: Optional[MetricsRegistry] = None):
+        """
+        Initialize the metrics
+        
+        Args:
+            registry: Registry to add the metrics to (a new one if None)
+        """
+        self.registry = registry or MetricsRegistry()
+        self.upstream_seconds = self.registry.register(Histogram(
+            "libergpt_upstream_request_seconds",
+            "Duration of requests to the AI API by outcome",
+            ["outcome"]
+        ))
+        self.telegram_send_seconds = self.registry.register(Histogram(
+            "libergpt_telegram_send_seconds",
+            "Duration of Bot API message calls by outcome",
+            ["outcome"]
+        ))
+        self.update_seconds = self.registry.register(Histogram(
+            "libergpt_update_handling_seconds",
+            "Time from receiving a chat message to delivering the answer, by outcome",
+            ["outcome"]
+        ))
+        self.rate_limit_rejections = self.registry.register(Counter(
+            "libergpt_rate_limit_rejections_total",
+            "Messages rejected by the per-user rate limit"
+        ))
+    
+    def record_upstream(self, latency: float, error: Optional[BaseException]) -> None:
+        """API client listener recording one upstream request"""
+        self.upstream_seconds.observe(latency, outcome=_outcome(error))
+    
+    def record_send(self, latency: float, error: Optional[BaseException]) -> None:
+        """Outbound scheduler listener recording one Bot API call"""
+        self.telegram_send_seconds.observe(latency, outcome=_outcome(error))
+    
+    def track(self, name: str, documentation: str, function: Callable[[], float]) -> None:
+        """
+        Export a value read when metrics are scraped
+        
+        Args:
+            name: Metric name
+            documentation: Help text
+            function: Called at scrape time; must be cheap
+        """
+        self.registry.register(Gauge(name, documentation, function=function))
+    
+    def track_memory(self, memory) -> None:
+        """Export the totals of a ConversationMemory, which it maintains in O(1)"""
+        self.track(
+            "libergpt_memory_active_users",
+            "Users with conversations in memory",
+            lambda: memory.get_total_stats()['active_users']
+        )
+        self.track(
+            "libergpt_memory_conversations",
+            "Conversations held in memory across all users",
+            lambda: memory.get_total_stats()['total_conversations']
+        )
+        self.track(
+            "libergpt_memory_bytes",
+            "Approximate bytes used by conversation memory",
+            lambda: memory.get_total_stats()['current_bytes']
+        )
+    
+    def track_cache(self, name: str, cache) -> None:
+        """
+        Export the counters of a response cache
+        
+        Args:
+            name: Cache name used in the metric names, e.g. "response"
+            cache: ResponseCache or SimilarityCache
+        """
+        for counter in ("hits", "misses", "evictions"):
+            self.registry.register(Counter(
+                f"libergpt_{name}_cache_{counter}_total",
+                f"Cache {counter} of the {name} cache",
+                function=lambda counter=counter: cache.get_stats()[counter]
+            ))
+        self.track(
+            f"libergpt_{name}_cache_entries",
+            f"Responses held in the {name} cache",
+            lambda: len(cache)
+        )
+
+class MetricsServer:
+    """aiohttp server exposing a registry on /metrics"""
+    
+    def __init__(self, registry: MetricsRegistry, listen: str = "127.0.0.1", port: int = 9090):
+        """
+        Initialize the metrics server
+        
+        Args:
+            registry: Registry to expose
+            listen: Address to bind to; the default keeps the endpoint local
+            port: Port to bind to
+        """
+        self.registry = registry
+        self.listen = listen
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+    
+    def make_app(self) -> web.Application:
+        """Build the aiohttp application"""
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        return app
+    
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        """Render the registry for a scrape"""
+        return web.Response(body=self.registry.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+    
+    async def start(self) -> None:
+        """Start serving metrics"""
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.listen, self.port)
+        await site.start()
+        logger.info(f"Metrics available on http://{self.listen}:{self.port}/metrics")
+    
+    async def stop(self) -> None:
+        """Stop serving metrics"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,384 @@
+"""
+Outbound message scheduling for LiberGPT Telegram bot
+Paces every Bot API call under Telegram's flood limits: globally, per chat, and by priority
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# A queued call: the function performing the Bot API call, the future receiving its result and its priority
+_Call = Tuple[Callable[[], Awaitable[Any]], asyncio.Future, int]
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Get the flood wait of a RetryAfter error in seconds"""
+    delay = error.retry_after
+    if isinstance(delay, timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+class TokenBucket:
+    """Token bucket refilled continuously at a fixed rate"""
+    
+    def __init__(self, rate: float, capacity: float):
+        """
+        Initialize the bucket full
+        
+        Args:
+            rate: Tokens added per second
+            capacity: Maximum number of tokens, i.e. the allowed burst
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+    
+    def _refill(self) -> None:
+        """Add the tokens accrued since the last update"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def wait_time(self) -> float:
+        """Get the seconds until a token is available, 0 if one is available now"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def take(self) -> None:
+        """Consume one token"""
+        self._refill()
+        self.tokens -= 1
+    
+    @property
+    def full(self) -> bool:
+        """Whether the bucket has refilled completely"""
+        self._refill()
+        return self.tokens >= self.capacity
+
+class _PriorityGate:
+    """Hands out tokens of a global bucket to waiters, highest priority (lowest number) first"""
+    
+    def __init__(self, bucket: TokenBucket, levels: int):
+        self.bucket = bucket
+        self._waiters: List[Deque[asyncio.Future]] = [deque() for _ in range(levels)]
+        self._pump_task: Optional[asyncio.Task] = None
+    
+    def _has_waiters(self) -> bool:
+        return any(self._waiters)
+    
+    async def acquire(self, priority: int) -> None:
+        """Wait for a token; cancelling the wait gives up the place in line"""
+        if not self._has_waiters() and self.bucket.wait_time() == 0:
+            self.bucket.take()
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(future)
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await future
+    
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        """Pop the first live waiter of the highest priority"""
+        for waiters in self._waiters:
+            while waiters:
+                future = waiters.popleft()
+                if not future.done():
+                    return future
+        return None
+    
+    async def _pump(self) -> None:
+        """Release waiters as tokens become available"""
+        while self._has_waiters():
+            wait = self.bucket.wait_time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            # Pick the waiter only once a token is there, so a reply queued
+            # during the sleep still goes ahead of an older typing indicator
+            future = self._next_waiter()
+            if future is None:
+                break
+            self.bucket.take()
+            future.set_result(None)
+
+class _ChatState:
+    """Queued calls and pacing of one chat"""
+    
+    __slots__ = ('queue', 'typing', 'typing_task', 'bucket', 'paused_until', 'task')
+    
+    def __init__(self, bucket: TokenBucket):
+        self.queue: Deque[_Call] = deque()
+        # Typing indicator waiting for a global token; a newer one replaces it, a reply makes it moot
+        self.typing: Optional[Callable[[], Awaitable[Any]]] = None
+        # Typing indicators are sent outside the queue, so they never hold up its calls
+        self.typing_task: Optional[asyncio.Task] = None
+        self.bucket = bucket
+        self.paused_until = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+class OutboundScheduler:
+    """
+    Central scheduler for Bot API calls
+    
+    Every call waits for a token from a global bucket (Telegram allows about
+    30 messages per second per bot) and messages additionally wait for a
+    per-chat bucket (about one per second in private chats, 20 per minute in
+    groups). Calls of a chat run in submission order. Replies get tokens
+    before stream preview edits, which get them before typing indicators.
+    Typing indicators are sent outside the chat's queue, coalesced per chat,
+    and dropped when a message for the chat is queued or when they would
+    arrive late. A RetryAfter pauses the chat for the requested time and the
+    call is retried.
+    """
+    
+    PRIORITY_REPLY = 0
+    PRIORITY_UPDATE = 1
+    PRIORITY_TYPING = 2
+    
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        group_rate: float = 20 / 60,
+        chat_burst: int = 3,
+        typing_max_wait: float = 3.0,
+        max_retries: int = 3,
+        sweep_interval: float = 300.0
+    ):
+        """
+        Initialize the scheduler
+        
+        Args:
+            global_rate: Calls per second across all chats
+            chat_rate: Messages per second in a private chat
+            group_rate: Messages per second in a group or channel
+            chat_burst: Messages a chat may receive back to back before pacing starts
+            typing_max_wait: Seconds after which a typing indicator still waiting is dropped
+            max_retries: How many times a call is retried after Telegram asks to wait
+            sweep_interval: Seconds between sweeps of idle chat state
+        """
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.typing_max_wait = typing_max_wait
+        self.max_retries = max_retries
+        self.sweep_interval = sweep_interval
+        self._gate = _PriorityGate(TokenBucket(global_rate, global_rate), levels=3)
+        self._chats: Dict[int, _ChatState] = {}
+        self._next_sweep = time.monotonic() + sweep_interval
+        self._listeners: List[Callable[[float, Optional[BaseException]], None]] = []
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.typing_sent = 0
+        self.typing_coalesced = 0
+        self.typing_dropped = 0
+    
+    def add_listener(self, listener: Callable[[float, Optional[BaseException]], None]) -> None:
+        """
+        Register a callback invoked after every message call sent to Telegram
+        
+        Args:
+            listener: Called with the call duration in seconds and the raised
+                exception, or None on success; typing indicators are not reported
+        """
+        self._listeners.append(listener)
+    
+    def _notify_listeners(self, started_at: float, error: Optional[BaseException]) -> None:
+        """Report a finished message call to all listeners"""
+        latency = time.monotonic() - started_at
+        for listener in self._listeners:
+            try:
+                listener(latency, error)
+            except Exception as e:
+                logger.error(f"Outbound call listener failed: {e}")
+    
+    def _chat(self, chat_id: int) -> _ChatState:
+        """Get or create the state of a chat"""
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
+        
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            # Group and channel IDs are negative in the Bot API
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            chat = self._chats[chat_id] = _ChatState(TokenBucket(rate, self.chat_burst))
+        return chat
+    
+    def _sweep(self, now: float) -> None:
+        """Forget idle chats whose pacing has fully recovered"""
+        self._next_sweep = now + self.sweep_interval
+        idle = [
+            chat_id for chat_id, chat in self._chats.items()
+            if chat.task is None and chat.typing_task is None and chat.paused_until <= now and chat.bucket.full
+        ]
+        for chat_id in idle:
+            del self._chats[chat_id]
+    
+    def _ensure_draining(self, chat_id: int, chat: _ChatState) -> None:
+        """Start the chat's drain task if it is not running"""
+        if chat.task is None:
+            chat.task = asyncio.create_task(self._drain(chat_id, chat))
+    
+    def submit(self, chat_id: int, send: Callable[[], Awaitable[Any]], priority: int = PRIORITY_REPLY) -> asyncio.Future:
+        """
+        Queue a message call for a chat without waiting for it
+        
+        Args:
+            chat_id: Chat the call sends to
+            send: Function making the call, e.g. lambda: message.reply_text(text)
+            priority: PRIORITY_REPLY or PRIORITY_UPDATE
+        
+        Returns:
+            Future resolved with the call's result, or its exception
+        """
+        future = asyncio.get_running_loop().create_future()
+        chat = self._chat(chat_id)
+        if chat.typing is not None:
+            # A message is about to arrive, the indicator would only flash
+            chat.typing = None
+            chat.typing_task.cancel()
+            self.typing_dropped += 1
+        chat.queue.append((send, future, priority))
+        self._ensure_draining(chat_id, chat)
+        return future
+    
+    async def send(self, chat_id: int, send: Callable[[], Awaitable[Any]], priority: int = PRIORITY_REPLY) -> Any:
+        """
+        Queue a message call for a chat and wait for its result
+        
+        Args:
+            chat_id: Chat the call sends to
+            send: Function making the call
+            priority: PRIORITY_REPLY or PRIORITY_UPDATE
+        
+        Returns:
+            The call's result
+        """
+        return await self.submit(chat_id, send, priority)
+    
+    def send_typing(self, chat_id: int, send: Callable[[], Awaitable[Any]]) -> None:
+        """
+        Queue a typing indicator for a chat; best effort, nobody waits for it
+        
+        Args:
+            chat_id: Chat to show the indicator in
+            send: Function making the send_chat_action call
+        """
+        chat = self._chat(chat_id)
+        if chat.queue:
+            # A message is already on its way
+            self.typing_dropped += 1
+            return
+        if chat.typing is not None:
+            self.typing_coalesced += 1
+        chat.typing = send
+        if chat.typing_task is None:
+            chat.typing_task = asyncio.create_task(self._send_typing(chat))
+    
+    async def _call(self, chat: _ChatState, send: Callable[[], Awaitable[Any]], priority: int) -> Any:
+        """Pace and make one message call, retrying when Telegram reports a flood limit"""
+        for attempt in range(self.max_retries + 1):
+            # Wait for the chat's turn, then for a global token
+            while True:
+                wait = max(chat.paused_until - time.monotonic(), chat.bucket.wait_time())
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            chat.bucket.take()
+            await self._gate.acquire(priority)
+            
+            started_at = time.monotonic()
+            try:
+                result = await send()
+            except Exception as e:
+                self._notify_listeners(started_at, e)
+                if not isinstance(e, RetryAfter) or attempt == self.max_retries:
+                    raise
+                delay = retry_after_seconds(e)
+                chat.paused_until = time.monotonic() + delay
+                self.retried += 1
+                logger.warning(f"Telegram flood limit hit, pausing chat for {delay:.0f}s")
+            else:
+                self._notify_listeners(started_at, None)
+                return result
+    
+    async def _send_typing(self, chat: _ChatState) -> None:
+        """Send a chat's pending typing indicators unless they would arrive too late to be useful"""
+        try:
+            while chat.typing is not None:
+                if chat.paused_until > time.monotonic():
+                    chat.typing = None
+                    self.typing_dropped += 1
+                    return
+                try:
+                    await asyncio.wait_for(self._gate.acquire(self.PRIORITY_TYPING), timeout=self.typing_max_wait)
+                except asyncio.TimeoutError:
+                    chat.typing = None
+                    self.typing_dropped += 1
+                    return
+                send, chat.typing = chat.typing, None
+                try:
+                    await send()
+                    self.typing_sent += 1
+                except Exception as e:
+                    logger.debug(f"Failed to send typing indicator: {e}")
+        finally:
+            chat.typing_task = None
+    
+    async def _drain(self, chat_id: int, chat: _ChatState) -> None:
+        """Run a chat's queued calls in order until nothing is left"""
+        try:
+            while chat.queue:
+                send, future, priority = chat.queue.popleft()
+                if future.cancelled():
+                    continue
+                try:
+                    result = await self._call(chat, send, priority)
+                except Exception as e:
+                    self.failed += 1
+                    if not future.cancelled():
+                        future.set_exception(e)
+                    continue
+                self.sent += 1
+                if not future.cancelled():
+                    future.set_result(result)
+        finally:
+            chat.task = None
+    
+    async def close(self) -> None:
+        """Wait for every queued call to finish"""
+        tasks = [
+            task for chat in self._chats.values()
+            for task in (chat.task, chat.typing_task) if task is not None
+        ]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def get_stats(self) -> Dict:
+        """
+        Get delivery statistics
+        
+        Returns:
+            Dictionary with queue and delivery counters
+        """
+        return {
+            'active_chats': sum(1 for chat in self._chats.values() if chat.task is not None),
+            'queued': sum(len(chat.queue) for chat in self._chats.values()),
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+            'typing_sent': self.typing_sent,
+            'typing_coalesced': self.typing_coalesced,
+            'typing_dropped': self.typing_dropped
+        }
@@ -0,0 +1,420 @@
+"""
+Shared state for LiberGPT Telegram bot replicas
+A small auto-pipelining Redis client plus Redis-backed rate limiting and conversation storage
+"""
+
+import asyncio
+import json
+import logging
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from .storage import StorageBackend, StoredTurn, WriteOp
+
+logger = logging.getLogger(__name__)
+
+class RedisError(Exception):
+    """Error reply returned by the Redis server"""
+
+def _encode_command(args: Tuple) -> bytes:
+    """Encode a command as a RESP array of bulk strings"""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        elif isinstance(arg, str):
+            data = arg.encode("utf-8")
+        else:
+            data = str(arg).encode("ascii")
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+async def _read_reply(reader: asyncio.StreamReader):
+    """
+    Read one RESP reply
+    
+    Returns:
+        str for simple strings, int for integers, bytes or None for bulk strings,
+        a list for arrays and a RedisError instance for error replies
+    """
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Redis connection closed")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload.decode("utf-8")
+    if kind == b"-":
+        return RedisError(payload.decode("utf-8"))
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b"*":
+        count = int(payload)
+        if count < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(count)]
+    raise ConnectionError(f"Unexpected Redis reply: {line!r}")
+
+class RedisClient:
+    """Single-connection Redis client that pipelines every command issued in the same loop iteration"""
+    
+    def __init__(
+        self,
+        url: str = "redis://localhost:6379/0",
+        connect_timeout: float = 5.0,
+        command_timeout: Optional[float] = 2.0
+    ):
+        """
+        Initialize the client; the connection is opened on first use
+        
+        Args:
+            url: Server URL, redis://[:password@]host[:port][/db]
+            connect_timeout: Seconds to wait for the connection
+            command_timeout: Seconds to wait for the replies of a command or pipeline
+                (None to wait forever); callers hold a user's lock while waiting
+        """
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._connect_lock = asyncio.Lock()
+        # Commands waiting to be written, and futures of written commands awaiting replies
+        self._buffer: List[bytes] = []
+        self._buffered: List[asyncio.Future] = []
+        self._pending: Deque[asyncio.Future] = deque()
+        self._flush_scheduled = False
+        self.commands_sent = 0
+        self.round_trips = 0
+    
+    @property
+    def connected(self) -> bool:
+        """Whether the connection is open"""
+        return self._writer is not None and not self._writer.is_closing()
+    
+    async def connect(self) -> None:
+        """Open the connection if it is not open yet"""
+        async with self._connect_lock:
+            if self.connected:
+                return
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port),
+                timeout=self.connect_timeout
+            )
+            self._reader_task = asyncio.create_task(self._read_replies())
+            logger.info(f"Connected to Redis at {self.host}:{self.port}/{self.db}")
+            
+            setup = []
+            if self.password:
+                setup.append(self._send(("AUTH", self.password)))
+            if self.db:
+                setup.append(self._send(("SELECT", self.db)))
+            for future in setup:
+                await future
+    
+    async def close(self) -> None:
+        """Close the connection, failing any command still waiting for a reply"""
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        self._fail_pending(ConnectionError("Redis connection closed"))
+        self._reader = self._writer = None
+    
+    def _send(self, args: Tuple) -> asyncio.Future:
+        """Buffer a command for the next pipelined write and return the future of its reply"""
+        future = asyncio.get_running_loop().create_future()
+        self._buffer.append(_encode_command(args))
+        self._buffered.append(future)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+        return future
+    
+    def _flush(self) -> None:
+        """Write every buffered command in one go"""
+        self._flush_scheduled = False
+        if not self._buffer:
+            return
+        data, futures = b"".join(self._buffer), self._buffered
+        self._buffer, self._buffered = [], []
+        if not self.connected:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(ConnectionError("Redis connection is not open"))
+            return
+        self._pending.extend(futures)
+        self._writer.write(data)
+        self.commands_sent += len(futures)
+        self.round_trips += 1
+    
+    async def _read_replies(self) -> None:
+        """Resolve pending commands in order as their replies arrive"""
+        try:
+            while True:
+                reply = await _read_reply(self._reader)
+                future = self._pending.popleft()
+                if future.done():
+                    continue
+                if isinstance(reply, RedisError):
+                    future.set_exception(reply)
+                else:
+                    future.set_result(reply)
+        except (ConnectionError, OSError, asyncio.IncompleteReadError, IndexError) as e:
+            logger.error(f"Redis connection lost: {e}")
+            if self._writer is not None:
+                self._writer.close()
+            self._fail_pending(ConnectionError("Redis connection lost"))
+    
+    def _fail_pending(self, error: Exception) -> None:
+        """Fail every command that will never get a reply"""
+        for future in list(self._pending) + self._buffered:
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+        self._buffer, self._buffered = [], []
+    
+    async def execute(self, *args):
+        """
+        Run a command; commands issued in the same loop iteration share one round trip
+        
+        Args:
+            *args: Command name and arguments
+        
+        Returns:
+            The decoded RESP reply
+        
+        Raises:
+            RedisError: If the server replied with an error
+            ConnectionError: If the connection failed
+            asyncio.TimeoutError: If the reply took longer than command_timeout
+        """
+        if not self.connected:
+            await self.connect()
+        # A late reply still arrives in order; the reader skips the cancelled future
+        return await asyncio.wait_for(self._send(args), self.command_timeout)
+    
+    def execute_nowait(self, *args) -> None:
+        """Run a command without waiting for its reply; failures are only logged"""
+        if not self.connected:
+            asyncio.ensure_future(self._execute_logged(args))
+            return
+        self._send(args).add_done_callback(self._log_failure)
+    
+    async def _execute_logged(self, args: Tuple) -> None:
+        """Run a command in the background, logging failures"""
+        try:
+            await self.execute(*args)
+        except (RedisError, ConnectionError, OSError, asyncio.TimeoutError) as e:
+            logger.warning(f"Background Redis command {args[0]} failed: {e}")
+    
+    @staticmethod
+    def _log_failure(future: asyncio.Future) -> None:
+        """Log the failure of a command nobody awaits"""
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning(f"Background Redis command failed: {future.exception()}")
+    
+    async def pipeline(self, *commands: Tuple) -> List:
+        """
+        Run several commands in a single round trip
+        
+        Args:
+            *commands: Tuples of command name and arguments
+        
+        Returns:
+            Replies in command order
+        
+        Raises:
+            asyncio.TimeoutError: If the replies took longer than command_timeout
+        """
+        if not self.connected:
+            await self.connect()
+        replies = asyncio.gather(*(self._send(command) for command in commands))
+        return list(await asyncio.wait_for(replies, self.command_timeout))
+    
+    async def transaction(self, *commands: Tuple) -> List:
+        """
+        Run several commands atomically in a single round trip with MULTI/EXEC
+        
+        The server applies all of them or, if the connection drops before EXEC
+        arrives or a command is rejected while queueing, none of them.
+        
+        Args:
+            *commands: Tuples of command name and arguments
+        
+        Returns:
+            Replies in command order; a command that failed while running, which
+            Redis does not roll back, has a RedisError instance as its reply
+        
+        Raises:
+            RedisError: If a command was rejected and the transaction discarded
+            ConnectionError: If the connection failed
+            asyncio.TimeoutError: If the replies took longer than command_timeout
+        """
+        if not self.connected:
+            await self.connect()
+        futures = [self._send(command) for command in (("MULTI",), *commands, ("EXEC",))]
+        # Wait for every reply, so the EXECABORT following a rejected command is retrieved too
+        replies = asyncio.gather(*futures, return_exceptions=True)
+        replies = await asyncio.wait_for(replies, self.command_timeout)
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies[-1]
+
+class RedisRateLimiter:
+    """
+    Per-user rate limiter shared by all replicas, using a sliding window counter
+    
+    Each check is one pipelined round trip: INCR and PEXPIRE the current
+    window's counter and GET the previous window's. The previous window is
+    weighted by how much of it still overlaps the sliding window. Rejected
+    messages are uncounted with a DECR that nobody waits for.
+    """
+    
+    def __init__(self, client: RedisClient, max_messages: int = 10, time_window: int = 60, prefix: str = "libergpt:"):
+        """
+        Initialize the rate limiter
+        
+        Args:
+            client: Redis client
+            max_messages: Messages allowed per time window
+            time_window: Window length in seconds
+            prefix: Key prefix
+        """
+        self.client = client
+        self.max_messages = max_messages
+        self.time_window = time_window
+        self.prefix = f"{prefix}ratelimit:"
+        # Seconds to wait reported by the last rejected check of each user
+        self._retry_after: Dict[int, int] = {}
+    
+    def _keys(self, user_id: int, now: float) -> Tuple[str, str, float]:
+        """Get the current and previous window keys and the time into the current window"""
+        window = int(now // self.time_window)
+        return (
+            f"{self.prefix}{user_id}:{window}",
+            f"{self.prefix}{user_id}:{window - 1}",
+            now - window * self.time_window
+        )
+    
+    async def acquire(self, user_id: int) -> bool:
+        """
+        Check if user is allowed to send a message, consuming one message of quota if so
+        
+        Fails open when Redis is unreachable so an outage does not silence the bot.
+        """
+        # Wall-clock time, because the windows are shared with other hosts
+        now = time.time()
+        key, previous_key, elapsed = self._keys(user_id, now)
+        try:
+            current, _, previous = await self.client.pipeline(
+                ("INCR", key),
+                ("PEXPIRE", key, int(self.time_window * 2000)),
+                ("GET", previous_key)
+            )
+        except (RedisError, ConnectionError, OSError, asyncio.TimeoutError) as e:
+            logger.warning(f"Redis rate limit check failed, allowing message: {e}")
+            return True
+        
+        previous = int(previous or 0)
+        weight = 1.0 - elapsed / self.time_window
+        if previous * weight + current <= self.max_messages + 1e-9:
+            self._retry_after.pop(user_id, None)
+            return True
+        
+        self.client.execute_nowait("DECR", key)
+        # The message fits once enough of the previous window has slid out of view;
+        # if the current window alone is full, only the next window helps
+        used = current - 1
+        if previous and used < self.max_messages:
+            wait = self.time_window * (1.0 - (self.max_messages - used - 1) / previous) - elapsed
+        else:
+            wait = self.time_window - elapsed
+        self._retry_after[user_id] = max(1, math.ceil(wait))
+        return False
+    
+    async def available(self, user_id: int) -> bool:
+        """Check if user could send a message now without consuming quota"""
+        key, previous_key, elapsed = self._keys(user_id, time.time())
+        try:
+            current, previous = await self.client.pipeline(("GET", key), ("GET", previous_key))
+        except (RedisError, ConnectionError, OSError, asyncio.TimeoutError):
+            return True
+        weight = 1.0 - elapsed / self.time_window
+        return int(previous or 0) * weight + int(current or 0) + 1 <= self.max_messages + 1e-9
+    
+    def get_remaining_time(self, user_id: int) -> int:
+        """Get remaining time in seconds until user can send messages again, as of their last rejected message"""
+        return self._retry_after.pop(user_id, 0)
+
+class RedisMemoryBackend(StorageBackend):
+    """Conversation storage in Redis lists, shared by all replicas"""
+    
+    shared = True
+    
+    def __init__(self, client: RedisClient, max_conversations: int = 20, prefix: str = "libergpt:", ttl: int = 0):
+        """
+        Initialize the Redis backend
+        
+        Args:
+            client: Redis client
+            max_conversations: Conversations kept per user; older entries are trimmed on write
+            prefix: Key prefix
+            ttl: Seconds a user's history is kept after their last message (0 to keep forever)
+        """
+        self.client = client
+        self.max_conversations = max_conversations
+        self.prefix = f"{prefix}memory:"
+        self.ttl = ttl
+    
+    async def start(self) -> None:
+        """Connect to Redis"""
+        await self.client.connect()
+    
+    async def load_user(self, user_id: int, limit: int) -> List[StoredTurn]:
+        """Load the most recent conversations of a user with a single LRANGE"""
+        rows = await self.client.execute("LRANGE", f"{self.prefix}{user_id}", -limit, -1)
+        return [tuple(json.loads(row)) for row in rows]
+    
+    async def write_batch(self, ops: List[WriteOp]) -> None:
+        """Apply a batch of writes atomically in a single round trip"""
+        commands = []
+        touched = set()
+        for op in ops:
+            key = f"{self.prefix}{op[1]}"
+            if op[0] == "append":
+                commands.append(("RPUSH", key, json.dumps(op[2:], ensure_ascii=False)))
+                touched.add(key)
+            elif op[0] == "clear":
+                commands.append(("DEL", key))
+                touched.discard(key)
+        
+        for key in touched:
+            commands.append(("LTRIM", key, -self.max_conversations, -1))
+            if self.ttl:
+                commands.append(("EXPIRE", key, self.ttl))
+        
+        if commands:
+            await self.client.transaction(*commands)
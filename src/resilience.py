@@ -0,0 +1,222 @@
+"""
+Resilience primitives for LiberGPT upstream requests
+Retries with jittered backoff, circuit breaking and latency tracking for hedged requests
+"""
+
+import asyncio
+import logging
+import math
+import random
+import time
+from collections import deque
+from typing import Dict, Optional, Sequence
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+class CircuitOpenError(Exception):
+    """Raised when a request is rejected because the circuit breaker is open"""
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Check whether a failed upstream request is worth retrying
+    
+    Timeouts, connection problems, 5xx responses and 429 are transient;
+    malformed responses and other client errors are not.
+    
+    Args:
+        error: Exception raised by the request
+    
+    Returns:
+        True if the request may succeed when retried
+    """
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+class RetryPolicy:
+    """Bounded retries with decorrelated jitter backoff"""
+    
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0):
+        """
+        Initialize the retry policy
+        
+        Args:
+            max_attempts: Total number of attempts, including the first one
+            base_delay: Smallest delay between attempts in seconds
+            max_delay: Largest delay between attempts in seconds
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self.exhausted = 0
+    
+    def next_delay(self, previous_delay: float) -> float:
+        """
+        Get the delay before the next attempt
+        
+        Args:
+            previous_delay: Delay used before the previous attempt (base_delay for the first retry)
+        
+        Returns:
+            Delay in seconds, drawn uniformly between base_delay and three times the previous delay
+        """
+        return min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, previous_delay * 3)))
+    
+    def get_stats(self) -> Dict:
+        """
+        Get retry statistics
+        
+        Returns:
+            Dictionary with retry counters
+        """
+        return {
+            'retries': self.retries,
+            'retries_exhausted': self.exhausted
+        }
+
+class CircuitBreaker:
+    """Circuit breaker that fails fast while the upstream is down"""
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        Initialize the circuit breaker
+        
+        Args:
+            failure_threshold: Consecutive failures that open the circuit
+            reset_timeout: Seconds the circuit stays open before a trial request is let through
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.opened = 0
+        self.half_opened = 0
+        self.closed = 0
+        self.rejected = 0
+    
+    def before_request(self) -> None:
+        """
+        Check whether a request may be sent
+        
+        Raises:
+            CircuitOpenError: If the circuit is open, or a half-open trial is already running
+        """
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                self.rejected += 1
+                raise CircuitOpenError("Upstream API is unavailable, failing fast")
+            self.state = self.HALF_OPEN
+            self.half_opened += 1
+            logger.info("Circuit breaker half-open, sending a trial request")
+        
+        if self.state == self.HALF_OPEN:
+            if self._trial_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError("Upstream API is recovering, failing fast")
+            self._trial_in_flight = True
+    
+    def record_success(self) -> None:
+        """Record a request that reached a responsive upstream"""
+        self._consecutive_failures = 0
+        self._trial_in_flight = False
+        if self.state != self.CLOSED:
+            self.state = self.CLOSED
+            self.closed += 1
+            logger.info("Circuit breaker closed, upstream API recovered")
+    
+    def record_failure(self) -> None:
+        """Record a request that failed because the upstream is unavailable"""
+        self._consecutive_failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opened += 1
+                logger.warning(f"Circuit breaker opened after {self._consecutive_failures} consecutive failures")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+    
+    def release(self) -> None:
+        """Give up a half-open trial slot without an outcome (e.g. the request was cancelled)"""
+        self._trial_in_flight = False
+    
+    def get_stats(self) -> Dict:
+        """
+        Get circuit breaker statistics
+        
+        Returns:
+            Dictionary with the current state and transition counters
+        """
+        return {
+            'circuit_state': self.state,
+            'circuit_opened': self.opened,
+            'circuit_half_opened': self.half_opened,
+            'circuit_closed': self.closed,
+            'circuit_rejected': self.rejected
+        }
+
+def percentile(sorted_values: Sequence[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of already sorted values
+    
+    Shared by everything that reports latency percentiles, so that /status
+    and the hedging delay agree on the same samples.
+    
+    Args:
+        sorted_values: Non-empty values in ascending order
+        fraction: Percentile as a fraction, e.g. 0.95
+    
+    Returns:
+        The smallest value with at least that fraction of values at or below it
+    """
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+class LatencyTracker:
+    """Rolling window of successful request latencies"""
+    
+    def __init__(self, window_size: int = 200, min_samples: int = 20):
+        """
+        Initialize the latency tracker
+        
+        Args:
+            window_size: Number of recent latencies kept
+            min_samples: Samples required before percentiles are reported
+        """
+        self.min_samples = min_samples
+        self._latencies: deque = deque(maxlen=window_size)
+    
+    def record(self, latency: float, error: Optional[BaseException]) -> None:
+        """
+        Record one upstream request; usable as an API client listener
+        
+        Args:
+            latency: Request duration in seconds
+            error: Exception raised by the request, None on success
+        """
+        if error is None:
+            self._latencies.append(latency)
+    
+    def percentile(self, fraction: float) -> Optional[float]:
+        """
+        Get a latency percentile
+        
+        Args:
+            fraction: Percentile as a fraction, e.g. 0.95
+        
+        Returns:
+            Latency in seconds, or None until enough samples were recorded
+        """
+        if len(self._latencies) < self.min_samples:
+            return None
+        return percentile(sorted(self._latencies), fraction)
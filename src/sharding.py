@@ -0,0 +1,224 @@
+"""
+Multi-process sharding for LiberGPT Telegram bot
+A front process hands each user's updates to one of several worker processes
+"""
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+logger = logging.getLogger(__name__)
+
+class ConsistentHashRing:
+    """Consistent hash ring with virtual nodes"""
+    
+    def __init__(self, nodes: Sequence[Hashable] = (), replicas: int = 100):
+        """
+        Initialize the hash ring
+        
+        Args:
+            nodes: Initial nodes
+            replicas: Virtual nodes per node; more spread keys more evenly
+        """
+        self.replicas = replicas
+        self._hashes: List[int] = []
+        self._nodes: List[Hashable] = []
+        for node in nodes:
+            self.add_node(node)
+    
+    @staticmethod
+    def _hash(value: str) -> int:
+        """Hash a string to a 64-bit position on the ring"""
+        return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+    
+    def add_node(self, node: Hashable) -> None:
+        """Place a node's virtual nodes on the ring"""
+        for replica in range(self.replicas):
+            position = self._hash(f"{node}#{replica}")
+            index = bisect.bisect(self._hashes, position)
+            self._hashes.insert(index, position)
+            self._nodes.insert(index, node)
+    
+    def remove_node(self, node: Hashable) -> None:
+        """Take a node's virtual nodes off the ring"""
+        kept = [(h, n) for h, n in zip(self._hashes, self._nodes) if n != node]
+        self._hashes = [h for h, _ in kept]
+        self._nodes = [n for _, n in kept]
+    
+    def get_node(self, key: Hashable) -> Hashable:
+        """
+        Get the node responsible for a key
+        
+        Args:
+            key: Key to place, e.g. a user ID
+        
+        Returns:
+            The first node clockwise from the key's position
+        
+        Raises:
+            LookupError: If the ring is empty
+        """
+        if not self._hashes:
+            raise LookupError("Hash ring has no nodes")
+        index = bisect.bisect(self._hashes, self._hash(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+class WorkerPool:
+    """Supervised worker processes, each fed its share of updates through its own queue"""
+    
+    def __init__(
+        self,
+        num_workers: int,
+        target: Callable[..., Any],
+        args: Tuple = (),
+        check_interval: float = 1.0
+    ):
+        """
+        Initialize the worker pool
+        
+        Args:
+            num_workers: Number of worker processes
+            target: Module-level function run in each worker as target(index, queue, *args);
+                it must process queued update dicts until it receives None
+            args: Extra arguments passed to target
+            check_interval: Seconds between liveness checks of the workers
+        """
+        if num_workers < 1:
+            raise ValueError("num_workers must be a positive integer")
+        
+        self.num_workers = num_workers
+        self.target = target
+        self.args = args
+        self.check_interval = check_interval
+        # Spawned workers start from a clean interpreter rather than a copy of a
+        # process that already has an event loop and HTTP client threads
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue() for _ in range(num_workers)]
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * num_workers
+        self.ring = ConsistentHashRing(range(num_workers))
+        self._supervisor: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.dispatched = 0
+        self.restarts = 0
+    
+    def _spawn(self, index: int) -> None:
+        """Start the worker process for one shard"""
+        process = self._context.Process(
+            target=self.target,
+            args=(index, self._queues[index], *self.args),
+            name=f"libergpt-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        self._processes[index] = process
+        logger.info(f"Started worker {index} (pid {process.pid})")
+    
+    def worker_for(self, update: object) -> int:
+        """
+        Get the worker that owns an update
+        
+        Args:
+            update: Update to place
+        
+        Returns:
+            Worker index; updates without a user or chat go to worker 0
+        """
+        key = None
+        if isinstance(update, Update):
+            if update.effective_user:
+                key = update.effective_user.id
+            elif update.effective_chat:
+                key = update.effective_chat.id
+        if key is None:
+            return 0
+        return self.ring.get_node(key)
+    
+    def dispatch(self, update: Update) -> int:
+        """
+        Hand an update to the worker that owns its user
+        
+        Args:
+            update: Update to dispatch
+        
+        Returns:
+            Index of the worker the update was sent to
+        """
+        index = self.worker_for(update)
+        # Queue.put hands the pickling and pipe write to a feeder thread, so this does not block
+        self._queues[index].put(update.to_dict())
+        self.dispatched += 1
+        return index
+    
+    async def handle_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Dispatch handler for the front process's application"""
+        self.dispatch(update)
+    
+    async def _supervise(self) -> None:
+        """Restart workers that died"""
+        while not self._stopping:
+            await asyncio.sleep(self.check_interval)
+            for index, process in enumerate(self._processes):
+                if self._stopping or process is None or process.is_alive():
+                    continue
+                self.restarts += 1
+                logger.error(f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}, restarting")
+                process.close()
+                # The queue belongs to the pool, so updates dispatched meanwhile are kept
+                self._spawn(index)
+    
+    def start(self) -> None:
+        """Start all workers and the supervisor"""
+        self._stopping = False
+        for index in range(self.num_workers):
+            self._spawn(index)
+        self._supervisor = asyncio.create_task(self._supervise())
+    
+    async def stop(self, timeout: float = 30.0) -> None:
+        """
+        Ask the workers to finish their queued updates and exit
+        
+        Args:
+            timeout: Seconds to wait for each worker before terminating it
+        """
+        self._stopping = True
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            try:
+                await self._supervisor
+            except asyncio.CancelledError:
+                pass
+            self._supervisor = None
+        
+        for queue in self._queues:
+            queue.put(None)
+        
+        loop = asyncio.get_running_loop()
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"Worker {index} did not stop in time, terminating it")
+                process.terminate()
+                await loop.run_in_executor(None, process.join)
+            self._processes[index] = None
+    
+    def get_stats(self) -> Dict:
+        """
+        Get worker pool statistics
+        
+        Returns:
+            Dictionary with the worker count, liveness and counters
+        """
+        return {
+            'workers': self.num_workers,
+            'alive_workers': sum(1 for p in self._processes if p is not None and p.is_alive()),
+            'dispatched': self.dispatched,
+            'restarts': self.restarts
+        }
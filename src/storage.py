@@ -0,0 +1,268 @@
+"""
+Storage backends for LiberGPT conversation memory
+Persist conversation history behind a write-behind buffer so the event loop never waits on disk
+"""
+
+import asyncio
+import logging
+import sqlite3
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# A stored conversation turn: (timestamp, user_message, bot_response)
+StoredTurn = Tuple[float, str, str]
+
+# A pending write: ("append", user_id, timestamp, user_message, bot_response) or ("clear", user_id)
+WriteOp = tuple
+
+class StorageBackend(ABC):
+    """Interface for conversation memory storage backends"""
+    
+    # Whether stored conversations survive a restart of the process
+    persistent = True
+    
+    # Whether other processes write to the same store, so cached history may be stale
+    shared = False
+    
+    async def start(self) -> None:
+        """Open the backend"""
+    
+    async def close(self) -> None:
+        """Close the backend"""
+    
+    @abstractmethod
+    async def load_user(self, user_id: int, limit: int) -> List[StoredTurn]:
+        """
+        Load the most recent conversations of a user
+        
+        Args:
+            user_id: Telegram user ID
+            limit: Maximum number of conversations to load
+        
+        Returns:
+            Conversations ordered from oldest to newest
+        """
+    
+    @abstractmethod
+    async def write_batch(self, ops: List[WriteOp]) -> None:
+        """
+        Apply a batch of writes atomically and in order
+        
+        Args:
+            ops: Pending append and clear operations
+        """
+
+class InMemoryBackend(StorageBackend):
+    """Default backend that keeps conversations only in process memory"""
+    
+    persistent = False
+    
+    async def load_user(self, user_id: int, limit: int) -> List[StoredTurn]:
+        """Nothing is stored outside the hot in-memory tier"""
+        return []
+    
+    async def write_batch(self, ops: List[WriteOp]) -> None:
+        """Nothing to persist"""
+
+class SQLiteBackend(StorageBackend):
+    """SQLite backend in WAL mode; all queries run on one dedicated thread"""
+    
+    def __init__(self, path: str = "libergpt.db", max_conversations: int = 20):
+        """
+        Initialize the SQLite backend
+        
+        Args:
+            path: Database file path
+            max_conversations: Conversations kept per user; older rows are pruned on write
+        """
+        self.path = path
+        self.max_conversations = max_conversations
+        self._connection: Optional[sqlite3.Connection] = None
+        # A single worker thread serialises access to the connection
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="libergpt-sqlite")
+    
+    async def _run(self, func, *args):
+        """Run a blocking database function on the database thread"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+    
+    def _open(self) -> None:
+        """Open the database and create the schema"""
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "user_id INTEGER NOT NULL, "
+            "timestamp REAL NOT NULL, "
+            "user_message TEXT NOT NULL, "
+            "bot_response TEXT NOT NULL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_conversations_user ON conversations (user_id, id)"
+        )
+        connection.commit()
+        self._connection = connection
+    
+    async def start(self) -> None:
+        """Open the database file"""
+        await self._run(self._open)
+        logger.info(f"SQLite memory backend opened at {self.path}")
+    
+    async def close(self) -> None:
+        """Close the database file"""
+        if self._connection is not None:
+            await self._run(self._connection.close)
+            self._connection = None
+        self._executor.shutdown(wait=True)
+    
+    def _load_user(self, user_id: int, limit: int) -> List[StoredTurn]:
+        """Blocking part of load_user()"""
+        rows = self._connection.execute(
+            "SELECT timestamp, user_message, bot_response FROM conversations "
+            "WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+        rows.reverse()
+        return rows
+    
+    async def load_user(self, user_id: int, limit: int) -> List[StoredTurn]:
+        """Load the most recent conversations of a user from disk"""
+        return await self._run(self._load_user, user_id, limit)
+    
+    def _write_batch(self, ops: List[WriteOp]) -> None:
+        """Blocking part of write_batch()"""
+        touched: Set[int] = set()
+        with self._connection:
+            for op in ops:
+                if op[0] == "append":
+                    self._connection.execute(
+                        "INSERT INTO conversations (user_id, timestamp, user_message, bot_response) "
+                        "VALUES (?, ?, ?, ?)",
+                        op[1:]
+                    )
+                    touched.add(op[1])
+                elif op[0] == "clear":
+                    self._connection.execute("DELETE FROM conversations WHERE user_id = ?", (op[1],))
+                    touched.discard(op[1])
+            
+            # Keep only the newest max_conversations rows of every user written to
+            for user_id in touched:
+                self._connection.execute(
+                    "DELETE FROM conversations WHERE user_id = ? AND id <= ("
+                    "SELECT id FROM conversations WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                    (user_id, user_id, self.max_conversations)
+                )
+    
+    async def write_batch(self, ops: List[WriteOp]) -> None:
+        """Apply a batch of writes in a single transaction"""
+        await self._run(self._write_batch, ops)
+
+class WriteBehindWriter:
+    """Buffers writes and group-commits them to a backend from a background task"""
+    
+    def __init__(self, backend: StorageBackend, flush_interval: float = 1.0, max_batch: int = 500, max_pending: int = 10000):
+        """
+        Initialize the writer
+        
+        Args:
+            backend: Backend receiving the writes
+            flush_interval: Seconds between group commits
+            max_batch: Pending writes that trigger an early commit
+            max_pending: Writes kept for retry while the backend fails; the oldest
+                are dropped beyond this, so an unwritable store cannot exhaust memory
+        """
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self._pending: List[WriteOp] = []
+        self._pending_users: Set[int] = set()
+        # Users whose writes are being committed right now
+        self._flushing_users: Set[int] = set()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.batches_written = 0
+        self.ops_written = 0
+        self.write_errors = 0
+        self.ops_dropped = 0
+    
+    def enqueue(self, op: WriteOp) -> None:
+        """
+        Buffer a write without blocking
+        
+        Args:
+            op: Append or clear operation
+        """
+        self._pending.append(op)
+        self._pending_users.add(op[1])
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+    
+    def has_pending(self, user_id: int) -> bool:
+        """Check whether writes for a user are buffered or still being committed"""
+        return user_id in self._pending_users or user_id in self._flushing_users
+    
+    async def flush(self) -> None:
+        """Commit all buffered writes now"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            
+            ops = self._pending
+            self._flushing_users = self._pending_users
+            self._pending = []
+            self._pending_users = set()
+            try:
+                await self.backend.write_batch(ops)
+            except Exception as e:
+                # Keep the writes for the next attempt, ahead of anything buffered meanwhile
+                self.write_errors += 1
+                logger.error(f"Failed to write {len(ops)} memory operations: {e}")
+                self._pending = ops + self._pending
+                self._pending_users.update(self._flushing_users)
+                dropped = len(self._pending) - self.max_pending
+                if dropped > 0:
+                    self._pending = self._pending[dropped:]
+                    self._pending_users = {op[1] for op in self._pending}
+                    self.ops_dropped += dropped
+                    logger.error(f"Dropped the {dropped} oldest memory operations; {self.ops_dropped} dropped in total")
+                return
+            finally:
+                self._flushing_users = set()
+            
+            self.batches_written += 1
+            self.ops_written += len(ops)
+            logger.debug(f"Committed {len(ops)} memory operations")
+    
+    async def _run(self) -> None:
+        """Commit buffered writes every flush_interval, or earlier when a batch fills up"""
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+    
+    def start(self) -> None:
+        """Start the background commit task"""
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        """Stop the background task and commit whatever is still buffered"""
+        # Let the task finish its current commit rather than cancelling it mid-write
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
@@ -0,0 +1,108 @@
+"""
+Update trace recording for LiberGPT Telegram bot
+Records anonymised arrival timing of chat messages for replay in load tests
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import List, Optional
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+class TraceRecorder:
+    """
+    Appends one JSON line per chat message to a trace file
+    
+    Each line holds the arrival time (Unix seconds), a keyed hash of the user
+    ID and the message length; message text is never recorded. Lines
+    are buffered and written from a worker thread so the event loop never
+    waits for the disk.
+    """
+    
+    def __init__(self, path: str, salt: str = "", flush_interval: float = 5.0):
+        """
+        Initialize the recorder
+        
+        Args:
+            path: JSONL file to append to
+            salt: Key for hashing user IDs; a random one per process if empty, so
+                traces cannot be joined with each other or with Telegram IDs
+            flush_interval: Seconds between writes of buffered lines
+        """
+        self.path = path
+        self._key = salt.encode("utf-8") if salt else os.urandom(16)
+        self.flush_interval = flush_interval
+        self._buffer: List[str] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self.recorded = 0
+    
+    def anonymise(self, user_id: int) -> str:
+        """Map a user ID to a stable pseudonym"""
+        return hashlib.blake2b(str(user_id).encode("utf-8"), key=self._key, digest_size=8).hexdigest()
+    
+    def record(self, update: object) -> None:
+        """
+        Record a plain text message as it arrives
+        
+        Called by the update processor before the update waits for its user's
+        earlier updates or a worker slot, so the trace keeps the real bursts.
+        
+        Args:
+            update: Incoming update; anything but a text message from a user is ignored
+        """
+        if not isinstance(update, Update) or not update.effective_user:
+            return
+        message = update.message
+        if message is None or not message.text or message.text.startswith('/'):
+            return
+        entry = {
+            't': round(time.time(), 3),
+            'user': self.anonymise(update.effective_user.id),
+            'chars': len(message.text)
+        }
+        self._buffer.append(json.dumps(entry))
+        self.recorded += 1
+    
+    def _write(self, lines: List[str]) -> None:
+        """Append lines to the trace file"""
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+    
+    async def flush(self) -> None:
+        """Write buffered lines from a worker thread"""
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, lines)
+        except OSError as e:
+            logger.error(f"Failed to write {len(lines)} trace lines: {e}")
+    
+    async def _flush_periodically(self) -> None:
+        """Flush the buffer every flush_interval seconds"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+    
+    def start(self) -> None:
+        """Start flushing in the background"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_periodically())
+            logger.info(f"Recording update trace to {self.path}")
+    
+    async def close(self) -> None:
+        """Stop the background flush and write what is left"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
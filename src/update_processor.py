@@ -0,0 +1,129 @@
+"""
+Concurrent update processing for LiberGPT Telegram bot
+Runs updates from different users in parallel while keeping each user's updates in order
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from .debounce import MessageDebouncer
+from .trace import TraceRecorder
+
+logger = logging.getLogger(__name__)
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Update processor with a global concurrency cap and per-user ordering"""
+    
+    def __init__(
+        self,
+        max_concurrent_updates: int = 32,
+        max_pending_updates: int = 1024,
+        debouncer: Optional[MessageDebouncer] = None,
+        trace: Optional[TraceRecorder] = None
+    ):
+        """
+        Initialize the update processor
+        
+        Args:
+            max_concurrent_updates: Maximum number of updates whose handlers run at the same time
+            max_pending_updates: Maximum number of updates accepted from the update queue,
+                including those waiting behind an earlier update from the same user
+            debouncer: Optional debouncer merging quick successive messages from a user
+            trace: Optional recorder of message arrivals for load test replay
+        """
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates must be a positive integer")
+        
+        # The base class semaphore only bounds how many updates are admitted. The real
+        # concurrency cap is applied after the per-user lock so that a user with a backlog
+        # of messages does not hold worker slots while waiting for their own earlier updates.
+        super().__init__(max(max_pending_updates, max_concurrent_updates, 2))
+        self.max_handler_concurrency = max_concurrent_updates
+        self._workers = asyncio.Semaphore(max_concurrent_updates)
+        # Dictionary mapping ordering key to [lock, number of updates holding or waiting on it]
+        self._user_locks: Dict[int, list] = {}
+        self.debouncer = debouncer
+        self.trace = trace
+    
+    @staticmethod
+    def _get_ordering_key(update: object) -> Optional[int]:
+        """
+        Get the key used to order updates
+        
+        Args:
+            update: The update to be processed
+        
+        Returns:
+            User ID (or chat ID when there is no user), None if the update is not ordered
+        """
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        """
+        Process an update after all earlier updates from the same user have finished
+        
+        Args:
+            update: The update to be processed
+            coroutine: The coroutine that will be awaited to process the update
+        """
+        # Arrival time is taken before any waiting, and before a merge drops the update
+        if self.trace is not None:
+            self.trace.record(update)
+        
+        key = self._get_ordering_key(update)
+        if key is None:
+            async with self._workers:
+                await coroutine
+            return
+        
+        # Merge before queueing on the user's lock, so fragments arriving while an
+        # earlier answer is still being generated join the next burst
+        if self.debouncer is not None and self.debouncer.add(key, update):
+            # Merged into an earlier message; close the coroutine instead of running it
+            coroutine.close()
+            return
+        
+        # asyncio.Lock wakes waiters in FIFO order, and updates reach this point in the
+        # order they were fetched, so each user's updates run in arrival order.
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        
+        try:
+            async with entry[0]:
+                if self.debouncer is not None:
+                    await self.debouncer.wait(key, update)
+                async with self._workers:
+                    await coroutine
+        finally:
+            if self.debouncer is not None:
+                self.debouncer.discard(key, update)
+            entry[1] -= 1
+            if entry[1] == 0:
+                # Drop the lock once nobody holds or waits on it so the map stays bounded
+                del self._user_locks[key]
+    
+    async def initialize(self) -> None:
+        """Log the processor configuration"""
+        logger.info(f"Update processor initialized with max {self.max_handler_concurrency} concurrent updates")
+    
+    async def shutdown(self) -> None:
+        """Forget per-user ordering state"""
+        self._user_locks.clear()
+        if self.debouncer is not None:
+            self.debouncer.clear()
+    
+    @property
+    def active_users(self) -> int:
+        """Number of users with an update being processed or waiting"""
+        return len(self._user_locks)
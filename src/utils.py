@@ -2,56 +2,108 @@
 Utility functions for LiberGPT bot
 """
 
+import copy
 import time
+import math
 import html
+import json
+import queue
+import atexit
 import logging
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 from typing import Dict, List, Optional
-from collections import defaultdict, deque
 
 logger = logging.getLogger(__name__)
 
 class RateLimiter:
-    """Simple rate limiter for user messages"""
+    """
+    Per-user rate limiter using the generic cell rate algorithm (GCRA)
     
-    def __init__(self, max_messages: int = 10, time_window: int = 60):
+    Allows bursts of up to max_messages and refills one message every
+    time_window / max_messages seconds. Each user costs a single float: the
+    theoretical arrival time (TAT) of their next message.
+    """
+    
+    def __init__(self, max_messages: int = 10, time_window: int = 60, sweep_interval: float = 300.0):
         self.max_messages = max_messages
         self.time_window = time_window
-        self.user_messages: Dict[int, deque] = defaultdict(deque)
+        self.sweep_interval = sweep_interval
+        # Seconds of quota one message consumes
+        self._emission_interval = time_window / max_messages
+        # Dictionary mapping user_id to theoretical arrival time
+        self._tat: Dict[int, float] = {}
+        self._next_sweep = time.monotonic() + sweep_interval
+    
+    def _sweep(self, now: float) -> None:
+        """Forget users whose quota has fully refilled"""
+        self._next_sweep = now + self.sweep_interval
+        idle = [user_id for user_id, tat in self._tat.items() if tat <= now]
+        for user_id in idle:
+            del self._tat[user_id]
+        if idle:
+            logger.debug(f"Rate limiter dropped {len(idle)} idle users")
     
     def is_allowed(self, user_id: int) -> bool:
-        """Check if user is allowed to send a message"""
-        now = time.time()
-        user_queue = self.user_messages[user_id]
-        
-        # Remove old messages outside the time window
-        while user_queue and now - user_queue[0] > self.time_window:
-            user_queue.popleft()
+        """Check if user is allowed to send a message, consuming one message of quota if so"""
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
         
-        # Check if user has exceeded the limit
-        if len(user_queue) >= self.max_messages:
+        new_tat = max(self._tat.get(user_id, now), now) + self._emission_interval
+        # Small tolerance so float rounding never rejects the last message of a burst
+        if new_tat - now > self.time_window + 1e-9:
             return False
         
-        # Add current message timestamp
-        user_queue.append(now)
+        self._tat[user_id] = new_tat
         return True
     
+    async def acquire(self, user_id: int) -> bool:
+        """Awaitable form of is_allowed(), matching RedisRateLimiter"""
+        return self.is_allowed(user_id)
+    
+    async def available(self, user_id: int) -> bool:
+        """Awaitable form of peek(), matching RedisRateLimiter"""
+        return self.peek(user_id)
+    
+    def peek(self, user_id: int) -> bool:
+        """Check if user could send a message now without consuming quota"""
+        return self.remaining(user_id) > 0
+    
+    def remaining(self, user_id: int) -> int:
+        """Get the number of messages user can send right now without consuming quota"""
+        tat = self._tat.get(user_id)
+        if tat is None:
+            return self.max_messages
+        
+        used = max(0.0, tat - time.monotonic())
+        return max(0, int((self.time_window - used) / self._emission_interval + 1e-9))
+    
     def get_remaining_time(self, user_id: int) -> int:
         """Get remaining time in seconds until user can send messages again"""
-        if user_id not in self.user_messages:
+        tat = self._tat.get(user_id)
+        if tat is None:
             return 0
         
-        user_queue = self.user_messages[user_id]
-        if len(user_queue) < self.max_messages:
-            return 0
-        
-        oldest_message = user_queue[0]
-        return max(0, int(self.time_window - (time.time() - oldest_message)))
+        wait = tat + self._emission_interval - self.time_window - time.monotonic()
+        return max(0, math.ceil(wait))
+    
+    @property
+    def tracked_users(self) -> int:
+        """Number of users with quota currently in use"""
+        return len(self._tat)
+
+# Characters MarkdownV2 reserves outside entities; the backslash comes first so the
+# escapes added for the others are not escaped again
+_MARKDOWN_SPECIAL_CHARS = '\\_*[]()~`>#+-=|{}.!'
 
 def escape_markdown(text: str) -> str:
     """Escape markdown special characters"""
-    escape_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-    for char in escape_chars:
-        text = text.replace(char, f'\\{char}')
+    # str.replace runs in C, which beats str.translate and re.sub; skipping
+    # characters that do not occur saves building a copy for each of them
+    for char in _MARKDOWN_SPECIAL_CHARS:
+        if char in text:
+            text = text.replace(char, f'\\{char}')
     return text
 
 def truncate_message(text: str, max_length: int = 4096) -> str:
@@ -70,6 +122,64 @@ def truncate_message(text: str, max_length: int = 4096) -> str:
     
     return truncated + "..."
 
+# Preferred places to split a long message, best first: paragraphs, lines, sentences, words
+_SPLIT_SEPARATORS = ("\n\n", "\n", ". ", "! ", "? ", "; ", " ")
+_CODE_FENCE = "```"
+
+def _open_code_fence(text: str) -> Optional[str]:
+    """Get the opening fence line of a code block left open at the end of text, if any"""
+    fence = None
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if stripped.startswith(_CODE_FENCE):
+            fence = None if fence is not None else stripped
+    return fence
+
+def _find_split_point(text: str, limit: int) -> int:
+    """Find where to end a chunk of at most limit characters, preferring natural boundaries"""
+    for separator in _SPLIT_SEPARATORS:
+        index = text.rfind(separator, 0, limit - len(separator) + 1)
+        # A boundary in the first half of the window would leave a very short chunk
+        if index >= limit // 2:
+            return index + len(separator)
+    return limit
+
+def split_message(text: str, max_length: int = 4096) -> List[str]:
+    """
+    Split a long message into chunks that each fit in one Telegram message
+    
+    Chunks end on paragraph, line, sentence or word boundaries where possible.
+    A code block cut in two is closed at the end of one chunk and reopened,
+    with its language, at the start of the next.
+    
+    Args:
+        text: Message text
+        max_length: Maximum length of a chunk
+    
+    Returns:
+        Chunks in order; a single chunk if the text already fits
+    """
+    chunks = []
+    rest = text
+    while len(rest) > max_length:
+        # Keep room to close a code block that the cut might fall inside
+        limit = max_length - len(_CODE_FENCE) - 1 if _CODE_FENCE in rest else max_length
+        cut = _find_split_point(rest, limit)
+        chunk, rest = rest[:cut].rstrip(), rest[cut:]
+        
+        fence = _open_code_fence(chunk)
+        if fence is not None:
+            chunk += "\n" + _CODE_FENCE
+            rest = fence + "\n" + rest.lstrip("\n")
+        else:
+            rest = rest.lstrip()
+        if chunk:
+            chunks.append(chunk)
+    
+    if rest or not chunks:
+        chunks.append(rest)
+    return chunks
+
 def format_error_message(error: Exception) -> str:
     """Format error message for user display"""
     error_messages = {
@@ -77,6 +187,10 @@ def format_error_message(error: Exception) -> str:
         "TimeoutError": "⏱️ Request timed out. Please try again.",
         "JSONDecodeError": "📝 Invalid response format. Please try again.",
         "HTTPError": "🌐 Server error. Please try again later.",
+        "ClientResponseError": "🌐 Server error. Please try again later.",
+        "CircuitOpenError": "🚧 The AI service is temporarily unavailable. Please try again in a minute.",
+        "QueueFullError": "🚦 I'm handling a lot of requests right now. Please try again in a minute.",
+        "QueueTimeoutError": "🚦 The queue is moving slowly right now. Please try again in a minute.",
     }
     
     error_type = type(error).__name__
@@ -86,19 +200,154 @@ def sanitize_html(text: str) -> str:
     """Sanitize HTML content for safe display"""
     return html.escape(text)
 
-def setup_logging(debug: bool = False):
-    """Setup logging configuration"""
+# Renders tracebacks before records are queued; handlers apply their own formats later
+_EXCEPTION_FORMATTER = logging.Formatter()
+
+# Attributes every LogRecord has; anything else was passed through extra= and goes into JSON output
+_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line, including fields passed through extra="""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep a fraction of the records marked with a sample_key
+    
+    Records logged with extra={'sample_key': ...} at INFO or below are kept
+    when the key hashes below the sample rate, so all records sharing a key
+    (e.g. one update's logs) are kept or dropped together. Unmarked records
+    and warnings always pass.
+    """
+    
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, 'sample_key', None)
+        if key is None or self.rate >= 1 or record.levelno > logging.INFO:
+            return True
+        # Multiplicative hashing spreads consecutive IDs evenly over [0, 1)
+        return (hash(key) * 2654435761 % 2**32) / 2**32 < self.rate
+
+class _DeferredQueueHandler(QueueHandler):
+    """Queue handler that leaves the final formatting to the listener thread"""
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Like QueueHandler.prepare, merge the arguments and render the traceback now, so
+        # objects changed after the call are logged as they were and no frames are kept
+        # alive in the queue; unlike it, leave the format string to the listener's handlers
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _EXCEPTION_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class _QueueListener(QueueListener):
+    """Queue listener that may be stopped more than once, e.g. by its owner and at exit"""
+    
+    def stop(self) -> None:
+        if self._thread is not None:
+            super().stop()
+
+# Listener started by the last setup_logging() call in async mode
+_listener: Optional[_QueueListener] = None
+_atexit_registered = False
+
+def _stop_listener() -> None:
+    """Stop the current queue listener, flushing what is queued, and close its handlers"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+def setup_logging(
+    debug: bool = False,
+    log_file: str = 'libergpt.log',
+    json_format: bool = False,
+    async_mode: bool = True,
+    max_bytes: int = 10 * 1024 * 1024,
+    backup_count: int = 5,
+    rotate_when: str = '',
+    sample_rate: float = 1.0,
+    console: bool = True
+) -> Optional[QueueListener]:
+    """
+    Setup logging configuration
+    
+    Args:
+        debug: Whether to log at DEBUG level
+        log_file: File to log to besides stderr, empty to log to stderr only
+        json_format: Whether to write one JSON object per line instead of plain text
+        async_mode: Whether to hand records to a background thread, so slow disks
+            never block the event loop
+        max_bytes: Size at which the log file is rotated (0 to never rotate by size)
+        backup_count: Rotated files to keep
+        rotate_when: Rotate by time instead of size, e.g. "midnight" or "H"
+        sample_rate: Fraction of per-message INFO logs to keep
+        console: Whether to log to stderr
+    
+    Returns:
+        The started queue listener in async mode, None otherwise; a listener
+        from an earlier call is stopped
+    """
+    global _listener, _atexit_registered
     level = logging.DEBUG if debug else logging.INFO
     
-    logging.basicConfig(
-        level=level,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler('libergpt.log'),
-            logging.StreamHandler()
-        ]
-    )
+    if json_format:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    
+    handlers: List[logging.Handler] = [logging.StreamHandler()] if console else []
+    if log_file:
+        if rotate_when:
+            handlers.append(TimedRotatingFileHandler(log_file, when=rotate_when, backupCount=backup_count, encoding='utf-8'))
+        else:
+            handlers.append(RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    _stop_listener()
+    if async_mode:
+        queue_handler = _DeferredQueueHandler(queue.SimpleQueue())
+        _listener = _QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        if not _atexit_registered:
+            # Flush what is still queued when the process exits
+            atexit.register(_stop_listener)
+            _atexit_registered = True
+        handlers = [queue_handler]
+    
+    # Sample before records are queued, so dropped ones cost the event loop nothing more
+    sampling = SamplingFilter(sample_rate)
+    for handler in handlers:
+        handler.addFilter(sampling)
+    
+    logging.basicConfig(level=level, handlers=handlers, force=True)
     
     # Set specific loggers
     logging.getLogger('httpx').setLevel(logging.WARNING)
     logging.getLogger('telegram').setLevel(logging.INFO)
+    return _listener
@@ -0,0 +1,116 @@
+"""
+Webhook ingestion for LiberGPT Telegram bot
+Receives updates from Telegram over HTTP instead of long polling
+"""
+
+import hmac
+import json
+import logging
+from typing import Optional
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+class WebhookServer:
+    """aiohttp server that verifies webhook requests and feeds them to the application"""
+    
+    def __init__(
+        self,
+        application: Application,
+        listen: str = "0.0.0.0",
+        port: int = 8080,
+        path: str = "/telegram",
+        secret_token: Optional[str] = None
+    ):
+        """
+        Initialize the webhook server
+        
+        Args:
+            application: Application whose update queue receives the updates
+            listen: Address to bind to
+            port: Port to bind to
+            path: URL path Telegram posts updates to
+            secret_token: Secret Telegram sends in every request, None to accept any request
+        """
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self._runner: Optional[web.AppRunner] = None
+        self.updates_received = 0
+        self.requests_rejected = 0
+    
+    def make_app(self) -> web.Application:
+        """
+        Build the aiohttp application
+        
+        Returns:
+            Application with the webhook route and a health endpoint for load balancers
+        """
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/healthz", self.handle_health)
+        return app
+    
+    def _is_authorized(self, request: web.Request) -> bool:
+        """Check the secret token header in constant time"""
+        if not self.secret_token:
+            return True
+        received = request.headers.get(SECRET_TOKEN_HEADER, "")
+        return hmac.compare_digest(received.encode("utf-8"), self.secret_token.encode("utf-8"))
+    
+    async def handle_update(self, request: web.Request) -> web.Response:
+        """
+        Accept one update posted by Telegram
+        
+        Args:
+            request: Incoming webhook request
+        
+        Returns:
+            200 once the update is queued, 403 for a wrong secret, 400 for a malformed body
+        """
+        if not self._is_authorized(request):
+            self.requests_rejected += 1
+            logger.warning(f"Rejected webhook request from {request.remote} with a wrong secret token")
+            return web.Response(status=403)
+        
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.application.bot)
+        except (json.JSONDecodeError, TypeError, ValueError, KeyError) as e:
+            self.requests_rejected += 1
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            return web.Response(status=400)
+        
+        if update is None:
+            self.requests_rejected += 1
+            return web.Response(status=400)
+        
+        # Answer right away; the update processor picks the update up from the queue
+        await self.application.update_queue.put(update)
+        self.updates_received += 1
+        return web.Response(status=200)
+    
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """Report that this replica is accepting updates"""
+        return web.Response(text="ok")
+    
+    async def start(self) -> None:
+        """Start listening for webhook requests"""
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.listen, self.port)
+        await site.start()
+        logger.info(f"Webhook server listening on {self.listen}:{self.port}{self.path}")
+    
+    async def stop(self) -> None:
+        """Stop accepting webhook requests"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
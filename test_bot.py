@@ -4,8 +4,11 @@ Test script for LiberGPT bot components
 """
 
 import sys
+import time
+import random
 import asyncio
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 # Add src directory to Python path
 sys.path.insert(0, str(Path(__file__).parent / "src"))
@@ -33,14 +36,1111 @@ async def test_api_client():
                 print("✅ API Client test passed!")
             else:
                 print("⚠️  API appears to be down")
-                
+    
     except Exception as e:
         print(f"❌ API Client test failed: {e}")
 
+async def check_api_session_lifecycle():
+    """Check that the API client keeps one pooled session until closed"""
+    print("\n🧪 Testing API Session Lifecycle...")
+    
+    from src.api_client import LiberGPTAPIClient
+    
+    api_client = LiberGPTAPIClient(
+        base_url="https://api.example.com",
+        pool_limit=10,
+        pool_limit_per_host=5
+    )
+    
+    await api_client.start()
+    session = api_client.session
+    assert session is not None and not session.closed
+    assert session.connector.limit == 10
+    assert session.connector.limit_per_host == 5
+    
+    # Starting again must reuse the same pooled session
+    await api_client.start()
+    assert api_client.session is session
+    
+    await api_client.close()
+    assert api_client.session is None
+    assert session.closed
+    print("✅ API Session Lifecycle test passed!")
+
+def test_api_session_lifecycle():
+    """Test the pooled API session lifecycle"""
+    asyncio.run(check_api_session_lifecycle())
+
+async def start_local_api(handler):
+    """Serve a POST handler on a random local port, returning the runner and its URL"""
+    from aiohttp import web
+    
+    app = web.Application()
+    app.router.add_post("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/"
+
+class LocalRedisServer:
+    """
+    In-process stand-in for a Redis server
+    
+    Implements only the commands src/redis_state.py uses, without persistence.
+    """
+    
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        """
+        Initialize the server
+        
+        Args:
+            host: Address to bind to
+            port: Port to bind to, 0 for any free port
+        """
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+        # Dictionary mapping key to [value, expires_at or None]
+        self._data: Dict[bytes, list] = {}
+        self.commands_received = 0
+        self.batches_received = 0
+    
+    @property
+    def url(self) -> str:
+        """URL to pass to RedisClient"""
+        return f"redis://{self.host}:{self.port}/0"
+    
+    async def start(self) -> None:
+        """Start listening"""
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+    
+    async def stop(self) -> None:
+        """Stop listening"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+    
+    def _get(self, key: bytes):
+        """Get a live value, dropping it if it expired"""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        return entry[0]
+    
+    def _set(self, key: bytes, value) -> None:
+        """Store a value, keeping the key's expiry"""
+        entry = self._data.get(key)
+        if entry is None or self._get(key) is None:
+            self._data[key] = [value, None]
+        else:
+            entry[0] = value
+    
+    @staticmethod
+    def _slice(length: int, start: int, stop: int) -> Tuple[int, int]:
+        """Turn Redis inclusive, possibly negative, indexes into a Python slice"""
+        if start < 0:
+            start = max(0, length + start)
+        if stop < 0:
+            stop = length + stop
+        return start, min(stop, length - 1) + 1
+    
+    # Commands _run implements
+    COMMANDS = frozenset({
+        b"PING", b"AUTH", b"SELECT", b"GET", b"SET", b"INCR", b"DECR", b"PEXPIRE", b"EXPIRE",
+        b"DEL", b"RPUSH", b"LRANGE", b"LTRIM", b"LLEN"
+    })
+    
+    def _run(self, args: List[bytes]) -> bytes:
+        """Run one command and encode its reply"""
+        name = args[0].upper()
+        if name in (b"PING", b"AUTH", b"SELECT"):
+            return b"+OK\r\n" if name != b"PING" else b"+PONG\r\n"
+        if name == b"GET":
+            value = self._get(args[1])
+            return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+        if name == b"SET":
+            self._data[args[1]] = [args[2], None]
+            return b"+OK\r\n"
+        if name in (b"INCR", b"DECR"):
+            value = int(self._get(args[1]) or 0) + (1 if name == b"INCR" else -1)
+            self._set(args[1], str(value).encode())
+            return b":%d\r\n" % value
+        if name in (b"PEXPIRE", b"EXPIRE"):
+            if self._get(args[1]) is None:
+                return b":0\r\n"
+            seconds = int(args[2]) / (1000 if name == b"PEXPIRE" else 1)
+            self._data[args[1]][1] = time.monotonic() + seconds
+            return b":1\r\n"
+        if name == b"DEL":
+            removed = sum(1 for key in args[1:] if self._get(key) is not None and self._data.pop(key))
+            return b":%d\r\n" % removed
+        if name == b"RPUSH":
+            items = self._get(args[1])
+            if items is None:
+                items = []
+                self._data[args[1]] = [items, None]
+            items.extend(args[2:])
+            return b":%d\r\n" % len(items)
+        if name == b"LRANGE":
+            items = self._get(args[1]) or []
+            start, stop = self._slice(len(items), int(args[2]), int(args[3]))
+            selected = items[start:stop]
+            return b"*%d\r\n" % len(selected) + b"".join(b"$%d\r\n%s\r\n" % (len(i), i) for i in selected)
+        if name == b"LTRIM":
+            items = self._get(args[1])
+            if items is not None:
+                start, stop = self._slice(len(items), int(args[2]), int(args[3]))
+                items[:] = items[start:stop]
+            return b"+OK\r\n"
+        if name == b"LLEN":
+            return b":%d\r\n" % len(self._get(args[1]) or [])
+        return b"-ERR unknown command '%s'\r\n" % name
+    
+    @staticmethod
+    def _split_commands(data: bytes) -> Tuple[List[List[bytes]], bytes]:
+        """Parse the complete RESP commands at the start of data, returning them and the rest"""
+        commands = []
+        pos = 0
+        while pos < len(data):
+            end = data.find(b"\r\n", pos)
+            if end < 0:
+                break
+            cursor = end + 2
+            args = []
+            for _ in range(int(data[pos + 1:end])):
+                end = data.find(b"\r\n", cursor)
+                if end < 0:
+                    return commands, data[pos:]
+                start = end + 2
+                length = int(data[cursor + 1:end])
+                if len(data) < start + length + 2:
+                    return commands, data[pos:]
+                args.append(data[start:start + length])
+                cursor = start + length + 2
+            commands.append(args)
+            pos = cursor
+        return commands, data[pos:]
+    
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Answer the commands of one connection"""
+        pending = b""
+        # Commands queued since MULTI, None outside a transaction; a rejected command aborts it
+        queued: Optional[List[List[bytes]]] = None
+        aborted = False
+        
+        def run(command: List[bytes]) -> bytes:
+            nonlocal queued, aborted
+            name = command[0].upper()
+            if name == b"MULTI":
+                queued, aborted = [], False
+                return b"+OK\r\n"
+            if name == b"EXEC":
+                transaction, queued = queued, None
+                if aborted:
+                    return b"-EXECABORT Transaction discarded because of previous errors.\r\n"
+                return b"*%d\r\n" % len(transaction) + b"".join(self._run(args) for args in transaction)
+            if queued is None:
+                return self._run(command)
+            if name not in self.COMMANDS:
+                aborted = True
+                return b"-ERR unknown command '%s'\r\n" % name
+            queued.append(command)
+            return b"+QUEUED\r\n"
+        
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                # Everything that arrived together is one pipelined batch
+                commands, pending = self._split_commands(pending + data)
+                if not commands:
+                    continue
+                self.commands_received += len(commands)
+                self.batches_received += 1
+                writer.write(b"".join(run(command) for command in commands))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+async def check_stream_response():
+    """Check incremental parsing of a streamed API response"""
+    print("\n🧪 Testing Streaming Response...")
+    
+    import json
+    from aiohttp import web
+    from src.api_client import LiberGPTAPIClient
+    
+    async def sse_endpoint(request):
+        payload = await request.json()
+        assert payload["stream"] == "true"
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in ["Hello", " streaming", " world"]:
+            event = {"choices": [{"delta": {"content": word}}]}
+            await response.write(f"data: {json.dumps(event)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+    
+    runner, url = await start_local_api(sse_endpoint)
+    try:
+        async with LiberGPTAPIClient(base_url=url) as client:
+            chunks = [chunk async for chunk in client.stream_response("Hi")]
+    finally:
+        await runner.cleanup()
+    
+    assert chunks == ["Hello", " streaming", " world"], chunks
+    print(f"   Received {len(chunks)} chunks")
+    print("✅ Streaming Response test passed!")
+
+def test_stream_response():
+    """Test streaming response parsing against a local server"""
+    asyncio.run(check_stream_response())
+
+async def check_single_flight():
+    """Check coalescing and cancellation safety of single-flight calls"""
+    print("\n🧪 Testing Single Flight...")
+    
+    from src.api_client import SingleFlight
+    
+    flight = SingleFlight()
+    calls = 0
+    
+    async def slow_call():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return "answer"
+    
+    # Concurrent identical calls share one execution, even if one waiter leaves
+    waiters = [asyncio.create_task(flight.do("same", slow_call)) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    waiters[0].cancel()
+    results = await asyncio.gather(*waiters, return_exceptions=True)
+    assert isinstance(results[0], asyncio.CancelledError)
+    assert results[1:] == ["answer", "answer"]
+    assert calls == 1 and flight.coalesced == 2
+    
+    # Errors reach every waiter
+    async def failing_call():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+    
+    results = await asyncio.gather(
+        flight.do("fail", failing_call), flight.do("fail", failing_call),
+        return_exceptions=True
+    )
+    assert all(isinstance(r, ValueError) for r in results)
+    
+    # The shared call is cancelled once every waiter is gone
+    waiter = asyncio.create_task(flight.do("abandoned", slow_call))
+    await asyncio.sleep(0.01)
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    assert flight.in_flight == 0
+    
+    print(f"   {flight.executions} executions, {flight.coalesced} coalesced")
+    print("✅ Single Flight test passed!")
+
+def test_single_flight():
+    """Test single-flight request coalescing"""
+    asyncio.run(check_single_flight())
+
+async def check_health_monitor():
+    """Check that health is derived from observed requests without probing"""
+    print("\n🧪 Testing Health Monitor...")
+    
+    import time
+    from src.api_client import LiberGPTAPIClient
+    from src.health import HealthMonitor
+    
+    api_client = LiberGPTAPIClient(base_url="https://api.example.com")
+    monitor = HealthMonitor(api_client, interval=60, window_size=4)
+    assert monitor.get_status()['healthy'] is None
+    
+    # Requests observed by the client feed the rolling window
+    for latency in (0.5, 1.0, 1.5):
+        api_client._notify_listeners(time.monotonic() - latency, None)
+    api_client._notify_listeners(time.monotonic(), ValueError("boom"))
+    
+    status = monitor.get_status()
+    assert status['samples'] == 4 and status['healthy']
+    assert abs(status['error_rate'] - 0.25) < 1e-9
+    assert 0.9 < status['p50_latency'] < 1.1
+    
+    # /status and the hedging delay report the same percentiles for the same samples
+    from src.resilience import LatencyTracker
+    
+    monitor = HealthMonitor(api_client, interval=60, window_size=20)
+    tracker = LatencyTracker(min_samples=1)
+    api_client.add_listener(tracker.record)
+    for n in range(1, 21):
+        api_client._notify_listeners(time.monotonic() - n / 10, None)
+    for fraction, key in ((0.5, 'p50_latency'), (0.95, 'p95_latency')):
+        assert abs(monitor.get_status()[key] - tracker.percentile(fraction)) < 0.01
+    
+    # Recent traffic means the background loop has nothing to probe yet
+    monitor.start()
+    await asyncio.sleep(0.01)
+    await monitor.stop()
+    assert monitor.probes == 0
+    
+    print(f"   Error rate: {status['error_rate']:.0%}, median latency: {status['p50_latency']:.1f}s")
+    print("✅ Health Monitor test passed!")
+
+def test_health_monitor():
+    """Test the background health monitor"""
+    asyncio.run(check_health_monitor())
+
+async def check_resilience():
+    """Check retries of transient failures and the circuit breaker"""
+    print("\n🧪 Testing Resilience...")
+    
+    from aiohttp import web
+    from src.api_client import LiberGPTAPIClient
+    from src.resilience import CircuitBreaker, CircuitOpenError, RetryPolicy
+    
+    failures_left = 2
+    
+    async def flaky_endpoint(request):
+        nonlocal failures_left
+        if failures_left > 0:
+            failures_left -= 1
+            return web.Response(status=503)
+        return web.json_response({"code": 200, "response": {"content": "Recovered"}})
+    
+    runner, url = await start_local_api(flaky_endpoint)
+    try:
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        client = LiberGPTAPIClient(
+            base_url=url,
+            retry_policy=RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.02),
+            circuit_breaker=breaker
+        )
+        async with client:
+            # Two 503s are retried transparently
+            assert await client.get_response("Hi", use_cache=False) == "Recovered"
+            assert client.retry_policy.retries == 2
+            assert breaker.state == breaker.CLOSED
+            
+            # Three more failures open the circuit, then requests fail fast
+            failures_left = 3
+            try:
+                await client.get_response("Hi again", use_cache=False)
+                assert False, "Expected the request to fail"
+            except Exception as e:
+                assert getattr(e, "status", None) == 503
+            assert breaker.state == breaker.OPEN
+            
+            try:
+                await client.get_response("Hi again", use_cache=False)
+                assert False, "Expected the circuit to reject the request"
+            except CircuitOpenError:
+                pass
+        
+        stats = client.get_stats()
+        print(f"   Retries: {stats['retries']}, circuit opened: {stats['circuit_opened']}, rejected: {stats['circuit_rejected']}")
+        assert stats['circuit_opened'] == 1 and stats['circuit_rejected'] == 1
+    finally:
+        await runner.cleanup()
+    
+    print("✅ Resilience test passed!")
+
+def test_resilience():
+    """Test retry and circuit breaker behaviour against a local server"""
+    asyncio.run(check_resilience())
+
+def make_text_update(update_id, user_id, text, chat_id=None):
+    """Build a synthetic text message update from a user, in their private chat by default"""
+    from telegram import Update
+    
+    chat = {"id": user_id, "type": "private"} if chat_id is None else {"id": chat_id, "type": "supergroup"}
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": chat,
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+            "text": text
+        }
+    }, None)
+
+async def check_update_processor():
+    """Check per-user ordering and cross-user concurrency of the update processor"""
+    print("\n🧪 Testing Update Processor...")
+    
+    from src.update_processor import PerUserUpdateProcessor
+    
+    processor = PerUserUpdateProcessor(max_concurrent_updates=4)
+    await processor.initialize()
+    
+    order = []
+    running = 0
+    peak = 0
+    
+    async def handle(user_id, n, delay):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(delay)
+        order.append((user_id, n))
+        running -= 1
+    
+    tasks = []
+    update_id = 0
+    for n in range(3):
+        for user_id in (1, 2, 3):
+            update_id += 1
+            # Earlier messages are slower, so only ordering keeps them first
+            delay = 0.03 - n * 0.01
+            tasks.append(asyncio.create_task(processor.process_update(
+                make_text_update(update_id, user_id, f"msg {n}"),
+                handle(user_id, n, delay)
+            )))
+    await asyncio.gather(*tasks)
+    
+    for user_id in (1, 2, 3):
+        user_order = [n for uid, n in order if uid == user_id]
+        assert user_order == [0, 1, 2], f"User {user_id} processed out of order: {user_order}"
+    assert peak == 3, f"Expected 3 users in parallel, got {peak}"
+    assert processor.active_users == 0
+    
+    await processor.shutdown()
+    print("✅ Update Processor test passed!")
+
+def test_update_processor():
+    """Test the per-user update processor"""
+    asyncio.run(check_update_processor())
+
+async def check_debounce():
+    """Check merging of quick successive messages before per-user ordering"""
+    print("\n🧪 Testing Message Debouncing...")
+    
+    import os
+    from src.debounce import MessageDebouncer
+    from src.trace import TraceRecorder
+    from src.update_processor import PerUserUpdateProcessor
+    
+    debouncer = MessageDebouncer(window=0.05, max_wait=0.2)
+    recorder = TraceRecorder(os.devnull)
+    processor = PerUserUpdateProcessor(max_concurrent_updates=4, debouncer=debouncer, trace=recorder)
+    handled = []
+    
+    async def handle(update):
+        handled.append((update.effective_chat.id, debouncer.text_of(update)))
+    
+    async def send(update_id, user_id, text, delay=0.0, chat_id=None):
+        await asyncio.sleep(delay)
+        update = make_text_update(update_id, user_id, text, chat_id)
+        await processor.process_update(update, handle(update))
+    
+    # Fragments within the window become one message; another user is not affected
+    await asyncio.gather(
+        send(1, 1, "How do I"), send(2, 1, "reverse a list", 0.02), send(3, 1, "in Python?", 0.04),
+        send(4, 2, "Hello")
+    )
+    assert sorted(handled) == [(1, "How do I\nreverse a list\nin Python?"), (2, "Hello")], handled
+    print("   ✅ Three fragments answered as one message")
+    
+    # A command ends the burst and still runs after it
+    handled.clear()
+    await asyncio.gather(send(5, 1, "First"), send(6, 1, "/stats", 0.01), send(7, 1, "Second", 0.02))
+    assert handled == [(1, "First"), (1, "/stats"), (1, "Second")], handled
+    
+    # A user who keeps typing is answered after the maximum wait
+    handled.clear()
+    started = asyncio.get_running_loop().time()
+    await asyncio.gather(*(send(10 + n, 3, f"part {n}", n * 0.03) for n in range(10)))
+    assert len(handled) == 2 and asyncio.get_running_loop().time() - started < 0.5, handled
+    assert "\n".join(text for _, text in handled) == "\n".join(f"part {n}" for n in range(10))
+    
+    # Messages from one user in two chats are never merged, so no text crosses chats
+    handled.clear()
+    await asyncio.gather(
+        send(20, 4, "group question", chat_id=-100), send(21, 4, "my private secret", 0.01),
+        send(22, 4, "back in the group", 0.02, chat_id=-100)
+    )
+    assert handled == [(-100, "group question"), (4, "my private secret"), (-100, "back in the group")], handled
+    print("   ✅ Messages in different chats kept apart")
+    
+    stats = debouncer.get_stats()
+    print(f"   {stats['bursts']} bursts, {stats['merged']} messages merged")
+    assert stats['merged'] == 10 and stats['pending'] == 0 and not debouncer._leaders
+    assert processor.active_users == 0
+    
+    # Traces keep every text message, including those merged away
+    assert recorder.recorded == 19
+    print("✅ Message Debouncing test passed!")
+
+def test_debounce():
+    """Test per-user message debouncing"""
+    asyncio.run(check_debounce())
+
+async def check_admission():
+    """Check the upstream concurrency cap, queue positions, shedding, deadlines and fairness"""
+    print("\n🧪 Testing Admission Control...")
+    
+    from src.admission import AdmissionController, QueueFullError, QueueTimeoutError
+    
+    admission = AdmissionController(max_in_flight=2, max_queue=2, queue_timeout=1.0)
+    running = 0
+    peak = 0
+    positions = []
+    release = asyncio.Event()
+    
+    async def on_queued(position):
+        positions.append(position)
+    
+    async def call():
+        nonlocal running, peak
+        async with admission.slot(on_queued=on_queued):
+            running += 1
+            peak = max(peak, running)
+            await release.wait()
+            running -= 1
+    
+    tasks = [asyncio.create_task(call()) for _ in range(4)]
+    await asyncio.sleep(0.01)
+    assert positions == [1, 2], f"Unexpected queue positions: {positions}"
+    
+    # A fifth request finds the queue full and is shed immediately
+    try:
+        await admission.acquire()
+        assert False, "Expected the request to be shed"
+    except QueueFullError:
+        pass
+    
+    release.set()
+    await asyncio.gather(*tasks)
+    assert peak == 2, f"Expected at most 2 requests in flight, got {peak}"
+    
+    # A queued request gives up at its deadline and leaves the queue
+    admission.queue_timeout = 0.05
+    await admission.acquire()
+    await admission.acquire()
+    try:
+        await admission.acquire()
+        assert False, "Expected the queued request to time out"
+    except QueueTimeoutError:
+        pass
+    admission.release()
+    admission.release()
+    
+    stats = admission.get_stats()
+    print(f"   Admitted: {stats['admitted']}, queued: {stats['queued']}, shed: {stats['shed']}, timed out: {stats['timed_out']}")
+    assert stats['in_flight'] == 0 and stats['queue_length'] == 0
+    assert stats['admitted'] == 6 and stats['shed'] == 1 and stats['timed_out'] == 1
+    
+    # A light user queued behind a heavy user's backlog is served next, not last
+    admission = AdmissionController(max_in_flight=1, max_queue=10, queue_timeout=1.0)
+    served = []
+    queued_at = {}
+    
+    async def user_call(user_id, n):
+        async def on_queued(position):
+            queued_at[(user_id, n)] = position
+        async with admission.slot(key=user_id, on_queued=on_queued):
+            served.append((user_id, n))
+            await asyncio.sleep(0)
+    
+    await admission.acquire(key="busy")
+    tasks = [asyncio.create_task(user_call("heavy", n)) for n in range(3)]
+    await asyncio.sleep(0)
+    tasks.append(asyncio.create_task(user_call("light", 0)))
+    await asyncio.sleep(0.01)
+    assert queued_at == {("heavy", 0): 1, ("heavy", 1): 2, ("heavy", 2): 3, ("light", 0): 2}, queued_at
+    admission.release()
+    await asyncio.gather(*tasks)
+    assert served == [("heavy", 0), ("light", 0), ("heavy", 1), ("heavy", 2)], f"Unfair order: {served}"
+    
+    print("✅ Admission Control test passed!")
+
+def test_admission():
+    """Test the upstream admission controller"""
+    asyncio.run(check_admission())
+
+async def check_webhook():
+    """Check secret verification and queueing of webhook updates"""
+    print("\n🧪 Testing Webhook Server...")
+    
+    import aiohttp
+    from aiohttp import web
+    from telegram.ext import Application
+    from src.webhook import SECRET_TOKEN_HEADER, WebhookServer
+    
+    application = Application.builder().token("123456:TEST").updater(None).build()
+    server = WebhookServer(application, path="/hook", secret_token="s3cret")
+    runner = web.AppRunner(server.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}/hook"
+    
+    update = make_text_update(1, 42, "Hello").to_dict()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, json=update) as response:
+                assert response.status == 403
+            async with session.post(url, json=update, headers={SECRET_TOKEN_HEADER: "wrong"}) as response:
+                assert response.status == 403
+            async with session.post(url, data="not json", headers={SECRET_TOKEN_HEADER: "s3cret"}) as response:
+                assert response.status == 400
+            async with session.post(url, json=update, headers={SECRET_TOKEN_HEADER: "s3cret"}) as response:
+                assert response.status == 200
+            async with session.get(f"http://127.0.0.1:{port}/healthz") as response:
+                assert response.status == 200
+    finally:
+        await runner.cleanup()
+    
+    queued = application.update_queue.get_nowait()
+    assert queued.effective_user.id == 42 and queued.message.text == "Hello"
+    assert application.update_queue.empty()
+    print(f"   Received: {server.updates_received}, rejected: {server.requests_rejected}")
+    assert server.updates_received == 1 and server.requests_rejected == 3
+    
+    # Webhook mode refuses to start without a secret
+    import os
+    from src.config import Config
+    
+    original_env = dict(os.environ)
+    os.environ.update({"BOT_TOKEN": "123456:TEST", "BOT_MODE": "webhook", "WEBHOOK_URL": "https://bot.example.com"})
+    try:
+        os.environ["WEBHOOK_SECRET"] = ""
+        try:
+            Config()
+            raise AssertionError("Webhook mode accepted an empty WEBHOOK_SECRET")
+        except ValueError as e:
+            assert "WEBHOOK_SECRET" in str(e)
+        os.environ["WEBHOOK_SECRET"] = "s3cret"
+        assert Config().WEBHOOK_SECRET == "s3cret"
+    finally:
+        os.environ.clear()
+        os.environ.update(original_env)
+    print("   ✅ Webhook mode requires a secret")
+    
+    print("✅ Webhook Server test passed!")
+
+def test_webhook():
+    """Test the webhook ingestion server"""
+    asyncio.run(check_webhook())
+
+def sharding_test_worker(index, queue, results):
+    """Worker process target for the sharding test; reports which worker saw each user"""
+    import os
+    
+    while True:
+        data = queue.get()
+        if data is None:
+            break
+        if data["message"]["text"] == "crash":
+            # Flush earlier results first; dying mid-write would leave the queue's lock held
+            results.close()
+            results.join_thread()
+            os._exit(1)
+        results.put((index, data["message"]["from"]["id"]))
+
+async def check_sharding():
+    """Check consistent hashing of users and supervision of worker processes"""
+    print("\n🧪 Testing Worker Sharding...")
+    
+    import multiprocessing
+    from src.sharding import ConsistentHashRing, WorkerPool
+    
+    # Adding a fourth node moves roughly a quarter of the users, all of them to the new node
+    ring = ConsistentHashRing(range(3))
+    before = {user_id: ring.get_node(user_id) for user_id in range(10000)}
+    ring.add_node(3)
+    moved = [user_id for user_id in before if ring.get_node(user_id) != before[user_id]]
+    assert all(ring.get_node(user_id) == 3 for user_id in moved)
+    assert 1500 < len(moved) < 3500, f"Unexpected number of moved users: {len(moved)}"
+    assert {before[user_id] for user_id in before} == {0, 1, 2}
+    
+    results = multiprocessing.get_context("spawn").Queue()
+    pool = WorkerPool(2, target=sharding_test_worker, args=(results,), check_interval=0.05)
+    loop = asyncio.get_running_loop()
+    
+    async def collect(count):
+        return [await loop.run_in_executor(None, results.get, True, 10) for _ in range(count)]
+    
+    pool.start()
+    try:
+        expected = {}
+        update_id = 0
+        for _ in range(2):
+            for user_id in range(1, 7):
+                update_id += 1
+                expected[user_id] = pool.dispatch(make_text_update(update_id, user_id, "Hello"))
+        seen = await collect(12)
+        assert all(expected[user_id] == index for index, user_id in seen), seen
+        
+        # A crashed worker is restarted and keeps serving its users
+        victim = next(user_id for user_id, index in expected.items() if index == 0)
+        pool.dispatch(make_text_update(100, victim, "crash"))
+        pool.dispatch(make_text_update(101, victim, "Hello again"))
+        assert await collect(1) == [(0, victim)]
+        assert pool.restarts == 1
+    finally:
+        await pool.stop(timeout=10)
+    
+    stats = pool.get_stats()
+    print(f"   Dispatched: {stats['dispatched']}, restarts: {stats['restarts']}, moved on resize: {len(moved)}/10000")
+    assert stats['alive_workers'] == 0
+    
+    print("✅ Worker Sharding test passed!")
+
+def test_sharding():
+    """Test user sharding across worker processes"""
+    asyncio.run(check_sharding())
+
+async def check_redis_state():
+    """Check shared rate limits and single round trip state access over Redis"""
+    print("\n🧪 Testing Redis Shared State...")
+    
+    import time
+    from src.redis_state import RedisClient, RedisMemoryBackend, RedisRateLimiter
+    
+    server = LocalRedisServer()
+    await server.start()
+    clients = [RedisClient(server.url), RedisClient(server.url)]
+    try:
+        # Two replicas share one user's quota
+        limiters = [RedisRateLimiter(client, max_messages=3, time_window=60) for client in clients]
+        results = [await limiters[n % 2].acquire(7) for n in range(4)]
+        assert results == [True, True, True, False], results
+        assert limiters[1].get_remaining_time(7) > 0
+        assert not await limiters[0].available(7)
+        assert await limiters[0].available(8)
+        
+        # The rejected message was not counted
+        await asyncio.sleep(0.01)
+        window = int(time.time() // 60)
+        assert await clients[0].execute("GET", f"libergpt:ratelimit:7:{window}") == b"3"
+        
+        # A rate limit check and a history load issued together share one round trip
+        backend = RedisMemoryBackend(clients[0])
+        before = clients[0].round_trips
+        allowed, rows = await asyncio.gather(limiters[0].acquire(9), backend.load_user(9, 5))
+        assert allowed and rows == []
+        assert clients[0].round_trips - before == 1
+        
+        # Error replies surface as exceptions
+        try:
+            await clients[0].execute("NOSUCHCOMMAND")
+            assert False, "Expected an error reply"
+        except Exception as e:
+            assert type(e).__name__ == "RedisError"
+        
+        # Memory writes are one MULTI/EXEC transaction: applied together or not at all
+        before = server.commands_received
+        await backend.write_batch([("append", 9, 1.0, "hi", "hello"), ("append", 9, 2.0, "again", "hi again")])
+        assert server.commands_received - before == 2 + 3
+        assert len(await backend.load_user(9, 5)) == 2
+        try:
+            await clients[0].transaction(("RPUSH", "libergpt:memory:9", "[]"), ("NOSUCHCOMMAND",))
+            assert False, "Expected the transaction to be discarded"
+        except Exception as e:
+            assert type(e).__name__ == "RedisError"
+        assert len(await backend.load_user(9, 5)) == 2
+    finally:
+        for client in clients:
+            await client.close()
+        await server.stop()
+    
+    # A stalled server times out: rate limits fail open and memory loads come back empty
+    from src.memory import ConversationMemory
+    
+    async def stall(reader, writer):
+        await reader.read()
+        writer.close()
+    
+    stalled = await asyncio.start_server(stall, "127.0.0.1", 0)
+    client = RedisClient(f"redis://127.0.0.1:{stalled.sockets[0].getsockname()[1]}/0", command_timeout=0.05)
+    memory = ConversationMemory(backend=RedisMemoryBackend(client), flush_interval=0.01)
+    try:
+        await memory.start()
+        started = time.monotonic()
+        assert await RedisRateLimiter(client).acquire(7)
+        await memory.ensure_loaded(7)
+        assert memory.get_context_string(7) == ""
+        assert time.monotonic() - started < 1
+    finally:
+        await memory.close()
+        await client.close()
+        stalled.close()
+        await stalled.wait_closed()
+    print("   ✅ Stalled server timed out without blocking the user")
+    
+    print(f"   Commands: {server.commands_received}, batches: {server.batches_received}")
+    print("✅ Redis Shared State test passed!")
+
+def test_redis_state():
+    """Test Redis-backed shared state against the in-process stand-in"""
+    asyncio.run(check_redis_state())
+
+async def check_outbound():
+    """Check ordering, pacing, priorities and flood-limit retries of the outbound scheduler"""
+    print("\n🧪 Testing Outbound Scheduler...")
+    
+    import time
+    from telegram.error import RetryAfter
+    from src.outbound import OutboundScheduler
+    
+    scheduler = OutboundScheduler(global_rate=1000, chat_rate=1000, chat_burst=10)
+    delivered = []
+    flood_once = {1: True}
+    
+    async def send(chat, n, delay=0):
+        await asyncio.sleep(delay)
+        if n == 1 and flood_once.pop(chat, False):
+            raise RetryAfter(0)
+        delivered.append((chat, n))
+        return n
+    
+    # Earlier parts are slower and one hits a flood limit, yet each chat's parts arrive in order
+    futures = []
+    for n in range(3):
+        for chat in (1, 2):
+            futures.append(scheduler.submit(chat, lambda chat=chat, n=n: send(chat, n, 0.02 - n * 0.01)))
+    results = await asyncio.gather(*futures)
+    assert results == [0, 0, 1, 1, 2, 2]
+    for chat in (1, 2):
+        assert [n for c, n in delivered if c == chat] == [0, 1, 2]
+    
+    # A failing send fails only its own future
+    async def fail():
+        raise ValueError("Bad request")
+    failed = scheduler.submit(3, fail)
+    assert await scheduler.send(3, lambda: send(3, 0)) == 0
+    try:
+        await failed
+        assert False, "Expected the send to fail"
+    except ValueError:
+        pass
+    await scheduler.close()
+    stats = scheduler.get_stats()
+    assert (stats['sent'], stats['retried'], stats['failed'], stats['queued']) == (7, 1, 1, 0)
+    
+    # The global bucket paces sends across chats, the chat bucket within a chat
+    scheduler = OutboundScheduler(global_rate=50, chat_rate=1000, chat_burst=10)
+    started = time.monotonic()
+    await asyncio.gather(*(scheduler.send(chat, lambda chat=chat: send(chat, 0)) for chat in range(10, 70)))
+    assert time.monotonic() - started >= 0.15, "Global rate was not enforced"
+    
+    scheduler = OutboundScheduler(global_rate=1000, chat_rate=20, chat_burst=1)
+    started = time.monotonic()
+    await asyncio.gather(*(scheduler.send(5, lambda n=n: send(5, n + 10)) for n in range(5)))
+    assert time.monotonic() - started >= 0.15, "Chat rate was not enforced"
+    
+    # Once the global bucket is empty, replies go ahead of typing indicators,
+    # repeated indicators are coalesced and stale ones are dropped
+    scheduler = OutboundScheduler(global_rate=10, chat_rate=1000, chat_burst=10, typing_max_wait=0.15)
+    order = []
+    
+    async def typing(chat):
+        order.append(("typing", chat))
+    
+    async def reply(chat):
+        order.append(("reply", chat))
+    
+    await asyncio.gather(*(scheduler.send(chat, lambda chat=chat: send(chat, 0)) for chat in range(100, 110)))
+    scheduler.send_typing(6, lambda: typing(6))
+    scheduler.send_typing(6, lambda: typing(6))
+    scheduler.send_typing(7, lambda: typing(7))
+    await asyncio.sleep(0)
+    await scheduler.send(8, lambda: reply(8))
+    # A reply queued while the chat's indicator waits for a token replaces it
+    scheduler.send_typing(9, lambda: typing(9))
+    await asyncio.sleep(0)
+    await scheduler.send(9, lambda: reply(9))
+    await scheduler.close()
+    stats = scheduler.get_stats()
+    print(f"   Order under load: {order}, typing dropped: {stats['typing_dropped']}")
+    assert order[:2] == [("reply", 8), ("reply", 9)], order
+    assert ("typing", 9) not in order
+    assert stats['typing_coalesced'] == 1
+    assert stats['typing_sent'] + stats['typing_dropped'] == 3 and stats['typing_dropped'] >= 2
+    
+    print("✅ Outbound Scheduler test passed!")
+
+def test_outbound():
+    """Test the outbound send scheduler"""
+    asyncio.run(check_outbound())
+
+async def check_metrics():
+    """Check metric rendering, the /metrics endpoint and the outbound hook"""
+    print("\n🧪 Testing Metrics...")
+    
+    import aiohttp
+    from aiohttp import web
+    from telegram.error import RetryAfter
+    from src.memory import ConversationMemory
+    from src.metrics import BotMetrics, MetricsServer
+    from src.outbound import OutboundScheduler
+    
+    metrics = BotMetrics()
+    metrics.record_upstream(0.3, None)
+    metrics.record_upstream(7.0, None)
+    metrics.record_upstream(60.0, asyncio.TimeoutError())
+    metrics.rate_limit_rejections.inc()
+    memory = ConversationMemory(max_conversations=5)
+    memory.add_conversation(1, "Hi", "Hello")
+    memory.add_conversation(2, "Hi", "Hello")
+    metrics.track_memory(memory)
+    
+    # Bot API calls are timed per attempt, flood waits included
+    outbound = OutboundScheduler(global_rate=1000, chat_rate=1000, chat_burst=10)
+    outbound.add_listener(metrics.record_send)
+    attempts = []
+    
+    async def send():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RetryAfter(0)
+        return "sent"
+    
+    assert await outbound.send(1, send) == "sent"
+    assert metrics.telegram_send_seconds.count(outcome="flood_limited") == 1
+    assert metrics.telegram_send_seconds.count(outcome="success") == 1
+    
+    server = MetricsServer(metrics.registry)
+    runner = web.AppRunner(server.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                assert response.status == 200
+                assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+                body = await response.text()
+    finally:
+        await runner.cleanup()
+    
+    lines = body.splitlines()
+    assert "# TYPE libergpt_upstream_request_seconds histogram" in lines
+    assert 'libergpt_upstream_request_seconds_bucket{outcome="success",le="0.5"} 1' in lines
+    assert 'libergpt_upstream_request_seconds_bucket{outcome="success",le="10"} 2' in lines
+    assert 'libergpt_upstream_request_seconds_bucket{outcome="success",le="+Inf"} 2' in lines
+    assert 'libergpt_upstream_request_seconds_count{outcome="timeout"} 1' in lines
+    assert "libergpt_rate_limit_rejections_total 1" in lines
+    assert "libergpt_memory_active_users 2" in lines
+    assert "libergpt_memory_conversations 2" in lines
+    print(f"   Exported {sum(1 for line in lines if not line.startswith('#'))} samples")
+    
+    print("✅ Metrics test passed!")
+
+def test_metrics():
+    """Test the metrics registry and endpoint"""
+    asyncio.run(check_metrics())
+
+async def check_mock_api():
+    """Check the API client against the local mock API used by the benchmarks"""
+    print("\n🧪 Testing Mock API...")
+    
+    from benchmarks.mock_api import MockLiberGPTAPI, parse_latency
+    from src.api_client import LiberGPTAPIClient
+    
+    api = MockLiberGPTAPI(latency=parse_latency("uniform:0,0.01"), response_chars=300, seed=1)
+    url = await api.start()
+    try:
+        async with LiberGPTAPIClient(base_url=url, timeout=5) as client:
+            response = await client.get_response("Hello", use_cache=False)
+            streamed = [chunk async for chunk in client.stream_response("Hello", use_cache=False)]
+    finally:
+        await api.stop()
+    
+    assert len(response) == 300 and len(streamed) > 1 and len("".join(streamed)) == 300
+    assert api.get_stats()['requests'] == 2
+    print(f"   ✅ Plain and streamed responses received ({len(streamed)} events)")
+    
+    # Latency distributions are validated up front
+    for spec in ("fixed:0.5", "uniform:0.1,0.2", "exp:0.3", "lognormal:0.5,0.5"):
+        assert parse_latency(spec)(random.Random(1)) >= 0
+    try:
+        parse_latency("normal:1")
+        assert False, "Unknown distribution accepted"
+    except ValueError:
+        pass
+    
+    print("✅ Mock API test passed!")
+
+def test_mock_api():
+    """Test the benchmark mock API"""
+    asyncio.run(check_mock_api())
+
+async def check_trace():
+    """Check update trace recording and loading for replay"""
+    print("\n🧪 Testing Update Trace...")
+    
+    import os
+    import json
+    import tempfile
+    from benchmarks.replay import load_trace
+    from src.trace import TraceRecorder
+    
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trace.jsonl")
+        recorder = TraceRecorder(path, salt="test")
+        for update_id, user_id, text in ((1, 42, "secret question"), (2, 7, "hi"), (3, 42, "another one")):
+            recorder.record(make_text_update(update_id, user_id, text))
+        recorder.record(make_text_update(4, 42, "/start"))
+        await recorder.close()
+        
+        with open(path, encoding="utf-8") as f:
+            raw = f.read()
+        entries = [json.loads(line) for line in raw.splitlines()]
+        trace = load_trace([path])
+    
+    # Only timing, a pseudonym and the length are stored
+    assert recorder.recorded == 3 and len(entries) == 3
+    assert "secret" not in raw and '"42"' not in raw
+    assert [entry['chars'] for entry in entries] == [15, 2, 11]
+    assert entries[0]['user'] == entries[2]['user'] != entries[1]['user']
+    assert TraceRecorder(path, salt="test").anonymise(42) == entries[0]['user']
+    assert TraceRecorder(path, salt="other").anonymise(42) != entries[0]['user']
+    print("   ✅ Messages recorded anonymously")
+    
+    # Replay sees users in order of first appearance and offsets from the first message
+    assert [(user, chars) for _, user, chars in trace] == [(1, 15), (2, 2), (1, 11)]
+    assert trace[0][0] == 0 and all(offset >= 0 for offset, _, _ in trace)
+    print("   ✅ Trace loaded for replay")
+    
+    # The update processor records arrivals, not when a message's turn comes
+    from src.update_processor import PerUserUpdateProcessor
+    
+    recorder = TraceRecorder(path, salt="test")
+    processor = PerUserUpdateProcessor(trace=recorder)
+    await asyncio.gather(
+        processor.process_update(make_text_update(1, 42, "first"), asyncio.sleep(0.2)),
+        processor.process_update(make_text_update(2, 42, "second"), asyncio.sleep(0))
+    )
+    arrivals = [json.loads(line)['t'] for line in recorder._buffer]
+    assert len(arrivals) == 2 and arrivals[1] - arrivals[0] < 0.1
+    print("   ✅ Arrival recorded before waiting for the user's earlier update")
+    
+    print("✅ Update trace test passed!")
+
+def test_trace():
+    """Test update trace recording"""
+    asyncio.run(check_trace())
+
 def test_rate_limiter():
     """Test the rate limiter"""
     print("\n🧪 Testing Rate Limiter...")
     
+    import time
     from src.utils import RateLimiter
     
     rate_limiter = RateLimiter(max_messages=3, time_window=60)
@@ -64,13 +1164,135 @@ def test_rate_limiter():
     
     remaining = rate_limiter.get_remaining_time(user_id)
     print(f"   4th Message: ❌ Blocked (wait {remaining}s)")
+    
+    # Peeking reports quota without consuming it
+    other_user = 67890
+    for _ in range(5):
+        assert rate_limiter.peek(other_user)
+    assert rate_limiter.remaining(other_user) == 3
+    rate_limiter.is_allowed(other_user)
+    assert rate_limiter.remaining(other_user) == 2
+    assert not rate_limiter.peek(user_id)
+    
+    # Users whose quota has refilled are swept from memory
+    short_limiter = RateLimiter(max_messages=2, time_window=0.02, sweep_interval=0)
+    short_limiter.is_allowed(user_id)
+    time.sleep(0.03)
+    short_limiter.is_allowed(other_user)
+    assert short_limiter.tracked_users == 1
+    print("   Peek and idle sweeping work")
     print("✅ Rate Limiter test passed!")
 
+def test_response_cache():
+    """Test the LRU+TTL response cache"""
+    print("\n🧪 Testing Response Cache...")
+    
+    import time
+    from src.cache import ResponseCache
+    
+    cache = ResponseCache(max_size=2, ttl=60)
+    
+    # Normalized prompts share an entry, different context does not
+    cache.set(cache.make_key("Hi  there"), "Hello!")
+    assert cache.get(cache.make_key("  hi there ")) == "Hello!"
+    assert cache.get(cache.make_key("hi there", "User: a\nAssistant: b")) is None
+    
+    # Least recently used entry is evicted first
+    cache.set(cache.make_key("one"), "1")
+    cache.get(cache.make_key("hi there"))
+    cache.set(cache.make_key("two"), "2")
+    assert cache.get(cache.make_key("one")) is None
+    assert cache.get(cache.make_key("hi there")) == "Hello!"
+    
+    # Expired entries are dropped
+    short_cache = ResponseCache(max_size=2, ttl=0.01)
+    short_cache.set("key", "value")
+    time.sleep(0.02)
+    assert short_cache.get("key") is None
+    
+    stats = cache.get_stats()
+    print(f"   Stats: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions")
+    assert stats['hits'] == 3 and stats['misses'] == 2 and stats['evictions'] == 1
+    assert short_cache.get_stats()['expirations'] == 1
+    print("✅ Response Cache test passed!")
+
+async def check_similarity_cache():
+    """Check near-duplicate matching and its use for prompts without context"""
+    print("\n🧪 Testing Similarity Cache...")
+    
+    import time
+    from benchmarks.mock_api import MockLiberGPTAPI
+    from src.api_client import LiberGPTAPIClient
+    from src.cache import SimilarityCache
+    from src.metrics import BotMetrics
+    
+    cache = SimilarityCache(max_size=2, ttl=60)
+    cache.set("How do I reverse a list in Python?", "Use reversed()")
+    
+    # Case, punctuation and spacing do not matter, other questions and numbers do
+    assert cache.get("how do I reverse a list in python") == "Use reversed()"
+    assert cache.get("How do I reverse a list in   Python!!") == "Use reversed()"
+    assert cache.get("How do I sort a list in Python?") is None
+    cache.set("What is 12 times 7?", "84")
+    assert cache.get("what is 12 times 8") is None
+    print("   ✅ Near-duplicates matched, different questions missed")
+    
+    # Prompts differing only by an operator are different questions
+    operator_cache = SimilarityCache(max_size=8, ttl=60)
+    operator_cache.set("what is 2+2", "4")
+    assert operator_cache.get("What is 2+2?") == "4"
+    for prompt in ("what is 2*2", "what is 2-2", "what is 2^2", "what is 2/2", "what is 2 2"):
+        assert operator_cache.get(prompt) is None, prompt
+    
+    # Least recently used entry is evicted first, along with its index entries
+    cache.get("how do i reverse a list in python")
+    cache.set("What is the capital of France?", "Paris")
+    assert cache.get("what is 12 times 7") is None
+    assert len(cache) == 2 and cache.evictions == 1
+    assert all("what is 12 times 7" not in bucket for bucket in cache._buckets.values())
+    
+    # Expired entries are dropped and long prompts are not indexed
+    short_cache = SimilarityCache(max_size=2, ttl=0.01, max_prompt_length=50)
+    short_cache.set("Tell me a joke", "Knock knock")
+    time.sleep(0.02)
+    assert short_cache.get("tell me a joke") is None
+    short_cache.set("x" * 60, "long")
+    assert len(short_cache) == 0 and short_cache.get("x" * 60) is None
+    assert short_cache.get_stats()['expirations'] == 1 and short_cache.get_stats()['skipped'] == 1
+    
+    stats = cache.get_stats()
+    print(f"   Stats: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions")
+    assert stats['hits'] == 3 and stats['misses'] == 3
+    
+    # Only prompts without conversation context reach the similarity cache
+    api = MockLiberGPTAPI(response_chars=50, seed=1)
+    url = await api.start()
+    try:
+        async with LiberGPTAPIClient(base_url=url, similarity_cache=SimilarityCache()) as client:
+            first = await client.get_response("What is a Python decorator?")
+            assert await client.get_response("what is a python decorator") == first
+            await client.get_response("what is a python decorator", context="User: hi\nAssistant: hello")
+            streamed = [chunk async for chunk in client.stream_response("What is a python decorator??")]
+    finally:
+        await api.stop()
+    assert streamed == [first] and api.get_stats()['requests'] == 2
+    print("   ✅ Stateless prompts answered from the similarity cache")
+    
+    metrics = BotMetrics()
+    metrics.track_cache("similarity", cache)
+    assert "libergpt_similarity_cache_hits_total 3" in metrics.registry.render()
+    
+    print("✅ Similarity Cache test passed!")
+
+def test_similarity_cache():
+    """Test the near-duplicate prompt cache"""
+    asyncio.run(check_similarity_cache())
+
 def test_utils():
     """Test utility functions"""
     print("\n🧪 Testing Utilities...")
     
-    from src.utils import truncate_message, format_error_message
+    from src.utils import truncate_message, split_message, format_error_message
     
     # Test message truncation
     long_message = "A" * 5000
@@ -82,6 +1304,20 @@ def test_utils():
         print("   ❌ Message truncation failed")
         return
     
+    # Test message splitting: nothing is lost, paragraphs stay whole, code blocks are reopened
+    paragraphs = [f"Paragraph {n}. " + "Some words here. " * 10 for n in range(6)]
+    code = "```python\n" + "\n".join(f"print({n})" for n in range(40)) + "\n```"
+    text = "\n\n".join(paragraphs[:3] + [code] + paragraphs[3:])
+    chunks = split_message(text, 300)
+    assert all(len(chunk) <= 300 for chunk in chunks)
+    assert all(chunk.count("```") % 2 == 0 for chunk in chunks), "A chunk left a code block open"
+    assert chunks[0].endswith("here.") and chunks[1].startswith("Paragraph 1.")
+    rejoined = "\n".join(chunks).replace("```\n```python", "").replace(" ", "").replace("\n", "")
+    assert rejoined == text.replace(" ", "").replace("\n", ""), "Splitting lost content"
+    assert split_message("Short", 300) == ["Short"]
+    assert split_message("A" * 700, 300) == ["A" * 300, "A" * 300, "A" * 100]
+    print(f"   ✅ Message splitting works ({len(chunks)} chunks)")
+    
     # Test error formatting
     error = ConnectionError("Test error")
     formatted = format_error_message(error)
@@ -94,6 +1330,98 @@ def test_utils():
     
     print("✅ Utilities test passed!")
 
+def test_markdown():
+    """Test rendering AI Markdown as MarkdownV2"""
+    print("\n🧪 Testing Markdown Rendering...")
+    
+    from src.markdown import render_markdown_v2, render_chunks
+    from src.utils import escape_markdown
+    
+    # Plain text is escaped, the backslash included
+    assert escape_markdown("1+1=2. (sure!) a\\b") == "1\\+1\\=2\\. \\(sure\\!\\) a\\\\b"
+    print("   ✅ Escaping works")
+    
+    # Common constructs become MarkdownV2 entities
+    assert render_markdown_v2("## Title") == "*Title*"
+    assert render_markdown_v2("### **Title** and __more__") == "*Title and more*"
+    assert render_markdown_v2("### 1. **Setup**: *fast*") == "*1\\. Setup: _fast_*"
+    assert render_markdown_v2("**bold** and *it* and ~~gone~~") == "*bold* and _it_ and ~gone~"
+    assert render_markdown_v2("- one\n* two") == "• one\n• two"
+    assert render_markdown_v2("[a.b](https://x.io/a_(b))") == "[a\\.b](https://x.io/a_(b\\))"
+    assert render_markdown_v2("snake_case 2*3*4") == "snake\\_case 2\\*3\\*4"
+    print("   ✅ Formatting works")
+    
+    # Code keeps its content, only backticks and backslashes are escaped
+    assert render_markdown_v2("run `a*b_c\\`") == "run `a*b_c\\\\`"
+    code = "```python\nx = [1, 2]  # `tick`\n```"
+    assert render_markdown_v2(code) == "```python\nx = [1, 2]  # \\`tick\\`\n```"
+    print("   ✅ Code blocks work")
+    
+    # Rendered parts fit in a message even though escaping makes them longer
+    parts = render_chunks("Fact. " * 1000, 500)
+    assert all(len(rendered) <= 500 for _, rendered in parts)
+    assert "".join(source for source, _ in parts).replace(" ", "") == "Fact." * 1000
+    print(f"   ✅ Rendered splitting works ({len(parts)} parts)")
+    
+    print("✅ Markdown rendering test passed!")
+
+def test_logging():
+    """Test the queued JSON logging pipeline with sampling"""
+    print("\n🧪 Testing Logging...")
+    
+    import json
+    import logging
+    import os
+    import tempfile
+    from src.utils import setup_logging
+    
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bot.log")
+        # A second setup replaces the first listener instead of leaving it running
+        first = setup_logging(log_file="", console=False)
+        listener = setup_logging(log_file=path, json_format=True, sample_rate=0.5, console=False)
+        assert first._thread is None and listener is not first
+        try:
+            log = logging.getLogger("libergpt.test")
+            for update_id in range(1000):
+                extra = {'sample_key': update_id}
+                log.info("Message %d from %s", update_id, "alice", extra=extra)
+                log.info("Answered %d", update_id, extra=extra)
+            log.warning("Always kept", extra={'sample_key': 1})
+            # Arguments are rendered when logging, not when the listener gets to the record
+            state = {'step': 1}
+            log.warning("State %s", state)
+            state['step'] = 2
+            try:
+                raise ValueError("boom")
+            except ValueError:
+                log.exception("Failed")
+        finally:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+            root.handlers[:] = saved_handlers
+            root.setLevel(saved_level)
+        
+        with open(path, encoding="utf-8") as f:
+            entries = [json.loads(line) for line in f]
+    
+    messages = [e for e in entries if e['message'].startswith("Message")]
+    answers = {e['sample_key'] for e in entries if e['message'].startswith("Answered")}
+    print(f"   Kept {len(messages)} of 1000 sampled messages")
+    assert 400 < len(messages) < 600
+    # Both logs of an update are kept or dropped together
+    assert {e['sample_key'] for e in messages} == answers
+    assert messages[0]['message'] == f"Message {messages[0]['sample_key']} from alice"
+    assert messages[0]['level'] == "INFO" and messages[0]['logger'] == "libergpt.test"
+    assert entries[-3]['message'] == "Always kept"
+    assert entries[-2]['message'] == "State {'step': 1}"
+    assert entries[-1]['message'] == "Failed" and "ValueError: boom" in entries[-1]['exc']
+    
+    print("✅ Logging test passed!")
+
 def test_config():
     """Test configuration loading"""
     print("\n🧪 Testing Configuration...")
@@ -152,8 +1480,27 @@ async def main():
     print("================================\n")
     
     # Test components
+    await check_api_session_lifecycle()
+    await check_update_processor()
+    await check_debounce()
+    await check_admission()
+    await check_webhook()
+    await check_sharding()
+    await check_redis_state()
+    await check_outbound()
+    await check_metrics()
+    await check_mock_api()
+    await check_trace()
+    await check_stream_response()
+    await check_single_flight()
+    await check_health_monitor()
+    await check_resilience()
     test_rate_limiter()
+    test_response_cache()
+    await check_similarity_cache()
     test_utils()
+    test_markdown()
+    test_logging()
     test_config()
     await test_api_client()
     
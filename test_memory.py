@@ -4,6 +4,8 @@ Simple test for the memory functionality
 """
 
 import sys
+import asyncio
+import tempfile
 from pathlib import Path
 
 # Add src directory to Python path
@@ -53,5 +55,200 @@ def test_memory():
     
     print("✅ Memory tests completed successfully!")
 
+def test_memory_bounds():
+    """Test global byte budget and idle eviction"""
+    print("\n🧪 Testing Memory Bounds...")
+    
+    import time
+    
+    long_reply = "x" * 1000
+    memory = ConversationMemory(max_conversations=5, max_bytes=5000)
+    
+    # Each turn costs a little over 1 KB, so only the most recent users fit
+    for user_id in range(1, 8):
+        memory.add_conversation(user_id, "Hi", long_reply)
+    
+    stats = memory.get_total_stats()
+    print(f"   📊 {stats['active_users']} users kept, {stats['current_bytes']} bytes, {stats['evicted_users']} evicted")
+    assert stats['current_bytes'] <= 5000
+    assert stats['evicted_users'] == 7 - stats['active_users']
+    assert memory.get_conversation_history(1) == []
+    assert len(memory.get_conversation_history(7)) == 1
+    
+    # Idle users are evicted once they exceed the TTL
+    idle_memory = ConversationMemory(max_conversations=5, idle_ttl=0.01)
+    idle_memory.add_conversation(1, "Hello", "Hi there!")
+    time.sleep(0.02)
+    assert idle_memory.evict_idle() == 1
+    assert idle_memory.get_total_stats()['current_bytes'] == 0
+    
+    # Totals are maintained incrementally and agree with a full scan
+    counted = ConversationMemory(max_conversations=2)
+    for user_id in (1, 1, 1, 2, 3):
+        counted.add_conversation(user_id, "Hi", "Hello")
+    counted.clear_user_memory(2)
+    totals = counted.get_total_stats()
+    assert totals['active_users'] == 2 and totals['total_conversations'] == 3
+    assert totals['total_conversations'] == sum(len(h.turns) for h in counted._conversations.values())
+    assert memory.get_total_stats()['total_conversations'] == sum(len(h.turns) for h in memory._conversations.values())
+    
+    print("✅ Memory bounds tests completed successfully!")
+
+def test_context_budget():
+    """Test budget-aware, cached context building"""
+    print("\n🧪 Testing Context Budget...")
+    
+    memory = ConversationMemory(max_conversations=5)
+    user_id = 12345
+    memory.add_conversation(user_id, "First question", "A" * 500)
+    memory.add_conversation(user_id, "Second question", "B" * 500)
+    memory.add_conversation(user_id, "Third question", "Short answer")
+    
+    full = memory.get_context_string(user_id, include_last_n=3)
+    budgeted = memory.get_context_string(user_id, include_last_n=3, max_chars=700)
+    print(f"   📝 Full context: {len(full)} chars, budgeted: {len(budgeted)} chars")
+    assert len(budgeted) <= 700
+    assert "First question" not in budgeted
+    assert "Third question" in budgeted
+    assert budgeted.endswith("Current message:")
+    
+    # Rendered context is reused until the history changes
+    assert memory.get_context_string(user_id, include_last_n=3, max_chars=700) is budgeted
+    
+    # Token budgets are converted to characters
+    assert len(memory.get_context_string(user_id, include_last_n=3, max_tokens=100)) <= 400
+    
+    memory.add_conversation(user_id, "Fourth question", "Another answer")
+    assert "Fourth question" in memory.get_context_string(user_id, include_last_n=3, max_chars=700)
+    
+    print("✅ Context budget tests completed successfully!")
+
+async def check_sqlite_memory():
+    """Check that conversations survive a restart with the SQLite backend"""
+    print("\n🧪 Testing SQLite Memory Backend...")
+    
+    from src.storage import SQLiteBackend
+    
+    user_id = 12345
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = str(Path(tmp_dir) / "memory.db")
+        
+        memory = ConversationMemory(max_conversations=2, backend=SQLiteBackend(db_path, max_conversations=2))
+        await memory.start()
+        await memory.ensure_loaded(user_id)
+        memory.add_conversation(user_id, "Hello", "Hi there!")
+        memory.add_conversation(user_id, "What's Python?", "A programming language.")
+        memory.add_conversation(user_id, "Who made it?", "Guido van Rossum.")
+        await memory.close()
+        print("   💾 Wrote 3 conversations and closed")
+        
+        # A fresh instance sees the newest conversations after loading
+        memory = ConversationMemory(max_conversations=2, backend=SQLiteBackend(db_path, max_conversations=2))
+        await memory.start()
+        await memory.ensure_loaded(user_id)
+        history = memory.get_conversation_history(user_id)
+        print(f"   📚 Restored {len(history)} conversations")
+        assert [conv['user_message'] for conv in history] == ["What's Python?", "Who made it?"]
+        
+        # Clearing is persisted as well
+        assert memory.clear_user_memory(user_id) == 2
+        await memory.ensure_loaded(user_id)
+        assert memory.get_conversation_history(user_id) == []
+        await memory.close()
+    
+    print("✅ SQLite memory tests completed successfully!")
+
+async def check_write_behind_limit():
+    """Check that writes kept for retry stay bounded while the backend fails"""
+    print("\n🧪 Testing Write-Behind Retry Limit...")
+    
+    from src.storage import StorageBackend, WriteBehindWriter
+    
+    class FailingBackend(StorageBackend):
+        async def load_user(self, user_id, limit):
+            return []
+        
+        async def write_batch(self, ops):
+            raise OSError("disk is read-only")
+    
+    writer = WriteBehindWriter(FailingBackend(), max_pending=100)
+    for n in range(3):
+        for user_id in range(60):
+            writer.enqueue(("append", user_id, float(n), "question", "answer"))
+        await writer.flush()
+    
+    # The newest writes are kept for the next attempt, the oldest are dropped
+    assert len(writer._pending) == 100 and writer.ops_dropped == 80
+    assert writer._pending[-1] == ("append", 59, 2.0, "question", "answer")
+    assert writer.write_errors == 3 and writer.has_pending(59)
+    print(f"   Kept {len(writer._pending)} writes, dropped {writer.ops_dropped}")
+    print("✅ Write-behind retry limit test passed!")
+
+def test_write_behind_limit():
+    """Test the bound on writes kept for retry"""
+    asyncio.run(check_write_behind_limit())
+
+def test_sqlite_memory():
+    """Test the SQLite memory backend"""
+    asyncio.run(check_sqlite_memory())
+
+async def check_redis_memory():
+    """Check that replicas sharing the Redis backend see each other's conversations"""
+    print("\n🧪 Testing Redis Memory Backend...")
+    
+    from src.redis_state import RedisClient, RedisMemoryBackend
+    from test_bot import LocalRedisServer
+    
+    user_id = 12345
+    server = LocalRedisServer()
+    await server.start()
+    clients = [RedisClient(server.url), RedisClient(server.url)]
+    try:
+        replica_a, replica_b = [
+            ConversationMemory(max_conversations=2, backend=RedisMemoryBackend(client, max_conversations=2), flush_interval=0.01)
+            for client in clients
+        ]
+        await replica_a.start()
+        await replica_b.start()
+        
+        await replica_a.ensure_loaded(user_id)
+        replica_a.add_conversation(user_id, "Hello", "Hi there!")
+        replica_a.add_conversation(user_id, "What's Python?", "A programming language.")
+        await replica_a.close()
+        
+        # The other replica picks up the history, then answers the next message itself
+        await replica_b.ensure_loaded(user_id)
+        assert [conv['user_message'] for conv in replica_b.get_conversation_history(user_id)] == ["Hello", "What's Python?"]
+        replica_b.add_conversation(user_id, "Who made it?", "Guido van Rossum.")
+        await replica_b.close()
+        print("   🔁 Two replicas wrote 3 conversations")
+        
+        # A replica with a stale copy refreshes it; old entries were trimmed in Redis
+        await replica_a.ensure_loaded(user_id)
+        history = replica_a.get_conversation_history(user_id)
+        print(f"   📚 Refreshed {len(history)} conversations")
+        assert [conv['user_message'] for conv in history] == ["What's Python?", "Who made it?"]
+        
+        # Clearing is shared as well
+        assert replica_a.clear_user_memory(user_id) == 2
+        await replica_a.close()
+        await replica_b.ensure_loaded(user_id)
+        assert replica_b.get_conversation_history(user_id) == []
+    finally:
+        for client in clients:
+            await client.close()
+        await server.stop()
+    
+    print("✅ Redis memory tests completed successfully!")
+
+def test_redis_memory():
+    """Test the Redis memory backend against the in-process stand-in"""
+    asyncio.run(check_redis_memory())
+
 if __name__ == "__main__":
     test_memory()
+    test_memory_bounds()
+    test_context_budget()
+    asyncio.run(check_sqlite_memory())
+    asyncio.run(check_write_behind_limit())
+    asyncio.run(check_redis_memory())